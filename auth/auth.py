@@ -1,20 +1,21 @@
 import json
-from flask import request, _request_ctx_stack
+import logging
+from flask import request, current_app, _request_ctx_stack
 from functools import wraps
 from jose import jwt
+from jose.exceptions import JWTError
 from urllib.request import urlopen
-import os
+import math
+import time
 
 
+logger = logging.getLogger(__name__)
+
 """
 https://fsnd-kml.auth0.com/authorize?audience=capstone&response_type=token&client_id=QgmGth71OqndSVlCJ6YIAFir6t2EAt48&redirect_uri=http://localhost:8100/login-results
 https://fsnd-kml.auth0.com/.well-known/jwks.json
 """
 
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = [os.environ['ALGORITHMS']]
-API_AUDIENCE = os.environ['API_AUDIENCE']
-
 # AuthError Exception
 '''
 AuthError Exception
@@ -23,9 +24,10 @@ A standardized way to communicate auth failure modes
 
 
 class AuthError(Exception):
-    def __init__(self, error, status_code):
+    def __init__(self, error, status_code, headers=None):
         self.error = error
         self.status_code = status_code
+        self.headers = headers or {}
 
 
 # Auth Header
@@ -74,7 +76,8 @@ def get_token_auth_header():
 '''
 @TODO implement check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'),
+            or a tuple of permissions of which any one is enough
         payload: decoded jwt payload
 
     it should raise an AuthError if permissions are not included in the payload
@@ -92,7 +95,13 @@ def check_permissions(permission, payload):
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    if isinstance(permission, str):
+        permissions = (permission,)
+    else:
+        # any of the given permissions
+        permissions = permission
+
+    if not any(p in payload['permissions'] for p in permissions):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -100,6 +109,71 @@ def check_permissions(permission, payload):
     return True
 
 
+'''
+JWKS cache
+    the signing keys of a domain are fetched once and kept for JWKS_TTL
+    seconds, a token signed with an unknown key id triggers a refetch
+    at most once every JWKS_MIN_REFRESH_INTERVAL seconds
+'''
+
+JWKS_MIN_REFRESH_INTERVAL = 60
+
+_jwks_cache = {}
+
+
+def jwks_url(auth0_domain):
+    return f'https://{auth0_domain}/.well-known/jwks.json'
+
+
+def set_jwks(auth0_domain, jwks, ttl):
+    _jwks_cache[auth0_domain] = (time.monotonic(), ttl, jwks)
+
+
+def cached_jwks(auth0_domain):
+    entry = _jwks_cache.get(auth0_domain)
+    if entry is None:
+        return None
+
+    fetched_at, ttl, jwks = entry
+    if time.monotonic() - fetched_at > ttl:
+        return None
+    return jwks
+
+
+def jwks_age(auth0_domain):
+    entry = _jwks_cache.get(auth0_domain)
+    if entry is None:
+        return None
+    return time.monotonic() - entry[0]
+
+
+def fetch_jwks(auth0_domain, ttl, timeout=None):
+    jsonurl = urlopen(jwks_url(auth0_domain), timeout=timeout)
+    jwks = json.loads(jsonurl.read())
+    set_jwks(auth0_domain, jwks, ttl)
+    return jwks
+
+
+def get_jwks(auth0_domain, ttl, timeout=None):
+    jwks = cached_jwks(auth0_domain)
+    if jwks is None:
+        jwks = fetch_jwks(auth0_domain, ttl, timeout)
+    return jwks
+
+
+def find_rsa_key(jwks, kid):
+    for key in jwks['keys']:
+        if key['kid'] == kid:
+            return {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return {}
+
+
 '''
 @TODO implement verify_decode_jwt(token) method
     @INPUTS
@@ -117,33 +191,30 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    auth0_domain = current_app.config['AUTH0_DOMAIN']
+    ttl = current_app.config['JWKS_TTL']
+    jwks = get_jwks(auth0_domain, ttl)
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = find_rsa_key(jwks, unverified_header['kid'])
+    if not rsa_key and jwks_age(auth0_domain) > JWKS_MIN_REFRESH_INTERVAL:
+        # the signing keys may have been rotated
+        jwks = fetch_jwks(auth0_domain, ttl)
+        rsa_key = find_rsa_key(jwks, unverified_header['kid'])
+
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=list(current_app.config['ALGORITHMS']),
+                audience=current_app.config['API_AUDIENCE'],
+                issuer='https://' + auth0_domain + '/'
             )
 
             return payload
@@ -187,6 +258,53 @@ def verify_decode_jwt(token):
 '''
 
 
+'''
+check_rate_limit(permission, payload)
+    takes one request from the budget of the token subject for the
+    permission, see auth/ratelimit.py
+    it should raise an AuthError with a Retry-After header
+    if the budget is exhausted
+'''
+
+
+def check_rate_limit(permission, payload):
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        return
+
+    if not isinstance(permission, str):
+        permission = ','.join(permission)
+
+    retry_after = limiter.acquire(payload.get('sub', ''), permission)
+    if retry_after:
+        raise AuthError({
+            'code': 'rate_limited',
+            'description': 'Too many requests.'
+        }, 429, headers={'Retry-After': str(int(math.ceil(retry_after)))})
+
+
+'''
+has_permission(permission)
+    whether the request carries a valid token with the permission,
+    for optional behaviour of a request; it never raises, a token that
+    cannot be checked (e.g. the JWKS cannot be fetched) counts as without
+    the permission
+'''
+
+
+def has_permission(permission):
+    try:
+        payload = verify_decode_jwt(get_token_auth_header())
+        check_permissions(permission, payload)
+    except (AuthError, JWTError):
+        return False
+    except Exception:
+        logger.warning('Could not check the %s permission', permission,
+                       exc_info=True)
+        return False
+    return True
+
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
@@ -194,6 +312,9 @@ def requires_auth(permission=''):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
             check_permissions(permission, payload)
+            check_rate_limit(permission, payload)
+            # for what happens outside of the handler, like the audit log
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
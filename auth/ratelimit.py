@@ -0,0 +1,158 @@
+import time
+from collections import namedtuple
+
+from sqlalchemy import text
+
+
+'''
+Rate limiting
+    every (token sub, permission) pair gets a token bucket
+    budgets are configured per permission as "<requests>/<seconds>",
+    e.g. RATE_LIMITS="post:movies=30/60,post:actors=30/60"
+    permissions without a budget use RATE_LIMIT_DEFAULT, or are not limited
+'''
+
+
+class Budget(namedtuple('Budget', ['capacity', 'period'])):
+
+    @property
+    def rate(self):
+        return self.capacity / self.period
+
+
+def parse_budget(value):
+    capacity, _, period = value.partition('/')
+    return Budget(float(capacity), float(period or 1))
+
+
+'''
+MemoryBackend
+    in-process buckets, one per gunicorn worker
+    a bucket is an immutable (tokens, stamp) tuple replaced with a single
+    dict assignment, so no lock is taken on the request path; two racing
+    requests of the same key may both be admitted, which over-admits by at
+    most the number of request threads
+'''
+
+
+class MemoryBackend(object):
+
+    def __init__(self, max_keys=100000):
+        self.buckets = {}
+        self.max_keys = max_keys
+
+    def acquire(self, key, budget, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        tokens, stamp = self.buckets.get(key, (budget.capacity, now))
+        tokens = min(budget.capacity, tokens + (now - stamp) * budget.rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            retry_after = 0
+        else:
+            self.buckets[key] = (tokens, now)
+            retry_after = (1 - tokens) / budget.rate
+
+        if len(self.buckets) > self.max_keys:
+            self.prune(now)
+        return retry_after
+
+    def prune(self, now):
+        # drop the oldest half, their buckets are (nearly) full again
+        stale = sorted(self.buckets.items(), key=lambda item: item[1][1])
+        for key, _ in stale[:len(stale) // 2]:
+            self.buckets.pop(key, None)
+
+
+'''
+DatabaseBackend
+    buckets shared by all workers and hosts, stored in the rate_limits table
+    one UPSERT per request refills, takes a token and reports the result
+'''
+
+ACQUIRE_SQL = text('''
+INSERT INTO rate_limits (key, tokens, updated_at, admitted)
+VALUES (:key, :capacity - 1, :now, true)
+ON CONFLICT (key) DO UPDATE SET
+    tokens = CASE
+        WHEN rate_limits.tokens
+             + (:now - rate_limits.updated_at) * :rate >= :capacity
+            THEN :capacity - 1
+        WHEN rate_limits.tokens
+             + (:now - rate_limits.updated_at) * :rate >= 1
+            THEN rate_limits.tokens
+                 + (:now - rate_limits.updated_at) * :rate - 1
+        ELSE rate_limits.tokens + (:now - rate_limits.updated_at) * :rate
+    END,
+    admitted = rate_limits.tokens
+               + (:now - rate_limits.updated_at) * :rate >= 1,
+    updated_at = :now
+RETURNING tokens, admitted
+''')
+
+
+class DatabaseBackend(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def acquire(self, key, budget, now=None):
+        if now is None:
+            now = time.time()
+
+        with self.db.engine.begin() as connection:
+            tokens, admitted = connection.execute(ACQUIRE_SQL, {
+                'key': key,
+                'capacity': budget.capacity,
+                'rate': budget.rate,
+                'now': now,
+            }).fetchone()
+
+        if admitted:
+            return 0
+        return (1 - tokens) / budget.rate
+
+
+'''
+RateLimiter
+    looks up the budget of a permission and asks the backend for a token
+    acquire() returns 0 when the request is allowed, otherwise the number
+    of seconds until a token is available
+'''
+
+
+class RateLimiter(object):
+
+    def __init__(self, budgets, backend, default=None):
+        self.budgets = budgets
+        self.backend = backend
+        self.default = default
+
+    def acquire(self, subject, permission):
+        budget = self.budgets.get(permission, self.default)
+        if budget is None:
+            return 0
+        return self.backend.acquire(subject + ' ' + permission, budget)
+
+
+def init_rate_limiter(app, db):
+    budgets = {
+        permission: parse_budget(value)
+        for permission, value in app.config['RATE_LIMITS'].items()
+    }
+    default = app.config['RATE_LIMIT_DEFAULT']
+    if default:
+        default = parse_budget(default)
+
+    if not budgets and not default:
+        return None
+
+    if app.config['RATE_LIMIT_BACKEND'] == 'database':
+        backend = DatabaseBackend(db)
+    else:
+        backend = MemoryBackend()
+
+    limiter = RateLimiter(budgets, backend, default)
+    app.extensions['rate_limiter'] = limiter
+    return limiter
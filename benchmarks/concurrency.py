@@ -0,0 +1,121 @@
+'''
+Concurrency benchmark
+
+Holds many slow clients open against a running server, each one trickling
+its request headers a byte at a time, and meanwhile measures the latency of
+normal requests. Run it once against the sync gunicorn workers and once
+against the ASGI entry point:
+
+    gunicorn -c gunicorn.conf.py -b 127.0.0.1:8000 'flaskr:create_app()'
+    uvicorn --factory --port 8001 flaskr.asgi:create_asgi_app
+
+    python benchmarks/concurrency.py http://127.0.0.1:8000/movies \
+        --slow 1000 --token $TOKEN
+    python benchmarks/concurrency.py http://127.0.0.1:8001/movies \
+        --slow 1000 --token $TOKEN
+'''
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+def request_bytes(parts, token):
+    lines = [
+        'GET {} HTTP/1.1'.format(parts.path or '/'),
+        'Host: {}'.format(parts.netloc),
+        'Connection: close',
+    ]
+    if token:
+        lines.append('Authorization: Bearer {}'.format(token))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1')
+
+
+async def slow_client(parts, token, duration):
+    try:
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port)
+    except OSError:
+        return False
+
+    data = request_bytes(parts, token)
+    deadline = time.monotonic() + duration
+    try:
+        # keep the headers incomplete until the benchmark is over
+        for byte in data[:-2]:
+            if time.monotonic() > deadline:
+                break
+            writer.write(bytes([byte]))
+            await writer.drain()
+            await asyncio.sleep(1)
+    except OSError:
+        pass
+    finally:
+        writer.close()
+    return True
+
+
+async def probe(parts, token, timeout):
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, parts.port), timeout)
+        writer.write(request_bytes(parts, token))
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        await asyncio.wait_for(reader.read(), timeout)
+        writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None
+    if b' 200 ' not in status_line:
+        return None
+    return time.perf_counter() - start
+
+
+async def run(url, slow, probes, token, duration, timeout):
+    parts = urlsplit(url)
+    slow_clients = [asyncio.ensure_future(slow_client(parts, token, duration))
+                    for _ in range(slow)]
+    # give the slow clients time to occupy the server
+    await asyncio.sleep(2)
+
+    latencies = []
+    failures = 0
+    for _ in range(probes):
+        latency = await probe(parts, token, timeout)
+        if latency is None:
+            failures += 1
+        else:
+            latencies.append(latency)
+
+    for client in slow_clients:
+        client.cancel()
+    await asyncio.gather(*slow_clients, return_exceptions=True)
+
+    print('slow clients: {}, probes: {}, failed probes: {}'.format(
+        slow, probes, failures))
+    if latencies:
+        latencies.sort()
+        print('probe latency ms: p50 {:.1f}  p99 {:.1f}  max {:.1f}'.format(
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.99) - 1] * 1000,
+            latencies[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url')
+    parser.add_argument('--slow', type=int, default=1000)
+    parser.add_argument('--probes', type=int, default=100)
+    parser.add_argument('--token', default=None)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--timeout', type=float, default=5)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(run(
+        args.url, args.slow, args.probes, args.token,
+        args.duration, args.timeout))
+
+
+if __name__ == '__main__':
+    main()
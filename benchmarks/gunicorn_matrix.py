@@ -0,0 +1,190 @@
+'''
+Gunicorn configuration matrix
+
+Starts gunicorn with gunicorn.conf.py once per combination of worker class,
+worker processes and threads, waits for GET /ready, drives the same mix of
+read requests with a fixed number of keep-alive clients, and prints the
+throughput and latency of every combination. The defaults of
+gunicorn.conf.py are the fastest combination whose p99 stays under
+--max-p99 milliseconds.
+
+The app talks to the database of DATABASE_URL, as it would in production:
+
+    DATABASE_URL=postgres:///capstone python benchmarks/gunicorn_matrix.py \
+        --token $TOKEN --duration 20
+
+--app serves another app factory, e.g. one with a test authentication.
+'''
+import argparse
+import http.client
+import itertools
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import Pool
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PATHS = ('/movies?page=1&per_page=20', '/movies/2', '/actors?page=2',
+         '/actors/1/movies', '/movies?year=2012')
+
+
+def cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def combinations(args):
+    for workers in args.workers:
+        yield 'sync', workers, 1
+    for workers, threads in itertools.product(args.workers, args.threads):
+        yield 'gthread', workers, threads
+
+
+def start_server(app, port, worker_class, workers, threads):
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads))
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+         '-b', '127.0.0.1:{}'.format(port), '--log-level', 'warning', app],
+        cwd=ROOT, env=env)
+
+
+def wait_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                    timeout=2)
+            connection.request('GET', '/ready')
+            if connection.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def client(job):
+    # one client process: threads sending requests on keep-alive
+    # connections until the deadline, returns latencies, errors and
+    # reconnects (a kept-alive connection the server closed while the
+    # request was sent, retried on a new connection as a router would)
+    port, token, threads, deadline = job
+    headers = {'Authorization': 'Bearer ' + token} if token else {}
+    latencies, errors, reconnects = [], [], []
+
+    def loop(offset):
+        connection = http.client.HTTPConnection('127.0.0.1', port,
+                                                timeout=30)
+        paths = itertools.cycle(PATHS[offset % len(PATHS):] +
+                                PATHS[:offset % len(PATHS)])
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', next(paths), headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except http.client.RemoteDisconnected:
+                reconnects.append(1)
+                connection.close()
+                continue
+            except (OSError, http.client.HTTPException):
+                errors.append(1)
+                connection.close()
+                continue
+            if response.status != 200:
+                errors.append(1)
+            latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=loop, args=(offset,))
+               for offset in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, len(errors), len(reconnects)
+
+
+def measure(port, token, clients, processes, duration):
+    deadline = time.monotonic() + duration
+    per_process = max(1, clients // processes)
+    with Pool(processes) as pool:
+        results = pool.map(client, [(port, token, per_process, deadline)] *
+                           processes)
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    reconnects = sum(result[2] for result in results)
+    if not latencies:
+        return {'rps': 0, 'p50': None, 'p99': None, 'errors': errors,
+                'reconnects': reconnects}
+    return {
+        'rps': len(latencies) / duration,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'errors': errors,
+        'reconnects': reconnects
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--app', default='flaskr:create_app()')
+    parser.add_argument('--token', default=None)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[cores(), cores() * 2, cores() * 4])
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[2, 4, 8])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--client-processes', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--max-p99', type=float, default=250)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    rows = []
+    for worker_class, workers, threads in combinations(args):
+        server = start_server(args.app, args.port, worker_class, workers,
+                              threads)
+        try:
+            if not wait_ready(args.port):
+                print('{} {}x{} did not get ready'.format(
+                    worker_class, workers, threads))
+                continue
+            result = measure(args.port, args.token, args.clients,
+                             args.client_processes, args.duration)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        result.update(worker_class=worker_class, workers=workers,
+                      threads=threads)
+        rows.append(result)
+        if result['p99'] is None:
+            print('{worker_class} {workers}x{threads}: no responses, errors '
+                  '{errors}'.format(**result))
+            continue
+        print('{worker_class:<8} workers {workers:>2}  threads {threads:>2}  '
+              '{rps:8.1f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  '
+              'errors {errors}  reconnects {reconnects}'.format(**result),
+              flush=True)
+
+    eligible = [row for row in rows if not row['errors'] and
+                row['p99'] is not None and row['p99'] <= args.max_p99]
+    if eligible:
+        best = max(eligible, key=lambda row: row['rps'])
+        print('best: {worker_class}, {workers} workers ({cores} cores), '
+              '{threads} threads'.format(cores=cores(), **best))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
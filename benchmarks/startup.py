@@ -0,0 +1,52 @@
+'''
+Startup time benchmark
+
+Measures, in fresh interpreters, how long it takes to import the app
+package and to build the app with create_app().
+
+Usage: python benchmarks/startup.py [runs]
+'''
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPETS = {
+    'import flaskr': 'import flaskr',
+    'import + create_app()': 'import flaskr; flaskr.create_app()',
+}
+
+TIMER = '''
+import time
+start = time.perf_counter()
+{snippet}
+print(time.perf_counter() - start)
+'''
+
+
+def measure(snippet, runs):
+    timings = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', TIMER.format(snippet=snippet)],
+            cwd=ROOT)
+        timings.append(float(output.decode().strip().splitlines()[-1]))
+    return timings
+
+
+def main(runs=10):
+    print('{:<24}{:>12}{:>12}{:>12}'.format('step', 'median ms', 'min ms',
+                                            'max ms'))
+    for name, snippet in SNIPPETS.items():
+        timings = measure(snippet, runs)
+        print('{:<24}{:>12.1f}{:>12.1f}{:>12.1f}'.format(
+            name,
+            statistics.median(timings) * 1000,
+            min(timings) * 1000,
+            max(timings) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
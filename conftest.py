@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from flaskr import create_app
+from flaskr.settings import Settings
+from flaskr.sqlhooks import on_sql
+from models import db, Movie, Actor, castings
+
+
+'''
+assert_constant_queries(path, headers, sizes=(1, 10, 100))
+    requests GET <path> from SQLite catalogues of each size (movies with
+    two cast actors each) and asserts that it runs the same number of SQL
+    statements for all of them, so an N+1 query fails the test before it
+    reaches a large catalogue
+'''
+
+
+def seed_catalogue(size):
+    movies = Movie.__table__
+    actors = Actor.__table__
+    for number in range(1, size + 1):
+        movie_id = db.session.execute(movies.insert().values(
+            title='Movie {}'.format(number),
+            release_date=datetime.datetime(2000, 1, 1))
+        ).inserted_primary_key[0]
+        for role in range(2):
+            actor_id = db.session.execute(actors.insert().values(
+                name='Actor {}.{}'.format(number, role), age=30,
+                gender='F', movie_id=movie_id)).inserted_primary_key[0]
+            db.session.execute(castings.insert().values(
+                movie_id=movie_id, actor_id=actor_id))
+    db.session.commit()
+
+
+@pytest.fixture
+def assert_constant_queries(tmp_path):
+    def check(path, headers, sizes=(1, 10, 100)):
+        counts = {}
+        for size in sizes:
+            settings = Settings.from_env()
+            settings.database_url = 'sqlite:///{}/catalogue-{}.db'.format(
+                tmp_path, size)
+            app = create_app(settings)
+            statements = []
+            on_sql(app, lambda statement, parameters, seconds:
+                   statements.append(statement))
+            with app.app_context():
+                db.create_all()
+                seed_catalogue(size)
+            del statements[:]
+
+            response = app.test_client().get(path, headers=headers)
+            assert response.status_code == 200, response.data
+            counts[size] = len(statements)
+            with app.app_context():
+                db.session.remove()
+                db.get_engine(app).dispose()
+
+        assert len(set(counts.values())) == 1, \
+            'GET {} runs a number of SQL statements that grows with the ' \
+            'catalogue: {}'.format(path, counts)
+        return counts
+    return check
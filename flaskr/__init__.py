@@ -1,37 +1,76 @@
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, send_file, url_for
+from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
-from flask_cors import CORS
-from models import setup_db, Movie, Actor
-
-from auth.auth import AuthError, requires_auth
+from flask_migrate import Migrate
+from models import setup_db, db, Movie, Actor, castings, add_casting, \
+    remove_casting, commit_write, VersionConflict
+
+from auth.auth import AuthError, check_permissions, requires_auth
+from auth.ratelimit import init_rate_limiter
+from .audit import audit_page, init_audit
+from .budgets import query_budget
+from .changes import changes_response, init_changes
+from .coalesce import coalesced, init_coalescing
+from .cors import init_cors
+from .documents import documents_response, init_documents, movie_page
+from .idempotency import idempotent, init_idempotency
+from .imports import import_rows
+from .jobs import enqueue_delete, enqueue_export, enqueue_import, \
+    export_path, get_job, job_accepted, job_dict, remove_file, wants_async
+from .listing import actor_criteria, count_rows, movie_criteria, paged, \
+    with_total
+from .metrics import init_metrics
+from .notifications import init_notifications
+from .profiling import init_profiling
+from .preconditions import if_match_versions, tagged
+from .schemas import ACTOR, MOVIE, init_schemas, validated
+from .settings import Settings
+from .slowlog import init_slow_query_log
+from .snapshot import init_read_model, read_snapshot
+from .stats import read_stats
+from .warmup import init_warmup
 
 from datetime import datetime
 
+JOB_PERMISSIONS = ('post:movies', 'post:actors', 'view:movies',
+                   'view:actors', 'delete:movies', 'delete:actors')
+
 
-def create_app(test_config=None):
+def create_app(settings=None):
     # create and configure the app
     app = Flask(__name__)
+    if settings is None:
+        settings = Settings.from_env()
+    settings.apply(app)
     setup_db(app)
-
-    CORS(app)
-
-    # CORS Headers
-    @app.after_request
-    def after_request(response):
-        response.headers.add(
-            'Access-Control-Allow-Headers',
-            'Content-Type,Authorization,true')
-        response.headers.add(
-            'Access-Control-Allow-Methods',
-            'GET,PUT,POST,DELETE,OPTIONS')
-        return response
+    # `flask db` with FLASK_APP=flaskr, `python manage.py db` otherwise
+    Migrate(app, db)
+    init_metrics(app)
+    init_audit(app)
+    init_rate_limiter(app, db)
+    init_idempotency(app)
+    bus = init_notifications(app)
+    init_changes(app, bus)
+    init_schemas(app, bus)
+    init_read_model(app, bus)
+    init_documents(app)
+    init_warmup(app)
+    init_coalescing(app)
+    init_slow_query_log(app)
+
+    init_profiling(app)
+    init_cors(app)
 
     '''
     GET /movies
-    Get all movies
+    Get all movies, or a page of them with ?page=<n>&per_page=<n>
+    Filters: ?title=<part of the title>&year=<release year>
+    X-Total-Count is the number of matching movies, X-Total-Count-Type
+    tells whether it is exact or an estimate of the database (only for
+    more than COUNT_EXACT_THRESHOLD matches)
 
-    Example Request: curl 'http://localhost:5000/movies'
+    Example Request: curl 'http://localhost:5000/movies?page=1&per_page=10'
 
     Expected Result:
     {
@@ -71,19 +110,32 @@ def create_app(test_config=None):
     '''
     @app.route('/movies', methods=['GET'])
     @requires_auth('view:movies')
+    @coalesced
+    @query_budget(4)
     def retrieve_movies(payload):
-        movies = Movie.query.all()
-        movies = list(map(lambda movie: movie.format(), movies))
-        return jsonify({
-            "success": True,
-            "movies": movies
-        })
+        snapshot = read_snapshot()
+        if snapshot is not None:
+            movies, count = snapshot.list_movies(request.args)
+            return with_total(jsonify({
+                "success": True,
+                "movies": movies
+            }), count)
+
+        criteria = movie_criteria(request.args)
+        # the stored JSON of the movies and their casts, see
+        # flaskr/documents.py
+        documents = movie_page(criteria, request.args)
+        return with_total(documents_response("movies", documents),
+                          count_rows(Movie.__table__, criteria,
+                                     app.config['COUNT_EXACT_THRESHOLD']))
 
     '''
     GET /actors
-    Get all actors
+    Get all actors, or a page of them, like GET /movies
+    Filters: ?name=<part of the name>&gender=<gender>
+             &min_age=<age>&max_age=<age>
 
-    Example Request: curl 'http://localhost:5000/actors'
+    Example Request: curl 'http://localhost:5000/actors?gender=F&page=2'
 
     Expected Result:
     {
@@ -115,14 +167,209 @@ def create_app(test_config=None):
     '''
     @app.route('/actors', methods=['GET'])
     @requires_auth('view:actors')
+    @coalesced
+    @query_budget(4)
     def retrieve_actors(payload):
-        actors = Actor.query.all()
-        actors = list(map(lambda actor: actor.format(), actors))
+        snapshot = read_snapshot()
+        if snapshot is not None:
+            actors, count = snapshot.list_actors(request.args)
+        else:
+            criteria = actor_criteria(request.args)
+            actors = paged(Actor.query.filter(*criteria).order_by(Actor.id),
+                           request.args).all()
+            actors = list(map(lambda actor: actor.format(), actors))
+            count = count_rows(Actor.__table__, criteria,
+                               app.config['COUNT_EXACT_THRESHOLD'])
+        return with_total(jsonify({
+            "success": True,
+            "actors": actors
+        }), count)
+
+    '''
+    GET /movies/<int:movie_id>
+    Get the movie with given id
+
+    Example Request: curl 'http://localhost:5000/movies/2'
+
+    Example Response:
+    {
+        "movie": {
+            "actors": [...],
+            "id": 2,
+            "release_date": "Fri, 04 May 2012 00:00:00 GMT",
+            "title": "Yahşi Batı"
+        },
+        "success": true
+    }
+    '''
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('view:movies')
+    @coalesced
+    @query_budget(2)
+    def retrieve_movie(payload, movie_id):
+        snapshot = read_snapshot()
+        if snapshot is not None:
+            movie = snapshot.movie(movie_id)
+        else:
+            movie = Movie.query.get(movie_id)
+            movie = None if movie is None else movie.format()
+
+        if movie is None:
+            abort(404, "No movie with given id " + str(movie_id) + " is found")
+
+        return tagged(jsonify({
+            "success": True,
+            "movie": movie
+        }), movie)
+
+    '''
+    GET /actors/<int:actor_id>
+    Get the actor with given id
+
+    Example Request: curl 'http://localhost:5000/actors/1'
+
+    Example Response:
+    {
+        "actor": {
+            "age": 54,
+            "gender": "M",
+            "id": 1,
+            "movie_id": 2,
+            "name": "Tom Hanks"
+        },
+        "success": true
+    }
+    '''
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('view:actors')
+    @coalesced
+    @query_budget(1)
+    def retrieve_actor(payload, actor_id):
+        snapshot = read_snapshot()
+        if snapshot is not None:
+            actor = snapshot.actor(actor_id)
+        else:
+            actor = Actor.query.get(actor_id)
+            actor = None if actor is None else actor.format()
+
+        if actor is None:
+            abort(404, "No actor with given id " + str(actor_id) + " is found")
+
+        return tagged(jsonify({
+            "success": True,
+            "actor": actor
+        }), actor)
+
+    '''
+    GET /movies/<int:movie_id>/actors
+    Get the cast of the movie with given id, with the role of each actor
+
+    Example Request: curl 'http://localhost:5000/movies/3/actors'
+
+    Example Response:
+    {
+        "actors": [
+            {
+                "age": 44,
+                "gender": "M",
+                "id": 2,
+                "movie_id": 3,
+                "name": "Brad Pitt",
+                "role": null
+            },
+            ...
+        ],
+        "success": true
+    }
+    '''
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('view:actors')
+    @coalesced
+    @query_budget(1)
+    def retrieve_movie_actors(payload, movie_id):
+        snapshot = read_snapshot()
+        if snapshot is not None:
+            actors = snapshot.movie_cast(movie_id)
+        else:
+            actors = Movie.cast_by_id(movie_id)
+
+        if actors is None:
+            abort(404, "No movie with given id " + str(movie_id) + " is found")
+
         return jsonify({
             "success": True,
             "actors": actors
         })
 
+    '''
+    GET /actors/<int:actor_id>/movies
+    Get the movies the actor with given id is cast in, with the roles
+
+    Example Request: curl 'http://localhost:5000/actors/1/movies'
+
+    Example Response:
+    {
+        "movies": [
+            {
+                "id": 2,
+                "release_date": "Fri, 04 May 2012 00:00:00 GMT",
+                "role": null,
+                "title": "Yahşi Batı"
+            }
+        ],
+        "success": true
+    }
+    '''
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('view:movies')
+    @coalesced
+    @query_budget(1)
+    def retrieve_actor_movies(payload, actor_id):
+        snapshot = read_snapshot()
+        if snapshot is not None:
+            movies = snapshot.actor_movies(actor_id)
+        else:
+            movies = Actor.movies_by_id(actor_id)
+
+        if movies is None:
+            abort(404, "No actor with given id " + str(actor_id) + " is found")
+
+        return jsonify({
+            "success": True,
+            "movies": movies
+        })
+
+    '''
+    GET /stats
+    Get counts and distributions of the catalogue
+    Requires both view:movies and view:actors permissions
+
+    Example Request: curl 'http://localhost:5000/stats'
+
+    Example Response:
+    {
+        "stats": {
+            "actors": 6,
+            "actors_by_age": {"30-39": 1, "40-49": 4, "50-59": 1},
+            "actors_by_gender": {"F": 2, "M": 4},
+            "actors_per_movie": 1.2,
+            "movies": 5,
+            "releases_per_year": {"2010": 1, "2012": 1, ...}
+        },
+        "success": true
+    }
+    '''
+    @app.route('/stats', methods=['GET'])
+    @requires_auth('view:movies')
+    @coalesced
+    @query_budget(1)
+    def retrieve_stats(payload):
+        check_permissions('view:actors', payload)
+        return jsonify({
+            "success": True,
+            "stats": read_stats()
+        })
+
     '''
     POST /movies
     Creates a new movie.
@@ -136,33 +383,30 @@ def create_app(test_config=None):
             "release_date": "2020-02-19"
         }'
 
-    Example Response:
+    Example Response: (with a Location header of the new movie)
     {
+        "movie": {
+            "actors": [],
+            "id": 6,
+            "release_date": "Wed, 19 Feb 2020 00:00:00 GMT",
+            "title": "Pek Yakında"
+        },
         "success": true
     }
     '''
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def create_movie(payload):
-        body = request.get_json()
-
-        if body is None:
-            abort(400)
+        movie = Movie.create(**validated(MOVIE))
 
-        title = body.get('title', None)
-        release_date = body.get('release_date', None)
-
-        if title is None or release_date is None:
-            abort(400, "Missing field for Movie")
-
-        movie = Movie(title=title,
-                      release_date=release_date)
-
-        movie.insert()
-
-        return jsonify({
-            "success": True
+        response = jsonify({
+            "success": True,
+            "movie": movie
         })
+        response.headers['Location'] = url_for(
+            'retrieve_movie', movie_id=movie['id'])
+        return tagged(response, movie)
 
         '''
     POST /actors
@@ -178,35 +422,288 @@ def create_app(test_config=None):
             "gender": "M"
         }'
 
-    Example Response:
+    Example Response: (with a Location header of the new actor)
     {
+        "actor": {
+            "age": 45,
+            "gender": "M",
+            "id": 7,
+            "movie_id": 1,
+            "name": "Cem Yılmaz"
+        },
         "success": true
     }
     '''
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def create_actor(payload):
+        values = validated(ACTOR)
+
+        try:
+            actor = Actor.create(**values)
+        except IntegrityError:
+            # the movie was deleted since it was checked
+            db.session.rollback()
+            abort(
+                400,
+                "Bad formatted request due to nonexistent movie id" +
+                str(values['movie_id']))
+
+        response = jsonify({
+            "success": True,
+            "actor": actor
+        })
+        response.headers['Location'] = url_for(
+            'retrieve_actor', actor_id=actor['id'])
+        return tagged(response, actor)
+
+    '''
+    POST /movies/<int:movie_id>/actors
+    Casts an existing actor in the movie with given id
+    Requires the actor id, the role is optional
+    Responds with a 404 error if the movie or the actor is not found,
+    and with a 409 error if the actor is already cast in the movie
+
+    Example Request:
+    curl --location --request POST 'http://localhost:5000/movies/3/actors' \
+        --header 'Content-Type: application/json' \
+        --data-raw '{
+            "actor_id": 1,
+            "role": "Mission Commander"
+        }'
+
+    Example Response:
+    {
+        "casting": {
+            "actor_id": 1,
+            "movie_id": 3,
+            "role": "Mission Commander"
+        },
+        "success": true
+    }
+    '''
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+    @requires_auth('update:movies')
+    @idempotent
+    def create_casting(payload, movie_id):
         body = request.get_json()
 
-        if body is None:
-            abort(400)
+        if body is None or body.get('actor_id') is None:
+            abort(400, "Missing field for Casting")
+
+        actor_id = body['actor_id']
+        casting = add_casting(movie_id, actor_id, body.get('role'))
+        if casting is None:
+            db.session.rollback()
+            if Movie.query.get(movie_id) is None:
+                abort(404, "No movie with given id " + str(movie_id) +
+                      " is found")
+            if Actor.query.get(actor_id) is None:
+                abort(404, "No actor with given id " + str(actor_id) +
+                      " is found")
+            abort(409, "Actor " + str(actor_id) +
+                  " is already cast in movie " + str(movie_id))
+
+        commit_write(('insert', castings.name, casting))
+        return jsonify({
+            "success": True,
+            "casting": casting
+        })
+
+    '''
+    DELETE /movies/<int:movie_id>/actors/<int:actor_id>
+    Removes the actor from the cast of the movie
+
+    Example Request:
+    curl --request DELETE 'http://localhost:5000/movies/3/actors/1'
+
+    Example Response:
+    {
+        "deleted": {
+            "actor_id": 1,
+            "movie_id": 3
+        },
+        "success": true
+    }
+    '''
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth('update:movies')
+    def delete_casting(payload, movie_id, actor_id):
+        if not remove_casting(movie_id, actor_id):
+            db.session.rollback()
+            abort(404, "Actor " + str(actor_id) +
+                  " is not cast in movie " + str(movie_id))
+
+        casting = {'movie_id': movie_id, 'actor_id': actor_id}
+        commit_write(('delete', castings.name, casting))
+        return jsonify({
+            "success": True,
+            "deleted": casting
+        })
+
+    '''
+    POST /import/movies
+    POST /import/actors
+    Creates movies or actors from an NDJSON (application/x-ndjson) or a CSV
+    (text/csv, with a header line) body, with the fields of POST /movies
+    and POST /actors; the body is read as a stream and written in batches,
+    so a failed row does not stop the import
+    Requires post:movies or post:actors permission
+
+    Example Request:
+    curl --request POST 'http://localhost:5000/import/actors' \
+        --header 'Content-Type: text/csv' \
+        --data-binary @actors.csv
+
+    Example Response:
+    {
+        "errors": [
+            {"error": "No movie with id 42", "row": 17}
+        ],
+        "errors_truncated": false,
+        "failed": 1,
+        "imported": 9999,
+        "success": true
+    }
+    '''
+    @app.route('/import/movies', methods=['POST'])
+    @requires_auth('post:movies')
+    def import_movies(payload):
+        if wants_async():
+            return job_accepted(
+                enqueue_import('movies', payload.get('sub', '')))
+        report = import_rows('movies', app.config)
+        return jsonify(dict(report, success=True))
+
+    @app.route('/import/actors', methods=['POST'])
+    @requires_auth('post:actors')
+    def import_actors(payload):
+        if wants_async():
+            return job_accepted(
+                enqueue_import('actors', payload.get('sub', '')))
+        report = import_rows('actors', app.config)
+        return jsonify(dict(report, success=True))
+
+    '''
+    POST /export/movies
+    POST /export/actors
+    Starts a background export of all movies or actors as NDJSON, in the
+    format POST /import/movies and POST /import/actors accept
+    Requires view:movies or view:actors permission
+
+    Example Request: curl --request POST 'http://localhost:5000/export/movies'
+
+    Example Response: (202, with a Location header of the job)
+    {
+        "job": {
+            "created_at": 1760868000.0,
+            "error": null,
+            "id": 12,
+            "kind": "export",
+            "progress": 0,
+            "result": null,
+            "status": "queued",
+            "total": null,
+            "updated_at": 1760868000.0
+        },
+        "success": true
+    }
+    '''
+    @app.route('/export/movies', methods=['POST'])
+    @requires_auth('view:movies')
+    def export_movies(payload):
+        return job_accepted(enqueue_export('movies', payload.get('sub', '')))
 
-        name = body.get('name', None)
-        age = body.get('age', None)
-        gender = body.get('gender', None)
-        movie_id = body.get('movie_id', None)
+    @app.route('/export/actors', methods=['POST'])
+    @requires_auth('view:actors')
+    def export_actors(payload):
+        return job_accepted(enqueue_export('actors', payload.get('sub', '')))
 
-        if name is None or age is None or gender is None or movie_id is None:
-            abort(400, "Missing field for Actor")
+    '''
+    POST /delete/movies
+    POST /delete/actors
+    Starts a background delete of the movies or actors with the given ids
+    Requires delete:movies or delete:actors permission
 
-        actor = Actor(name=name, age=age, gender=gender, movie_id=movie_id)
+    Example Request:
+    curl --request POST 'http://localhost:5000/delete/actors' \
+        --header 'Content-Type: application/json' \
+        --data-raw '{"ids": [4, 5, 6]}'
+
+    Example Response: (202, like POST /export/movies)
+    '''
+    @app.route('/delete/movies', methods=['POST'])
+    @requires_auth('delete:movies')
+    def bulk_delete_movies(payload):
+        return job_accepted(enqueue_delete('movies', payload.get('sub', '')))
+
+    @app.route('/delete/actors', methods=['POST'])
+    @requires_auth('delete:actors')
+    def bulk_delete_actors(payload):
+        return job_accepted(enqueue_delete('actors', payload.get('sub', '')))
+
+    '''
+    GET /jobs/<int:job_id>
+    Get the status of a background job started by the same user
+    status is queued, running, succeeded or failed; progress counts the
+    processed rows out of total (when known), result holds the report
 
-        actor.insert()
+    Example Request: curl 'http://localhost:5000/jobs/12'
+
+    Example Response:
+    {
+        "job": {
+            "id": 12,
+            "kind": "export",
+            "progress": 5,
+            "result": {"rows": 5},
+            "status": "succeeded",
+            "total": 5,
+            ...
+        },
+        "success": true
+    }
+    '''
+    @app.route('/jobs/<int:job_id>', methods=['GET'])
+    @requires_auth(JOB_PERMISSIONS)
+    def retrieve_job(payload, job_id):
+        job = get_job(job_id, payload.get('sub', ''))
+
+        if job is None:
+            abort(404, "No job with given id " + str(job_id) + " is found")
 
         return jsonify({
-            "success": True
+            "success": True,
+            "job": job_dict(job)
         })
 
+    '''
+    GET /jobs/<int:job_id>/result
+    Download the NDJSON file of a succeeded export job, once: the file is
+    removed as it is sent
+
+    Example Request: curl 'http://localhost:5000/jobs/12/result'
+    '''
+    @app.route('/jobs/<int:job_id>/result', methods=['GET'])
+    @requires_auth(JOB_PERMISSIONS)
+    def retrieve_job_result(payload, job_id):
+        job = get_job(job_id, payload.get('sub', ''))
+        path = None if job is None else export_path(job)
+
+        if path is None:
+            abort(404, "No export with given id " + str(job_id) +
+                  " is found")
+
+        response = send_file(path, mimetype='application/x-ndjson',
+                             as_attachment=True,
+                             attachment_filename='export-{}.ndjson'.format(
+                                 job_id))
+        # send_file has opened the file, it is still sent once unlinked
+        remove_file(path)
+        return response
+
     '''
     DELETE /movies/<int:movie_id>
     Deletes the movie with given id
@@ -222,13 +719,9 @@ def create_app(test_config=None):
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-
-        if movie is None:
+        if not Movie.delete_by_id(movie_id):
             abort(404, "No movie with given id " + str(movie_id) + " is found")
 
-        movie.delete()
-
         return jsonify({
             'success': True,
             'deleted': movie_id
@@ -249,13 +742,9 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-
-        if actor is None:
+        if not Actor.delete_by_id(actor_id):
             abort(404, "No actor with given id " + str(actor_id) + " is found")
 
-        actor.delete()
-
         return jsonify({
             'success': True,
             'deleted': actor_id
@@ -266,6 +755,9 @@ def create_app(test_config=None):
         Updates the movie where <movie_id> is the existing movie id
         Responds with a 404 error if <movie_id> is not found
         Update the corresponding fields for Movie with id <movie_id>
+        With an If-Match header of the ETag of GET /movies/<movie_id>, the
+        update is only applied if the movie was not changed since, else
+        it responds with a 412 error
 
     Example Request:
     curl --location --request PATCH 'http://localhost:5000/movies/1' \
@@ -274,21 +766,29 @@ def create_app(test_config=None):
             "title": "Eyvah eyvah 2"
         }'
 
-    Example Response:
+    Example Response: (with the new ETag, e.g. "2")
     {
         "success": true,
         "updated": {
             "id": 1,
             "release_date": "Wed, 04 May 2016 00:00:00 GMT",
-            "title": "Eyvah eyvah 2"
+            "title": "Eyvah eyvah 2",
+            "version": 2
         }
     }
     '''
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('update:movies')
     def update_movie(payload, movie_id):
+        values = validated(MOVIE, partial=True)
 
-        updated_movie = Movie.query.get(movie_id)
+        try:
+            updated_movie = Movie.update_by_id(
+                movie_id, versions=if_match_versions(), **values)
+        except VersionConflict:
+            db.session.rollback()
+            abort(412, 'Movie with id: ' + str(movie_id) +
+                  ' was changed, its ETag does not match If-Match.')
 
         if not updated_movie:
             abort(
@@ -297,28 +797,17 @@ def create_app(test_config=None):
                 str(movie_id) +
                 ' could not be found.')
 
-        body = request.get_json()
-
-        title = body.get('title', None)
-        release_date = body.get('release_date', None)
-
-        if title:
-            updated_movie.title = title
-        if release_date:
-            updated_movie.release_date = release_date
-
-        updated_movie.update()
-
-        return jsonify({
+        return tagged(jsonify({
             "success": True,
-            "updated": updated_movie.format()
-        })
+            "updated": updated_movie
+        }), updated_movie)
 
     '''
     PATCH /actors/<actor_id>
         Updates the actor where <actor_id> is the existing actor id
         Responds with a 404 error if <actor_id> is not found
         Update the given fields for Actor with id <actor_id>
+        Takes an If-Match header like PATCH /movies/<movie_id>
 
     Example Request:
     curl --location --request PATCH 'http://localhost:5000/actors/1' \
@@ -341,8 +830,22 @@ def create_app(test_config=None):
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('update:actors')
     def update_actor(payload, actor_id):
+        values = validated(ACTOR, partial=True)
 
-        updated_actor = Actor.query.get(actor_id)
+        try:
+            updated_actor = Actor.update_by_id(
+                actor_id, versions=if_match_versions(), **values)
+        except IntegrityError:
+            # the movie was deleted since it was checked
+            db.session.rollback()
+            abort(
+                400,
+                "Bad formatted request due to nonexistent movie id" +
+                str(values.get('movie_id')))
+        except VersionConflict:
+            db.session.rollback()
+            abort(412, 'Actor with id: ' + str(actor_id) +
+                  ' was changed, its ETag does not match If-Match.')
 
         if not updated_actor:
             abort(
@@ -351,35 +854,209 @@ def create_app(test_config=None):
                 str(actor_id) +
                 ' could not be found.')
 
-        body = request.get_json()
+        return tagged(jsonify({
+            "success": True,
+            "updated": updated_actor
+        }), updated_actor)
 
-        name = body.get('name', None)
-        age = body.get('age', None)
-        gender = body.get('gender', None)
-        movie_id = body.get('movie_id', None)
+    '''
+    GET /changes
+    Server-Sent Events stream of the inserts, updates and deletes of
+    movies and actors, for clients that would otherwise poll the lists
+    Requires view:movies or view:actors, only the changes of the
+    permitted tables are sent
+    A reconnecting client sends the Last-Event-ID header and gets the
+    changes it missed, or a "reset" event when they are too old or the
+    id comes from another worker
 
-        if name:
-            updated_actor.name = name
-        if age:
-            updated_actor.age = age
-        if gender:
-            updated_actor.gender = gender
-        if movie_id:
-            updated_actor.movie_id = movie_id
+    Example Request: curl -N 'http://localhost:5000/changes'
 
-        try:
-            updated_actor.update()
-        except BaseException:
-            abort(
-                400,
-                "Bad formatted request due to nonexistent movie id" +
-                str(movie_id))
+    Example Response:
+    id: 5f0c2a9e8d1b4c7e9a3f6b2d1c0e8f7a:12
+    event: actors.update
+    data: {"action": "update", "record": {"age": 54, ...}, "table": "actors"}
+
+    '''
+    @app.route('/changes', methods=['GET'])
+    @requires_auth(('view:movies', 'view:actors'))
+    def retrieve_changes(payload):
+        tables = set()
+        if 'view:movies' in payload['permissions']:
+            tables.add('movies')
+        if 'view:actors' in payload['permissions']:
+            tables.add('actors')
+        if tables == {'movies', 'actors'}:
+            tables.add('castings')
+
+        last_event_id = request.headers.get(
+            'Last-Event-ID', request.args.get('last_event_id'))
+        return changes_response(app.extensions['changes'], last_event_id,
+                                tables, app.config['CHANGES_HEARTBEAT'])
+
+    '''
+    GET /metrics
+    Counters and gauges of the worker that serves the request
+
+    Example Request: curl 'http://localhost:5000/metrics'
+
+    Example Response:
+    {
+        "metrics": {
+            "coalescing.coalesced": 112,
+            "coalescing.executed": 530
+        },
+        "success": true
+    }
+    '''
+    @app.route('/metrics', methods=['GET'])
+    @requires_auth('view:metrics')
+    def retrieve_metrics(payload):
+        return jsonify({
+            "success": True,
+            "metrics": app.extensions['metrics'].snapshot()
+        })
+
+    '''
+    GET /audit
+    Who wrote what, newest first, see flaskr/audit.py
+    Filters: ?actor=<JWT sub>&table=<table>&record_id=<id>&action=<action>
+    Pages: ?limit=<n> (default 50, at most 500) events with an id below
+    ?before=<id>; next_before is the cursor of the next page, null after
+    the last one
+    Events are written in batches, up to AUDIT_FLUSH_INTERVAL seconds
+    after their write
+
+    Example Request: curl 'http://localhost:5000/audit?table=movies&limit=1'
+
+    Example Response:
+    {
+        "events": [
+            {
+            "action": "update",
+            "actor": "auth0|5ed0dcc13c85420bf791cbb8",
+            "at": 1590794569.215,
+            "id": 42,
+            "record": {
+                "id": 2,
+                "release_date": "2012-05-04 00:00:00",
+                "title": "Yahşi Batı",
+                "version": 3
+            },
+            "record_id": 2,
+            "table": "movies"
+            }
+        ],
+        "next_before": 42,
+        "success": true
+    }
+    '''
+    @app.route('/audit', methods=['GET'])
+    @requires_auth('view:audit')
+    def retrieve_audit(payload):
+        events, next_before = audit_page(request.args)
+        return jsonify({
+            "success": True,
+            "events": events,
+            "next_before": next_before
+        })
+
+    '''
+    GET /ready
+    Readiness of the worker that serves the request for a load balancer:
+    503 while it warms up, 200 once it is done or WARMUP_BUDGET seconds
+    have passed, see flaskr/warmup.py
+    Requires no authentication
+
+    Example Request: curl 'http://localhost:5000/ready'
+
+    Example Response:
+    {
+        "ready": true,
+        "seconds": 0.412,
+        "steps": {
+            "database_pool": "done in 0.051s, pool size 5",
+            "jwks": "done in 0.304s",
+            "queries": "done in 0.038s",
+            "state": "done in 0.012s"
+        },
+        "success": true,
+        "warmed_up": true
+    }
+    '''
+    @app.route('/ready', methods=['GET'])
+    def ready():
+        status = app.extensions['warmup'].status()
+        response = jsonify(dict(status, success=status['ready']))
+        response.status_code = 200 if status['ready'] else 503
+        return response
+
+    '''
+    GET /profiles
+    The stored request profiles, newest first, see flaskr/profiling.py
+
+    Example Request: curl 'http://localhost:5000/profiles'
+
+    Example Response:
+    {
+        "profiles": [
+            {
+            "endpoint": "retrieve_movies",
+            "id": "01792384005331118000-9f1c2b3a",
+            "method": "GET",
+            "path": "/movies?page=1",
+            "seconds": 0.0412,
+            "sql": {
+                "seconds": 0.0311,
+                "slowest": [...],
+                "statements": 2
+            },
+            "started_at": 1792384005.33,
+            "status": 200,
+            "trigger": "header"
+            }
+        ],
+        "success": true
+    }
+    '''
+    @app.route('/profiles', methods=['GET'])
+    @requires_auth('view:profiles')
+    def retrieve_profiles(payload):
+        return jsonify({
+            "success": True,
+            "profiles": app.extensions['profiles'].list()
+        })
+
+    '''
+    GET /profiles/<profile_id>
+    One profile with the functions of the highest cumulative time
+    GET /profiles/<profile_id>/stats
+    Downloads its cProfile stats, e.g. for `python -m pstats` or snakeviz
+    '''
+    @app.route('/profiles/<profile_id>', methods=['GET'])
+    @requires_auth('view:profiles')
+    def retrieve_profile(payload, profile_id):
+        store = app.extensions['profiles']
+        profile = store.load(profile_id)
+        if profile is None:
+            abort(404, "No profile with given id " + profile_id + " is found")
+        profile['functions'] = store.functions(profile_id)
 
         return jsonify({
             "success": True,
-            "updated": updated_actor.format()
+            "profile": profile
         })
 
+    @app.route('/profiles/<profile_id>/stats', methods=['GET'])
+    @requires_auth('view:profiles')
+    def download_profile(payload, profile_id):
+        path = app.extensions['profiles'].stats_path(profile_id)
+        if path is None:
+            abort(404, "No profile with given id " + profile_id + " is found")
+
+        return send_file(path, mimetype='application/octet-stream',
+                         as_attachment=True,
+                         attachment_filename=profile_id + '.prof')
+
     def get_error_message(error, default_message):
         try:
             return error.description
@@ -404,6 +1081,22 @@ def create_app(test_config=None):
             "message": get_error_message(error, "resource not found")
         }), 404
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            "error": 409,
+            "message": get_error_message(error, "conflict")
+        }), 409
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": get_error_message(error, "precondition failed")
+        }), 412
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
@@ -418,12 +1111,10 @@ def create_app(test_config=None):
             "success": False,
             "error": auth_error.status_code,
             "message": auth_error.error['description']
-        }), auth_error.status_code
+        }), auth_error.status_code, auth_error.headers
 
     return app
 
 
-APP = create_app()
-
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
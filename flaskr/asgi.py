@@ -0,0 +1,292 @@
+'''
+ASGI entry point
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+
+Serves the same routes as create_app(). Connections, request bodies and
+response bodies are handled on the event loop, so a slow client only costs
+a coroutine. The Flask handlers, and the database round trips they make,
+run on a bounded thread pool (ASGI_THREADS) and only hold a thread while
+they are actually running. The body of an event stream (GET /changes) is
+pulled by a thread for as long as the stream stays open, so after their
+first chunk streams move to a pool of their own (ASGI_STREAM_THREADS):
+that many subscribers at most are served at once, the next ones wait for
+a thread, and none of them take a thread from the other requests. The
+Auth0 signing keys are fetched with non-blocking I/O and kept in the auth
+JWKS cache, so no handler thread ever waits on the JWKS urlopen call.
+'''
+import asyncio
+import io
+import json
+import ssl
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from auth.auth import cached_jwks, jwks_url, set_jwks
+from . import create_app
+
+
+_END = object()
+
+
+'''
+fetch_json(url)
+    GET an https url with asyncio streams and decode the JSON body
+'''
+
+
+async def fetch_json(url, timeout=10):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parts.hostname, parts.port or 443,
+                                ssl=ssl.create_default_context()),
+        timeout)
+    try:
+        writer.write((
+            'GET {} HTTP/1.1\r\n'
+            'Host: {}\r\n'
+            'Accept: application/json\r\n'
+            'Connection: close\r\n\r\n'
+        ).format(parts.path or '/', parts.hostname).encode('latin1'))
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin1').split('\r\n')
+    if status_line.split()[1] != '200':
+        raise IOError('Unexpected response from {}: {}'.format(
+            url, status_line))
+
+    headers = dict(line.lower().split(':', 1) for line in header_lines)
+    if headers.get('transfer-encoding', '').strip() == 'chunked':
+        body = decode_chunked(body)
+    return json.loads(body)
+
+
+def decode_chunked(body):
+    decoded = b''
+    while body:
+        size_line, _, body = body.partition(b'\r\n')
+        size = int(size_line.split(b';')[0], 16)
+        if size == 0:
+            break
+        decoded += body[:size]
+        body = body[size + 2:]
+    return decoded
+
+
+'''
+RequestBody
+    file-like wsgi.input
+    bodies up to ASGI_BUFFER_BYTES are read on the event loop before the
+    handler starts, larger ones are pulled from the client on demand by the
+    handler thread
+'''
+
+
+class RequestBody(io.RawIOBase):
+
+    def __init__(self, buffered, more_body, receive, loop):
+        self.buffer = buffered
+        self.more_body = more_body
+        self.receive = receive
+        self.loop = loop
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(
+            self.receive(), self.loop).result()
+        if message['type'] == 'http.disconnect':
+            self.more_body = False
+            return
+        self.buffer += message.get('body', b'')
+        self.more_body = message.get('more_body', False)
+
+    def readinto(self, target):
+        while not self.buffer and self.more_body:
+            self._fill()
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+'''
+AsgiApp
+    ASGI callable running a WSGI app
+'''
+
+
+class AsgiApp(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(app.config['ASGI_THREADS'])
+        self.stream_executor = ThreadPoolExecutor(
+            app.config['ASGI_STREAM_THREADS'])
+        self.buffer_bytes = app.config['ASGI_BUFFER_BYTES']
+        self.jwks_refresh = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.ensure_jwks()
+                except Exception:
+                    # the keys are fetched again on the first request
+                    pass
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.stream_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def ensure_jwks(self):
+        domain = self.app.config['AUTH0_DOMAIN']
+        if not domain or cached_jwks(domain) is not None:
+            return
+
+        # concurrent requests share one fetch
+        if self.jwks_refresh is None or self.jwks_refresh.done():
+            self.jwks_refresh = asyncio.ensure_future(
+                fetch_json(jwks_url(domain)))
+        jwks = await asyncio.shield(self.jwks_refresh)
+        set_jwks(domain, jwks, self.app.config['JWKS_TTL'])
+
+    async def read_body(self, receive):
+        body = b''
+        more_body = True
+        while more_body and len(body) <= self.buffer_bytes:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return body, False
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        return body, more_body
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        body, more_body = await self.read_body(receive)
+
+        headers = dict(scope['headers'])
+        if b'authorization' in headers:
+            try:
+                await self.ensure_jwks()
+            except Exception:
+                # auth falls back to fetching the keys itself
+                pass
+
+        request_body = RequestBody(body, more_body, receive, loop)
+        environ = build_environ(scope, request_body)
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in response_headers]
+
+        iterable = await loop.run_in_executor(
+            self.executor, self.app, environ, start_response)
+        disconnected = None
+        try:
+            iterator = iter(iterable)
+            chunk = await loop.run_in_executor(
+                self.executor, next, iterator, _END)
+            await send({
+                'type': 'http.response.start',
+                'status': response['status'],
+                'headers': response['headers'],
+            })
+            executor = self.executor
+            if is_event_stream(response['headers']):
+                executor = self.stream_executor
+            if not request_body.more_body:
+                # stop streaming responses once the client goes away
+                disconnected = asyncio.ensure_future(
+                    wait_for_disconnect(receive))
+            while chunk is not _END:
+                if disconnected is not None and disconnected.done():
+                    return
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True,
+                    })
+                chunk = await loop.run_in_executor(
+                    executor, next, iterator, _END)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if disconnected is not None:
+                disconnected.cancel()
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self.executor, close)
+
+
+def is_event_stream(headers):
+    return any(name == b'content-type' and
+               value.startswith(b'text/event-stream')
+               for name, value in headers)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8')
+                                                 .decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BufferedReader(body),
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+def create_asgi_app(settings=None):
+    # the factory runs in the server process, see flaskr/warmup.py
+    app = create_app(settings)
+    app.extensions['warmup'].start()
+    return AsgiApp(app)
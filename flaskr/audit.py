@@ -0,0 +1,207 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from flask import _request_ctx_stack, g, has_app_context, \
+    has_request_context
+from sqlalchemy import select
+
+from models import db, audit_log, on_write
+from .listing import integer_arg
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Audit log
+    every committed write is recorded in the audit_log table with the JWT
+    sub of the request that made it (the owner of the job for background
+    jobs), the action, the table and the written record
+    the write listener only puts the event on an in-memory queue; a
+    background thread of each process inserts the queued events in
+    batches of AUDIT_BATCH_SIZE rows, or of what was queued within
+    AUDIT_FLUSH_INTERVAL seconds of the first one, with one executemany
+    once AUDIT_QUEUE_SIZE events wait, a write blocks for up to
+    AUDIT_BLOCK_TIMEOUT seconds for room in the queue; the event is then
+    dropped, logged and counted as audit.dropped
+    a batch that cannot be inserted is tried WRITE_ATTEMPTS times before
+    it is dropped (audit.failed); the events still queued when the process
+    exits are written first
+'''
+
+WRITE_ATTEMPTS = 3
+MAX_LIMIT = 500
+
+
+def current_actor():
+    # the JWT sub of the request, see requires_auth, or the owner of the
+    # job being run, see flaskr/jobs.py
+    if has_request_context():
+        payload = getattr(_request_ctx_stack.top, 'current_user', None)
+        if payload is not None:
+            return payload.get('sub')
+    if has_app_context():
+        return g.get('job_owner')
+    return None
+
+
+def audit_row(event):
+    at, actor, action, table, record = event
+    record_id = record.get('id')
+    return {
+        'at': at,
+        'actor': actor,
+        'action': action,
+        'table_name': table,
+        'record_id': record_id if isinstance(record_id, int) else None,
+        'record': json.dumps(record, default=str, sort_keys=True)
+    }
+
+
+class AuditLog(object):
+
+    def __init__(self, app, batch_size, flush_interval, queue_size,
+                 block_timeout):
+        self.app = app
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.block_timeout = block_timeout
+        self.metrics = app.extensions.get('metrics')
+        self.queue = queue.Queue(queue_size)
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def on_write(self, action, table, record):
+        # write listener, see models.on_write
+        self.ensure_started()
+        event = (time.time(), current_actor(), action, table, dict(record))
+        try:
+            self.queue.put(event, timeout=self.block_timeout)
+        except queue.Full:
+            logger.error('Audit queue full, dropped %s of %s %s', action,
+                         table, record.get('id'))
+            self.count('audit.dropped')
+
+    def ensure_started(self):
+        # started lazily in each worker process, with a queue of its own:
+        # the events queued before a fork are written by the parent
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name='audit-log',
+                             daemon=True).start()
+            atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.write([audit_row(event) for event in batch])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write(self, rows):
+        # outside of any app context, so that these statements are neither
+        # observed nor counted against the budget of a request
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                with db.get_engine(self.app).begin() as connection:
+                    connection.execute(audit_log.insert(), rows)
+            except Exception:
+                logger.exception('Could not write %s audit events, attempt '
+                                 '%s of %s', len(rows), attempt,
+                                 WRITE_ATTEMPTS)
+                if attempt < WRITE_ATTEMPTS:
+                    time.sleep(attempt)
+                continue
+            self.count('audit.written', len(rows))
+            self.count('audit.batches')
+            return
+        self.count('audit.failed', len(rows))
+
+    def flush(self):
+        # waits until the events queued by this process are written
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def gauges(self):
+        return {'audit.queued': self.queue.qsize()}
+
+    def count(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.inc(name, value)
+
+
+'''
+audit_page(args)
+    the audit events matching ?actor=<sub>&table=<table>&record_id=<id>
+    &action=<action>, newest first, ?limit=<n> (default 50) of them with an
+    id below ?before=<id>
+    returns the events and the before cursor of the next page, None after
+    the last one; the indexes on (actor, id) and (table_name, record_id,
+    id) keep every page as cheap as the first
+'''
+
+
+def audit_page(args):
+    limit = integer_arg(args, 'limit')
+    limit = 50 if limit is None else min(max(limit, 1), MAX_LIMIT)
+    before = integer_arg(args, 'before')
+
+    query = select([audit_log])
+    if args.get('actor'):
+        query = query.where(audit_log.c.actor == args['actor'])
+    if args.get('table'):
+        query = query.where(audit_log.c.table_name == args['table'])
+    if args.get('action'):
+        query = query.where(audit_log.c.action == args['action'])
+    record_id = integer_arg(args, 'record_id')
+    if record_id is not None:
+        query = query.where(audit_log.c.record_id == record_id)
+    if before is not None:
+        query = query.where(audit_log.c.id < before)
+    rows = db.session.execute(
+        query.order_by(audit_log.c.id.desc()).limit(limit + 1)).fetchall()
+
+    events = [{
+        'id': row['id'],
+        'at': row['at'],
+        'actor': row['actor'],
+        'action': row['action'],
+        'table': row['table_name'],
+        'record_id': row['record_id'],
+        'record': json.loads(row['record'])
+    } for row in rows[:limit]]
+    next_before = events[-1]['id'] if len(rows) > limit else None
+    return events, next_before
+
+
+def init_audit(app):
+    log = AuditLog(app, app.config['AUDIT_BATCH_SIZE'],
+                   app.config['AUDIT_FLUSH_INTERVAL'],
+                   app.config['AUDIT_QUEUE_SIZE'],
+                   app.config['AUDIT_BLOCK_TIMEOUT'])
+    on_write(app, log.on_write)
+    app.extensions['metrics'].collect(log.gauges)
+    app.extensions['audit'] = log
+    return log
@@ -0,0 +1,74 @@
+import logging
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, request
+
+from .sqlhooks import unwatch_sql, watch_sql
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Query budgets
+    @query_budget(n) declares that an endpoint runs at most n SQL
+    statements, whatever the size of the catalogue; used under
+    @requires_auth and @coalesced
+    QUERY_BUDGET_MODE says what happens when a request needs more:
+        log      a warning and the query_budget.exceeded metrics (default)
+        enforce  the request fails with QueryBudgetExceeded (tests)
+        off      statements are not counted
+'''
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class StatementCounter(object):
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, statement, parameters, seconds):
+        self.count += 1
+
+
+@contextmanager
+def counted_statements():
+    counter = StatementCounter()
+    watch_sql(counter)
+    try:
+        yield counter
+    finally:
+        unwatch_sql(counter)
+
+
+def query_budget(limit):
+    def query_budget_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            mode = current_app.config['QUERY_BUDGET_MODE']
+            if mode == 'off':
+                return f(*args, **kwargs)
+
+            with counted_statements() as counter:
+                response = f(*args, **kwargs)
+            if counter.count > limit:
+                exceeded(counter.count, limit, mode)
+            return response
+        return wrapper
+    return query_budget_decorator
+
+
+def exceeded(count, limit, mode):
+    message = '{} {} ran {} SQL statements, its budget is {}'.format(
+        request.method, request.endpoint, count, limit)
+    metrics = current_app.extensions.get('metrics')
+    if metrics is not None:
+        metrics.inc('query_budget.exceeded')
+        metrics.inc('query_budget.exceeded.' + request.endpoint)
+    if mode == 'enforce':
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
@@ -0,0 +1,119 @@
+import threading
+from collections import deque, namedtuple
+
+from flask import Response, json
+
+
+'''
+Change feed
+    every invalidation event (the committed writes of movies and actors of
+    all workers, see flaskr/notifications.py) is published once into a
+    bounded ring buffer (CHANGES_BUFFER events), already serialized as an
+    SSE frame; all GET /changes subscribers of the worker read the same
+    frames, so a subscriber costs no database work
+    event ids are "<origin>:<n>", n counting the changes of the worker and
+    origin the id of the worker process (see NotificationBus.origin): a
+    client resumes with Last-Event-ID on the worker that sent it, so
+    resuming needs sticky sessions, and an id of another worker or of an
+    earlier process gets a reset event instead of the wrong changes
+'''
+
+Change = namedtuple('Change', ['id', 'table', 'frame'])
+
+
+class ChangeFeed(object):
+
+    def __init__(self, size, bus):
+        self.changes = deque(maxlen=size)
+        self.last_id = 0
+        self.bus = bus
+        self.condition = threading.Condition()
+
+    def event_id(self, id):
+        return '{}:{}'.format(self.bus.origin, id)
+
+    def parse_event_id(self, event_id):
+        # the n of an event id of this feed, -1 for any other id
+        origin, _, id = event_id.rpartition(':')
+        if origin != self.bus.origin or not id.isdigit():
+            return -1
+        return int(id)
+
+    def publish(self, action, table, record):
+        data = json.dumps({
+            'action': action,
+            'table': table,
+            'record': record
+        })
+        with self.condition:
+            self.last_id += 1
+            frame = 'id: {}\nevent: {}.{}\ndata: {}\n\n'.format(
+                self.event_id(self.last_id), table, action, data)
+            self.changes.append(Change(self.last_id, table, frame))
+            self.condition.notify_all()
+
+    def since(self, last_id):
+        # returns the changes after last_id, or None when some of them
+        # have already left the buffer (or last_id is not from this feed)
+        with self.condition:
+            if last_id < 0 or last_id > self.last_id:
+                return None
+            if self.changes and self.changes[0].id > last_id + 1:
+                return None
+            return [change for change in self.changes if change.id > last_id]
+
+    def wait(self, last_id, timeout):
+        with self.condition:
+            if self.last_id == last_id:
+                self.condition.wait(timeout)
+        return self.since(last_id)
+
+
+RESET_FRAME = 'event: reset\ndata: {}\n\n'
+KEEP_ALIVE_FRAME = ': keep-alive\n\n'
+
+
+def stream_changes(feed, last_id, tables, heartbeat):
+    yield 'retry: 3000\n\n'
+    while True:
+        changes = feed.wait(last_id, heartbeat)
+        if changes is None:
+            # missed changes, the client has to reload the collections
+            last_id = feed.last_id
+            yield RESET_FRAME
+        elif not changes:
+            yield KEEP_ALIVE_FRAME
+        for change in changes or ():
+            last_id = change.id
+            if change.table in tables:
+                yield change.frame
+
+
+'''
+changes_response(feed, last_event_id, tables)
+    text/event-stream response with the changes of the given tables
+    after last_event_id, or only the new ones without it
+'''
+
+
+def changes_response(feed, last_event_id, tables, heartbeat):
+    # read now rather than when the stream starts, so that the changes
+    # published meanwhile are sent too
+    last_id = feed.last_id
+    if last_event_id:
+        last_id = feed.parse_event_id(last_event_id)
+
+    response = Response(
+        stream_changes(feed, last_id, tables, heartbeat),
+        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def init_changes(app, bus):
+    feed = ChangeFeed(app.config['CHANGES_BUFFER'], bus)
+    bus.subscribe(lambda event: feed.publish(
+        event.action, event.table, event.record))
+    app.extensions['changes'] = feed
+    return feed
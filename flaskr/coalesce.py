@@ -0,0 +1,92 @@
+import threading
+from functools import wraps
+
+from flask import Response, current_app, request
+
+
+'''
+Request coalescing
+    identical concurrent reads (same endpoint, path, query string and
+    permission scope) share one execution: the first request runs the
+    handler, the ones arriving while it runs wait for its response instead
+    of running the same query and serialization again
+    counted in the coalescing.executed and coalescing.coalesced metrics
+'''
+
+
+class Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        # returns (result, shared), shared is True for the waiting callers
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+'''
+@coalesced
+    used under @requires_auth on read endpoints, so the payload
+    is the first argument
+'''
+
+
+def coalesced(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        flight = current_app.extensions.get('coalescing')
+        if flight is None:
+            return f(payload, *args, **kwargs)
+
+        key = (request.endpoint, request.path, request.query_string,
+               tuple(sorted(payload.get('permissions', ()))))
+
+        def run():
+            response = current_app.make_response(
+                f(payload, *args, **kwargs))
+            return (response.status_code, list(response.headers),
+                    response.get_data())
+
+        (status, headers, body), shared = flight.do(key, run)
+        current_app.extensions['metrics'].inc(
+            'coalescing.coalesced' if shared else 'coalescing.executed')
+        return Response(body, status, headers)
+    return wrapper
+
+
+def init_coalescing(app):
+    if not app.config['COALESCE_READS']:
+        return None
+    flight = SingleFlight()
+    app.extensions['coalescing'] = flight
+    return flight
@@ -0,0 +1,54 @@
+'''
+CORS
+    CorsMiddleware answers every preflight request (OPTIONS with an
+    Access-Control-Request-Method header) with the same 204 response,
+    before routing, authentication and the database are involved, and lets
+    browsers cache it for CORS_MAX_AGE seconds
+    all other responses get the Access-Control-Allow-Origin and
+    Access-Control-Expose-Headers headers
+    the header tuples are built once, not for every response
+'''
+
+ALLOW_METHODS = 'GET,PUT,POST,PATCH,DELETE,OPTIONS'
+ALLOW_HEADERS = ','.join([
+    'Authorization', 'Content-Type', 'Idempotency-Key', 'If-Match',
+    'Last-Event-ID', 'Prefer', 'X-Profile'
+])
+EXPOSE_HEADERS = ','.join([
+    'ETag', 'Location', 'X-Profile-Id', 'X-Total-Count',
+    'X-Total-Count-Type'
+])
+
+
+class CorsMiddleware(object):
+
+    def __init__(self, wsgi_app, max_age):
+        self.wsgi_app = wsgi_app
+        self.preflight_headers = (
+            ('Access-Control-Allow-Origin', '*'),
+            ('Access-Control-Allow-Methods', ALLOW_METHODS),
+            ('Access-Control-Allow-Headers', ALLOW_HEADERS),
+            ('Access-Control-Max-Age', str(max_age)),
+            ('Content-Length', '0'),
+        )
+        self.response_headers = (
+            ('Access-Control-Allow-Origin', '*'),
+            ('Access-Control-Expose-Headers', EXPOSE_HEADERS),
+        )
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'OPTIONS' and \
+                'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ:
+            start_response('204 No Content', list(self.preflight_headers))
+            return []
+
+        def cors_start_response(status, headers, exc_info=None):
+            headers.extend(self.response_headers)
+            return start_response(status, headers, exc_info)
+
+        return self.wsgi_app(environ, cors_start_response)
+
+
+def init_cors(app):
+    app.wsgi_app = CorsMiddleware(app.wsgi_app, app.config['CORS_MAX_AGE'])
+    return app.wsgi_app
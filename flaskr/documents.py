@@ -0,0 +1,170 @@
+from flask import current_app, json
+from sqlalchemy import and_, select, true
+
+from models import db, Movie, Actor, castings, movie_documents, on_write
+from .imports import chunked
+from .listing import paged
+
+
+'''
+Movie documents
+    movie_documents holds every movie serialized as GET /movies returns it
+    (Movie.format(), the cast ordered by actor id), so the list endpoint
+    joins the stored JSON of the page into the response, without ORM
+    instances or serialization per request
+    a write regenerates the documents of the movies it changed in its own
+    transaction (a write listener, see models.on_write), so they commit,
+    or fail, with it: a movie, or the range of a movie import; a write
+    that changes the cast of a movie updates the movie too (see
+    models.commit_write); the movie rows are locked (FOR NO KEY UPDATE,
+    which the foreign key checks of castings do not wait for)
+    until the write commits, so concurrent regenerations of a movie run one
+    after the other and the last one reads the last committed state
+    movies without a document (e.g. before `manage.py rebuild_documents`
+    after the migration) are serialized on the fly
+    `manage.py check_documents` reports the missing and outdated documents,
+    `manage.py rebuild_documents` regenerates all of them
+'''
+
+
+def render_documents(movie_ids):
+    # the documents of the existing movies among movie_ids, by id
+    movies = Movie.__table__
+    actors = Actor.__table__
+    rows = db.session.execute(
+        select([movies, actors.c.id.label('actor_id'), actors.c.name,
+                actors.c.age, actors.c.gender, actors.c.movie_id,
+                actors.c.version.label('actor_version')])
+        .select_from(movies
+                     .outerjoin(castings, castings.c.movie_id == movies.c.id)
+                     .outerjoin(actors, actors.c.id == castings.c.actor_id))
+        .where(movies.c.id.in_(movie_ids))
+        .order_by(movies.c.id, actors.c.id)).fetchall()
+
+    formatted = {}
+    for row in rows:
+        movie = formatted.get(row.id)
+        if movie is None:
+            movie = formatted[row.id] = {
+                'id': row.id,
+                'title': row.title,
+                'release_date': row.release_date,
+                'version': row.version,
+                'actors': []
+            }
+        if row.actor_id is not None:
+            movie['actors'].append({
+                'id': row.actor_id,
+                'name': row.name,
+                'age': row.age,
+                'gender': row.gender,
+                'movie_id': row.movie_id,
+                'version': row.actor_version
+            })
+    return {id: json.dumps(movie) for id, movie in formatted.items()}
+
+
+def refresh_documents(movie_ids, batch_size=500):
+    # in the current transaction, which the caller commits
+    movies = Movie.__table__
+    for chunk in chunked(sorted(set(movie_ids)), batch_size):
+        db.session.execute(
+            select([movies.c.id]).where(movies.c.id.in_(chunk))
+            .order_by(movies.c.id).with_for_update(key_share=True)).fetchall()
+        documents = render_documents(chunk)
+        db.session.execute(movie_documents.delete()
+                           .where(movie_documents.c.movie_id.in_(chunk)))
+        if documents:
+            db.session.execute(movie_documents.insert(), [
+                {'movie_id': id, 'document': document}
+                for id, document in documents.items()])
+
+
+def changed_movies(action, table, record):
+    # the ids of the movies whose documents a write changed; the movies
+    # whose cast changed are written too, see models.commit_write
+    if table != 'movies' or action == 'delete':
+        return []
+    if action == 'import':
+        movies = Movie.__table__
+        return [id for id, in db.session.execute(
+            select([movies.c.id]).where(movies.c.id.between(
+                record['min_id'], record['max_id'])))]
+    return [record['id']]
+
+
+def on_movie_write(action, table, record):
+    # write listener in the transaction of the write
+    movie_ids = changed_movies(action, table, record)
+    if movie_ids:
+        refresh_documents(movie_ids)
+
+
+def movie_ids_after(last_id, batch_size):
+    movies = Movie.__table__
+    return [id for id, in db.session.execute(
+        select([movies.c.id]).where(movies.c.id > last_id)
+        .order_by(movies.c.id).limit(batch_size))]
+
+
+def rebuild_documents(batch_size=500):
+    # keyset pagination, every batch is locked and committed on its own
+    rebuilt = 0
+    last_id = 0
+    while True:
+        ids = movie_ids_after(last_id, batch_size)
+        if not ids:
+            db.session.commit()
+            return rebuilt
+        refresh_documents(ids, batch_size)
+        db.session.commit()
+        rebuilt += len(ids)
+        last_id = ids[-1]
+
+
+def check_documents(batch_size=500):
+    # compares the stored documents with freshly rendered ones
+    report = {'movies': 0, 'missing': [], 'outdated': []}
+    last_id = 0
+    while True:
+        ids = movie_ids_after(last_id, batch_size)
+        if not ids:
+            db.session.commit()
+            return report
+        stored = dict(db.session.execute(
+            select([movie_documents.c.movie_id, movie_documents.c.document])
+            .where(movie_documents.c.movie_id.in_(ids))).fetchall())
+        for id, document in render_documents(ids).items():
+            if id not in stored:
+                report['missing'].append(id)
+            elif stored[id] != document:
+                report['outdated'].append(id)
+        report['movies'] += len(ids)
+        last_id = ids[-1]
+
+
+def movie_page(criteria, args):
+    # the documents of a page of GET /movies, in order
+    movies = Movie.__table__
+    rows = db.session.execute(paged(
+        select([movies.c.id, movie_documents.c.document])
+        .select_from(movies.outerjoin(
+            movie_documents, movie_documents.c.movie_id == movies.c.id))
+        .where(and_(*criteria) if criteria else true())
+        .order_by(movies.c.id), args)).fetchall()
+    missing = [row.id for row in rows if row.document is None]
+    rendered = render_documents(missing) if missing else {}
+    return [row.document or rendered[row.id] for row in rows
+            if row.document is not None or row.id in rendered]
+
+
+def documents_response(name, documents):
+    # like jsonify({"success": True, name: [...]}), with the documents
+    # already serialized
+    return current_app.response_class(
+        '{"' + name + '":[' + ','.join(documents) + '],"success":true}\n',
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def init_documents(app):
+    on_write(app, on_movie_write, in_transaction=True)
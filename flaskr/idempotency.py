@@ -0,0 +1,169 @@
+import hashlib
+import json
+import time
+from functools import wraps
+
+from flask import Response, abort, current_app, request
+from sqlalchemy import select, text
+
+from models import db, idempotency_keys
+
+
+'''
+Idempotency keys
+    a request with an Idempotency-Key header is executed once per
+    (token sub, key), its response is kept for IDEMPOTENCY_TTL seconds
+    a retry with the same body gets the stored response back without
+    running the handler, a retry with a different body, or one arriving
+    while the first request is still running, gets a 409
+    keys are rows of the idempotency_keys table, shared by all workers
+    and hosts; expired keys are claimed again, and deleted by purge() in
+    batches of PURGE_BATCH_SIZE: one batch as a response is stored, all of
+    them every IDEMPOTENCY_PURGE_INTERVAL seconds by the job worker (see
+    flaskr/jobs.py) or by `manage.py purge_idempotency_keys`
+'''
+
+PURGE_BATCH_SIZE = 1000
+
+CLAIM_SQL = text('''
+INSERT INTO idempotency_keys (key, fingerprint, expires_at)
+VALUES (:key, :fingerprint, :expires_at)
+ON CONFLICT (key) DO UPDATE SET
+    fingerprint = excluded.fingerprint,
+    expires_at = excluded.expires_at,
+    status = NULL,
+    headers = NULL,
+    body = NULL
+WHERE idempotency_keys.expires_at <= :now
+RETURNING key
+''')
+
+
+class IdempotencyStore(object):
+
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+
+    def begin(self, key, fingerprint):
+        # claims the key in the transaction of the request, which the write
+        # then commits with it: a concurrent claim of the same key waits on
+        # the primary key until that transaction ends, and a request that
+        # rolls back releases the key
+        # returns the stored (status, headers, body) of a replay, or None
+        # when the caller should run the request and complete() it
+        now = time.time()
+        claimed = self.db.session.execute(CLAIM_SQL, {
+            'key': key,
+            'fingerprint': fingerprint,
+            'expires_at': now + self.ttl,
+            'now': now
+        }).fetchone()
+        if claimed is not None:
+            return None
+
+        entry = self.db.session.execute(idempotency_keys.select().where(
+            idempotency_keys.c.key == key)).fetchone()
+        self.db.session.rollback()
+        if entry.fingerprint != fingerprint:
+            abort(409, "Idempotency-Key was already used "
+                       "with a different request")
+        if entry.status is None:
+            # also until IDEMPOTENCY_TTL when the process died between
+            # committing the write and storing its response
+            abort(409, "A request with this Idempotency-Key "
+                       "is still in progress")
+        return entry.status, json.loads(entry.headers), entry.body
+
+    def complete(self, key, response):
+        status, headers, body = response
+        self.db.session.execute(idempotency_keys.update().where(
+            idempotency_keys.c.key == key).values(
+                status=status, headers=json.dumps(headers), body=body))
+        self.purge_batch(time.time(), PURGE_BATCH_SIZE)
+        self.db.session.commit()
+
+    def purge_batch(self, now, batch_size):
+        # deletes up to batch_size expired keys in the current transaction,
+        # skipping the ones a request is claiming again; the outer condition
+        # is checked again on a row that changed meanwhile
+        expired = idempotency_keys.c.expires_at <= now
+        batch = select([idempotency_keys.c.key]).where(expired) \
+            .order_by(idempotency_keys.c.expires_at).limit(batch_size) \
+            .with_for_update(skip_locked=True)
+        return self.db.session.execute(idempotency_keys.delete().where(
+            idempotency_keys.c.key.in_(batch)).where(expired)).rowcount
+
+    def purge(self, batch_size=PURGE_BATCH_SIZE):
+        # deletes all the expired keys, one committed batch at a time
+        # returns how many were deleted
+        now = time.time()
+        purged = 0
+        while True:
+            deleted = self.purge_batch(now, batch_size)
+            self.db.session.commit()
+            purged += deleted
+            if deleted < batch_size:
+                return purged
+
+    def discard(self, key):
+        self.db.session.rollback()
+        self.db.session.execute(idempotency_keys.delete().where(
+            idempotency_keys.c.key == key))
+        self.db.session.commit()
+
+
+def request_fingerprint():
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+'''
+@idempotent
+    used under @requires_auth on write endpoints, so the payload
+    is the first argument
+    responses are stored unless they are server errors, aborted requests
+    are forgotten so that they can be retried
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return f(payload, *args, **kwargs)
+
+        store = current_app.extensions['idempotency']
+        key = payload.get('sub', '') + ' ' + idempotency_key
+        stored = store.begin(key, request_fingerprint())
+        if stored is not None:
+            status, headers, body = stored
+            response = Response(body, status, headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = current_app.make_response(
+                f(payload, *args, **kwargs))
+        except BaseException:
+            store.discard(key)
+            raise
+
+        if response.status_code >= 500:
+            store.discard(key)
+        else:
+            store.complete(key, (response.status_code,
+                                 list(response.headers),
+                                 response.get_data()))
+        return response
+    return wrapper
+
+
+def init_idempotency(app):
+    store = IdempotencyStore(db, app.config['IDEMPOTENCY_TTL'])
+    app.extensions['idempotency'] = store
+    return store
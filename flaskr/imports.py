@@ -0,0 +1,243 @@
+import csv
+import json
+from itertools import repeat
+
+from flask import abort, request
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError
+
+from models import db, Movie, Actor, castings, commit_write, \
+    supports_returning
+from .schemas import ACTOR, MOVIE, ValidationError, load_movie_ids
+
+
+'''
+Bulk import
+    POST /import/movies and POST /import/actors read the request body as a
+    stream of NDJSON lines (application/x-ndjson) or CSV rows with a header
+    line (text/csv), so the whole upload is never held in memory
+    every row is validated on its own with the schemas of the write
+    endpoints (see flaskr/schemas.py), valid rows are written in batches of
+    IMPORT_BATCH_SIZE with one commit per batch, invalid rows are reported
+    with their 1-based row number (at most IMPORT_MAX_ERRORS of them),
+    rows that are not UTF-8 too
+    every committed batch is published as one 'import' write event
+'''
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonlines',
+                'application/json-lines')
+CSV_TYPES = ('text/csv',)
+
+
+class RowError(ValidationError):
+    pass
+
+
+def is_decoded(text):
+    # bytes that are not UTF-8 are decoded to lone surrogates
+    return not any('\udc80' <= char <= '\udcff' for char in text)
+
+
+def read_rows(stream, mimetype):
+    # yields (row number, dict or RowError) for every row,
+    # blank NDJSON lines are skipped
+    lines = (line.decode('utf-8', 'surrogateescape') for line in stream)
+    if mimetype in NDJSON_TYPES:
+        number = 0
+        for line in lines:
+            if not line.strip():
+                continue
+            number += 1
+            if not is_decoded(line):
+                yield number, RowError('Invalid UTF-8')
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield number, RowError('Malformed JSON')
+                continue
+            if not isinstance(row, dict):
+                row = RowError('Expected a JSON object')
+            yield number, row
+    else:
+        reader = csv.DictReader(lines)
+        for number, row in enumerate(reader, 1):
+            if None in row:
+                row = RowError('Too many fields')
+            elif not all(is_decoded(value) for value in row.values()
+                         if value is not None):
+                row = RowError('Invalid UTF-8')
+            yield number, row
+
+
+def validate_movie(row):
+    return MOVIE.validate(row)
+
+
+class ActorValidator(object):
+    # a class rather than a closure, so that it can be sent to a process
+
+    def __init__(self, movie_ids):
+        self.movie_ids = movie_ids
+
+    def __call__(self, row):
+        values = ACTOR.validate(row)
+        if values['movie_id'] not in self.movie_ids:
+            raise RowError('No movie with id ' + str(values['movie_id']))
+        return values
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def check_batch(validate, rows):
+    # returns the row numbers and values of the valid rows,
+    # and (row number, message) for the others
+    numbers, batch, errors = [], [], []
+    for number, row in rows:
+        try:
+            if isinstance(row, RowError):
+                raise row
+            batch.append(validate(row))
+            numbers.append(number)
+        except ValidationError as error:
+            errors.append((number, str(error)))
+    return numbers, batch, errors
+
+
+def insert_batch(table, rows):
+    # returns the ids of the inserted rows, in order
+    if supports_returning():
+        result = db.session.execute(
+            table.insert().values(rows).returning(table.c.id))
+        return [id for id, in result]
+    return [db.session.execute(table.insert().values(row))
+            .inserted_primary_key[0] for row in rows]
+
+
+def write_movies(rows):
+    return insert_batch(Movie.__table__, rows)
+
+
+def write_actors(rows):
+    actors = Actor.__table__
+    ids = insert_batch(actors, rows)
+    # one statement instead of a round trip per casting
+    db.session.execute(castings.insert().from_select(
+        ['movie_id', 'actor_id'],
+        select([actors.c.movie_id, actors.c.id])
+        .where(actors.c.id.in_(ids))))
+    return ids
+
+
+'''
+Importer
+    validates the rows batch by batch and writes the valid ones
+    a batch the database rejects is rolled back and written again row by
+    row, each in a savepoint, so only the rejected rows are reported
+    run() takes the map function used for validation, a background job
+    passes one that validates in worker processes (see flaskr/jobs.py)
+'''
+
+
+class Importer(object):
+
+    def __init__(self, table, validate, write, batch_size, max_errors,
+                 progress=None):
+        self.table = table
+        self.validate = validate
+        self.write = write
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.progress = progress
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, number, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': number, 'error': message})
+
+    def run(self, rows, map=map):
+        chunks = chunked(rows, self.batch_size)
+        for numbers, batch, errors in map(check_batch,
+                                          repeat(self.validate), chunks):
+            for number, message in errors:
+                self.error(number, message)
+            if batch:
+                self.flush(numbers, batch)
+            if self.progress is not None:
+                self.progress(self.imported + self.failed)
+        return self
+
+    def flush(self, numbers, batch):
+        try:
+            ids = self.write(batch)
+            self.commit(ids)
+        except DBAPIError:
+            db.session.rollback()
+            ids = self.flush_rows(numbers, batch)
+            self.commit(ids)
+        self.imported += len(ids)
+
+    def commit(self, ids):
+        if not ids:
+            db.session.commit()
+            return
+        commit_write(('import', self.table, {
+            'count': len(ids),
+            'min_id': min(ids),
+            'max_id': max(ids)
+        }))
+
+    def flush_rows(self, numbers, batch):
+        ids = []
+        for number, row in zip(numbers, batch):
+            savepoint = db.session.begin_nested()
+            try:
+                ids += self.write([row])
+                savepoint.commit()
+            except DBAPIError as error:
+                savepoint.rollback()
+                self.error(number, 'Rejected by the database: ' +
+                           str(error.orig).strip().split('\n')[0])
+        return ids
+
+    def report(self):
+        return {
+            'imported': self.imported,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errors_truncated': self.failed > len(self.errors)
+        }
+
+
+def check_import_type():
+    if request.mimetype not in NDJSON_TYPES + CSV_TYPES:
+        abort(400, "Import body must be NDJSON or CSV")
+
+
+def create_importer(table, config, progress=None):
+    if table == 'movies':
+        validate, write = validate_movie, write_movies
+    else:
+        # the movie ids are loaded once, not looked up for every row
+        validate, write = ActorValidator(load_movie_ids()), write_actors
+
+    return Importer(table, validate, write, config['IMPORT_BATCH_SIZE'],
+                    config['IMPORT_MAX_ERRORS'], progress)
+
+
+def import_rows(table, config):
+    check_import_type()
+    rows = read_rows(request.stream, request.mimetype)
+    return create_importer(table, config).run(rows).report()
@@ -0,0 +1,413 @@
+import json
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+from flask import abort, current_app, g, jsonify, request, url_for
+from sqlalchemy import and_, func, or_, select
+
+from models import db, Movie, Actor, jobs, insert_row, update_row, \
+    delete_rows, commit_write
+from .imports import check_import_type, chunked, create_importer, read_rows
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Background jobs
+    long imports, exports and bulk deletes are stored as rows of the jobs
+    table and answered with 202 and a GET /jobs/<id> status resource
+    `python manage.py worker` runs them: JOBS_THREADS threads each claim
+    the oldest queued job with SELECT ... FOR UPDATE SKIP LOCKED, so any
+    number of worker processes and hosts can share the queue
+    with JOBS_PROCESSES > 0 the CPU-heavy stages (row validation, export
+    serialization) run in a process pool
+    a running job whose progress was not updated for JOBS_STALE_AFTER
+    seconds is claimed again, at most JOBS_MAX_ATTEMPTS times; an
+    interrupted import fails instead, with the number of rows it processed
+    uploads and exports are kept as files in JOBS_SPOOL_DIR, which has to
+    be shared between the web and the worker hosts; an upload is removed
+    once its import has finished or failed, an export once it has failed
+    or its result has been downloaded
+    every IDEMPOTENCY_PURGE_INTERVAL seconds a worker also deletes the
+    expired idempotency keys, see flaskr/idempotency.py
+'''
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+def job_dict(row):
+    return {
+        'id': row['id'],
+        'kind': row['kind'],
+        'status': row['status'],
+        'progress': row['progress'],
+        'total': row['total'],
+        'result': None if row['result'] is None else json.loads(
+            row['result']),
+        'error': row['error'],
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at']
+    }
+
+
+def enqueue(kind, params, owner):
+    now = time.time()
+    row = insert_row(jobs, {
+        'kind': kind,
+        'owner': owner,
+        'params': json.dumps(params),
+        'status': QUEUED,
+        'progress': 0,
+        'attempts': 0,
+        'created_at': now,
+        'updated_at': now
+    })
+    db.session.commit()
+    return row
+
+
+def get_job(id, owner):
+    row = db.session.execute(
+        jobs.select().where(jobs.c.id == id)
+        .where(jobs.c.owner == owner)).fetchone()
+    return None if row is None else dict(row)
+
+
+def update_job(id, **values):
+    values['updated_at'] = time.time()
+    db.session.execute(jobs.update().where(jobs.c.id == id).values(**values))
+    db.session.commit()
+
+
+def claim(stale_after):
+    now = time.time()
+    candidate = db.session.execute(
+        select([jobs.c.id])
+        .where(or_(jobs.c.status == QUEUED,
+                   and_(jobs.c.status == RUNNING,
+                        jobs.c.updated_at < now - stale_after)))
+        .order_by(jobs.c.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)).fetchone()
+    if candidate is None:
+        db.session.rollback()
+        return None
+
+    row = update_row(jobs, candidate.id, {
+        'status': RUNNING,
+        'attempts': jobs.c.attempts + 1,
+        'updated_at': now
+    })
+    db.session.commit()
+    return row
+
+
+def spool_path(name):
+    directory = current_app.config['JOBS_SPOOL_DIR'] or os.path.join(
+        tempfile.gettempdir(), 'capstone-jobs')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def discard_spool(job, status):
+    # the upload of a finished import, the partial file of a failed export
+    if job['kind'] == 'import':
+        remove_file(json.loads(job['params'])['path'])
+    elif job['kind'] == 'export' and status == FAILED:
+        remove_file(spool_path('export-{}.ndjson'.format(job['id'])))
+
+
+def bounded_map(executor, fn, *iterables, window):
+    # like executor.map, but submits at most window calls ahead of the
+    # consumer, so a large input is never queued in memory at once
+    pending = deque()
+    for args in zip(*iterables):
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+'''
+JobContext
+    passed to the job handlers
+    progress() records how far the job is, which also tells other workers
+    that it is still alive; map() runs a CPU-heavy function over chunks,
+    in the process pool when there is one
+'''
+
+
+class JobContext(object):
+
+    def __init__(self, job, cpu=None, window=4):
+        self.job = job
+        self.cpu = cpu
+        self.window = window
+
+    def progress(self, done, total=None):
+        values = {'progress': done}
+        if total is not None:
+            values['total'] = total
+        update_job(self.job['id'], **values)
+
+    def map(self, fn, *iterables):
+        if self.cpu is None:
+            return map(fn, *iterables)
+        return bounded_map(self.cpu, fn, *iterables, window=self.window)
+
+
+TABLES = {
+    'movies': Movie.__table__,
+    'actors': Actor.__table__
+}
+
+
+def run_import(context, params):
+    importer = create_importer(params['table'], current_app.config,
+                               context.progress)
+    with open(params['path'], 'rb') as upload:
+        rows = read_rows(upload, params['mimetype'])
+        return importer.run(rows, map=context.map).report()
+
+
+def iso_format(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def serialize_rows(rows):
+    return ''.join(json.dumps(row, default=iso_format) + '\n'
+                   for row in rows)
+
+
+def read_table(table, batch_size):
+    # keyset pagination, every batch is a short indexed query
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            table.select().where(table.c.id > last_id)
+            .order_by(table.c.id).limit(batch_size)).fetchall()
+        db.session.commit()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [dict(row) for row in rows]
+
+
+def run_export(context, params):
+    # the export is NDJSON that POST /import/<table> accepts
+    table = TABLES[params['table']]
+    batch_size = current_app.config['IMPORT_BATCH_SIZE']
+    total = db.session.execute(
+        select([func.count()]).select_from(table)).scalar()
+    context.progress(0, total)
+
+    exported = 0
+    path = spool_path('export-{}.ndjson'.format(context.job['id']))
+    with open(path, 'w', encoding='utf-8') as export:
+        chunks = read_table(table, batch_size)
+        for lines in context.map(serialize_rows, chunks):
+            export.write(lines)
+            exported += lines.count('\n')
+            context.progress(exported)
+    return {'rows': exported}
+
+
+def run_delete(context, params):
+    table = TABLES[params['table']]
+    ids = params['ids']
+    context.progress(0, len(ids))
+
+    deleted = 0
+    done = 0
+    for chunk in chunked(ids, current_app.config['IMPORT_BATCH_SIZE']):
+        records = delete_rows(table, chunk)
+        commit_write(*[('delete', table.name, record)
+                       for record in records.values()])
+        deleted += len(records)
+        done += len(chunk)
+        context.progress(done)
+    return {'deleted': deleted, 'missing': len(ids) - deleted}
+
+
+HANDLERS = {
+    'import': run_import,
+    'export': run_export,
+    'delete': run_delete
+}
+
+# an import is not run again, its committed batches would be duplicated
+RETRYABLE = {'export', 'delete'}
+
+
+'''
+Worker
+    runs the queued jobs, see `manage.py worker`
+    work_once() claims and runs one job in the calling thread and returns
+    whether there was one
+'''
+
+
+class Worker(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.threads = app.config['JOBS_THREADS']
+        self.processes = app.config['JOBS_PROCESSES']
+        self.poll_interval = app.config['JOBS_POLL_INTERVAL']
+        self.stale_after = app.config['JOBS_STALE_AFTER']
+        self.max_attempts = app.config['JOBS_MAX_ATTEMPTS']
+        self.purge_interval = app.config['IDEMPOTENCY_PURGE_INTERVAL']
+        self.stopped = threading.Event()
+
+    def work_once(self, cpu=None):
+        job = claim(self.stale_after)
+        if job is None:
+            return False
+
+        if job['attempts'] > self.max_attempts:
+            self.finish(job, status=FAILED,
+                        error='Gave up after {} attempts'.format(
+                            self.max_attempts))
+            return True
+        if job['attempts'] > 1 and job['kind'] not in RETRYABLE:
+            self.finish(job, status=FAILED,
+                        error='Interrupted after {} rows'.format(
+                            job['progress']))
+            return True
+
+        # the writes of the job are audited as the writes of its owner
+        g.job_owner = job['owner']
+        context = JobContext(job, cpu, window=max(2, self.processes * 2))
+        try:
+            result = HANDLERS[job['kind']](context, json.loads(job['params']))
+        except Exception as error:
+            db.session.rollback()
+            logger.exception('Job %s failed', job['id'])
+            self.finish(job, status=FAILED, error=str(error))
+        else:
+            self.finish(job, status=SUCCEEDED, result=json.dumps(result))
+        return True
+
+    def finish(self, job, status, **values):
+        update_job(job['id'], status=status, **values)
+        discard_spool(job, status)
+
+    def poll(self, cpu):
+        while not self.stopped.is_set():
+            try:
+                with self.app.app_context():
+                    worked = self.work_once(cpu)
+            except Exception:
+                logger.exception('Job worker failed')
+                worked = False
+            if not worked:
+                self.stopped.wait(self.poll_interval)
+
+    def purge_idempotency_keys(self):
+        try:
+            with self.app.app_context():
+                purged = self.app.extensions['idempotency'].purge()
+        except Exception:
+            logger.exception('Could not purge the idempotency keys')
+            return
+        if purged:
+            logger.info('Purged %s expired idempotency keys', purged)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+        cpu = None
+        if self.processes:
+            cpu = ProcessPoolExecutor(self.processes)
+        try:
+            with ThreadPoolExecutor(self.threads) as pool:
+                for _ in range(self.threads):
+                    pool.submit(self.poll, cpu)
+                next_purge = time.monotonic()
+                while not self.stopped.is_set():
+                    if time.monotonic() >= next_purge:
+                        self.purge_idempotency_keys()
+                        next_purge = time.monotonic() + self.purge_interval
+                    self.stopped.wait(1)
+        finally:
+            if cpu is not None:
+                cpu.shutdown()
+
+    def stop(self):
+        self.stopped.set()
+
+
+'''
+Endpoint helpers
+'''
+
+
+def job_accepted(job):
+    response = jsonify({
+        "success": True,
+        "job": job_dict(job)
+    })
+    response.status_code = 202
+    response.headers['Location'] = url_for('retrieve_job', job_id=job['id'])
+    return response
+
+
+def wants_async():
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+
+def enqueue_import(table, owner):
+    check_import_type()
+    path = spool_path('upload-{}.{}'.format(
+        os.urandom(8).hex(), 'csv' if request.mimetype == 'text/csv'
+        else 'ndjson'))
+    with open(path, 'wb') as upload:
+        shutil.copyfileobj(request.stream, upload, 1024 * 1024)
+    return enqueue('import', {
+        'table': table,
+        'path': path,
+        'mimetype': request.mimetype
+    }, owner)
+
+
+def enqueue_export(table, owner):
+    return enqueue('export', {'table': table}, owner)
+
+
+def enqueue_delete(table, owner):
+    body = request.get_json()
+    ids = None if body is None else body.get('ids')
+    if not isinstance(ids, list) or \
+            not all(isinstance(id, int) for id in ids):
+        abort(400, "Bulk delete requires a list of ids")
+    return enqueue('delete', {'table': table, 'ids': ids}, owner)
+
+
+def export_path(job):
+    if job['kind'] != 'export' or job['status'] != SUCCEEDED:
+        return None
+    path = spool_path('export-{}.ndjson'.format(job['id']))
+    return path if os.path.exists(path) else None
@@ -0,0 +1,132 @@
+import json
+
+from flask import abort
+from sqlalchemy import and_, extract, func, literal, select, text, true
+
+from models import db, Movie, Actor
+
+
+'''
+Paging and filtering of GET /movies and GET /actors
+    ?page=<n>&per_page=<n> pages the list (all rows without them)
+    movies: ?title=<part of the title>&year=<release year>
+    actors: ?name=<part of the name>&gender=<gender>
+            &min_age=<age>&max_age=<age>
+'''
+
+
+def integer_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400, "Query parameter " + name + " must be an integer")
+
+
+def movie_criteria(args):
+    criteria = []
+    if args.get('title'):
+        criteria.append(Movie.title.ilike(
+            '%' + escape_like(args['title']) + '%', escape='\\'))
+    year = integer_arg(args, 'year')
+    if year is not None:
+        criteria.append(extract('year', Movie.release_date) == year)
+    return criteria
+
+
+def actor_criteria(args):
+    criteria = []
+    if args.get('name'):
+        criteria.append(Actor.name.ilike(
+            '%' + escape_like(args['name']) + '%', escape='\\'))
+    if args.get('gender'):
+        criteria.append(Actor.gender == args['gender'])
+    min_age = integer_arg(args, 'min_age')
+    if min_age is not None:
+        criteria.append(Actor.age >= min_age)
+    max_age = integer_arg(args, 'max_age')
+    if max_age is not None:
+        criteria.append(Actor.age <= max_age)
+    return criteria
+
+
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+def page_bounds(args):
+    # (offset, limit) of the requested page, or None for all rows
+    page = integer_arg(args, 'page')
+    per_page = integer_arg(args, 'per_page')
+    if page is None and per_page is None:
+        return None
+    page = max(page or 1, 1)
+    per_page = min(max(per_page or 10, 1), 1000)
+    return (page - 1) * per_page, per_page
+
+
+def paged(query, args):
+    bounds = page_bounds(args)
+    if bounds is None:
+        return query
+    offset, limit = bounds
+    return query.offset(offset).limit(limit)
+
+
+'''
+Total counts
+    count_rows() counts the matching rows, but never more than
+    COUNT_EXACT_THRESHOLD + 1 of them, so the cost is bounded; up to the
+    threshold the count is exact, above it PostgreSQL's estimate is used:
+    pg_class.reltuples without filters, the row estimate of the EXPLAIN of
+    the filtered query otherwise
+    other databases always get an exact count
+'''
+
+EXACT = 'exact'
+ESTIMATE = 'estimate'
+
+
+def count_rows(table, criteria, threshold):
+    where = and_(*criteria) if criteria else true()
+    if db.engine.dialect.name != 'postgresql':
+        return db.session.execute(
+            select([func.count()]).select_from(table).where(where)
+        ).scalar(), EXACT
+
+    capped = select([literal(1)]).select_from(table).where(where) \
+        .limit(threshold + 1).alias('capped')
+    count = db.session.execute(
+        select([func.count()]).select_from(capped)).scalar()
+    if count <= threshold:
+        return count, EXACT
+    return max(estimate_rows(table, criteria), count), ESTIMATE
+
+
+def estimate_rows(table, criteria):
+    if not criteria:
+        reltuples = db.session.execute(text(
+            'SELECT reltuples FROM pg_class '
+            'WHERE oid = CAST(:name AS regclass)'), {'name': table.name}
+        ).scalar()
+        # -1 or 0 when the table was never analyzed
+        if reltuples and reltuples > 0:
+            return int(reltuples)
+
+    statement = select([table.c.id]).where(and_(*criteria)) \
+        .compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(statement), statement.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def with_total(response, count):
+    total, kind = count
+    response.headers['X-Total-Count'] = str(total)
+    response.headers['X-Total-Count-Type'] = kind
+    return response
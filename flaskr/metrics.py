@@ -0,0 +1,44 @@
+import threading
+from collections import defaultdict
+
+
+'''
+Metrics
+    process-wide counters and gauges of one worker, served by GET /metrics
+    counters only go up, gauges hold the last value set
+    collect(function) adds the gauges the function returns as a dict,
+    for values that are cheaper to read when /metrics is requested
+'''
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def collect(self, function):
+        self.collectors.append(function)
+
+    def snapshot(self):
+        with self.lock:
+            values = dict(self.counters)
+        values.update(self.gauges)
+        for function in self.collectors:
+            values.update(function())
+        return values
+
+
+def init_metrics(app):
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+    return metrics
@@ -0,0 +1,248 @@
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from flask import json
+from sqlalchemy import or_, text
+
+from models import db, on_write, invalidations
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Invalidation events
+    every committed write of a Movie, an Actor or a casting becomes an
+    InvalidationEvent that is delivered to the handlers subscribed on every
+    worker of every host, so that in-process state can be dropped or updated
+    the event is sent to the other workers in the transaction of the write,
+    so that it is delivered if and only if the write commits, and a write
+    whose event cannot be sent fails; local handlers are called right after
+    the commit, other workers receive the event from a background listener
+    thread
+    NOTIFY_BACKEND selects how events travel between workers:
+        listen  PostgreSQL NOTIFY/LISTEN on the NOTIFY_CHANNEL channel
+        poll    rows in the invalidations table, polled every
+                NOTIFY_POLL_INTERVAL seconds (works on SQLite)
+        none    only the local worker is notified
+        auto    listen on PostgreSQL, poll otherwise (default)
+'''
+
+InvalidationEvent = namedtuple(
+    'InvalidationEvent', ['table', 'action', 'id', 'record', 'origin'])
+
+# NOTIFY payloads are limited to 8000 bytes
+MAX_PAYLOAD = 7900
+
+
+class NotificationBus(object):
+
+    def __init__(self, app, backend):
+        self.app = app
+        self.backend = backend
+        self.handlers = []
+        self.pid = None
+        self.origin = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, handler, tables=None):
+        self.handlers.append((handler, tables))
+
+    def send(self, action, table, record):
+        # write listener in the transaction of the write, see models.on_write
+        self.ensure_started()
+        self.backend.send(encode(self.event(action, table, record)))
+
+    def publish(self, action, table, record):
+        # write listener, see models.on_write
+        self.ensure_started()
+        self.dispatch(self.event(action, table, record))
+
+    def event(self, action, table, record):
+        return InvalidationEvent(table, action, record.get('id'), record,
+                                 self.origin)
+
+    def dispatch(self, event):
+        for handler, tables in self.handlers:
+            if tables is not None and event.table not in tables:
+                continue
+            try:
+                handler(event)
+            except Exception:
+                logger.exception('Invalidation handler failed')
+
+    def receive(self, payload):
+        event = decode(payload)
+        if event is None or event.origin == self.origin:
+            return
+        with self.app.app_context():
+            self.dispatch(event)
+
+    def ensure_started(self):
+        # threads and the origin id do not survive a fork, so the listener
+        # is started lazily in each worker process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.origin = uuid.uuid4().hex
+            if self.backend is not None:
+                self.thread = threading.Thread(
+                    target=self.backend.listen, args=(self.receive,),
+                    name='invalidation-listener', daemon=True)
+                self.thread.start()
+
+
+def encode(event):
+    payload = json.dumps(event._asdict())
+    if len(payload) > MAX_PAYLOAD:
+        payload = json.dumps(event._replace(record={'id': event.id})
+                             ._asdict())
+    return payload
+
+
+def decode(payload):
+    try:
+        return InvalidationEvent(**json.loads(payload))
+    except (ValueError, TypeError):
+        logger.warning('Ignoring malformed invalidation event')
+        return None
+
+
+'''
+ListenBackend
+    sends with pg_notify() in the transaction of the write, which delivers
+    the notification when it commits, and listens on a dedicated connection
+    that is not part of the pool
+'''
+
+
+class ListenBackend(object):
+
+    def __init__(self, app, channel):
+        self.app = app
+        self.channel = channel
+
+    def send(self, payload):
+        db.session.execute(text('SELECT pg_notify(:channel, :payload)'),
+                           {'channel': self.channel, 'payload': payload})
+
+    def listen(self, callback):
+        while True:
+            try:
+                self.listen_once(callback)
+            except Exception:
+                logger.exception('Invalidation listener failed, restarting')
+                time.sleep(1)
+
+    def listen_once(self, callback):
+        connection = db.get_engine(self.app).raw_connection()
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute('LISTEN "{}"'.format(self.channel))
+            while True:
+                if select.select([dbapi_connection], [], [], 60)[0]:
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        callback(notify.payload)
+        finally:
+            dbapi_connection.close()
+
+
+'''
+PollBackend
+    stores events in the invalidations table, in the transaction of the
+    write, and polls it
+    ids are taken when a write inserts its event but become visible when it
+    commits, so a lower id can show up after a higher one: the poller reads
+    the rows after the last id it saw and those of the last COMMIT_GRACE
+    seconds, skipping the ones it already delivered
+    rows older than NOTIFY_RETENTION seconds are deleted by the pollers
+'''
+
+COMMIT_GRACE = 60
+
+
+class PollBackend(object):
+
+    def __init__(self, app, interval, retention):
+        self.app = app
+        self.interval = interval
+        self.retention = retention
+
+    def send(self, payload):
+        db.session.execute(invalidations.insert().values(
+            payload=payload, created_at=time.time()))
+
+    def listen(self, callback):
+        engine = db.get_engine(self.app)
+        last_id = None
+        seen = {}
+        while True:
+            since = time.time() - COMMIT_GRACE
+            try:
+                with engine.begin() as connection:
+                    if last_id is None:
+                        last_id = connection.execute(text(
+                            'SELECT max(id) FROM invalidations')
+                        ).scalar() or 0
+                        seen = {row.id: row.created_at
+                                for row in connection.execute(
+                                    invalidations.select().where(
+                                        invalidations.c.created_at > since))}
+                    rows = connection.execute(
+                        invalidations.select()
+                        .where(or_(invalidations.c.id > last_id,
+                                   invalidations.c.created_at > since))
+                        .order_by(invalidations.c.id)).fetchall()
+                    connection.execute(invalidations.delete().where(
+                        invalidations.c.created_at <
+                        time.time() - self.retention))
+            except Exception:
+                logger.exception('Invalidation poller failed')
+                rows = ()
+
+            for row in rows:
+                if row.id in seen:
+                    continue
+                seen[row.id] = row.created_at
+                last_id = max(last_id, row.id)
+                callback(row.payload)
+            seen = {id: created_at for id, created_at in seen.items()
+                    if created_at > since}
+            time.sleep(self.interval)
+
+
+def init_notifications(app):
+    backend_name = app.config['NOTIFY_BACKEND']
+    if backend_name == 'auto':
+        url = app.config['SQLALCHEMY_DATABASE_URI']
+        backend_name = 'listen' if url.startswith('postgres') else 'poll'
+
+    if backend_name == 'listen':
+        backend = ListenBackend(app, app.config['NOTIFY_CHANNEL'])
+    elif backend_name == 'poll':
+        backend = PollBackend(app, app.config['NOTIFY_POLL_INTERVAL'],
+                              app.config['NOTIFY_RETENTION'])
+    else:
+        backend = None
+
+    bus = NotificationBus(app, backend)
+    if backend is not None:
+        on_write(app, bus.send, in_transaction=True)
+    on_write(app, bus.publish)
+    app.before_request(bus.ensure_started)
+    app.extensions['notifications'] = bus
+    return bus
@@ -0,0 +1,24 @@
+from flask import request
+
+
+'''
+Conditional requests
+    the ETag of a movie or an actor is its version, e.g. "3"; the version
+    of a movie also follows its cast (see models.commit_write), which
+    GET /movies/<id> includes
+    a PATCH with If-Match is only applied while the version is one of the
+    listed ones, otherwise it gets a 412 (see models.update_row)
+'''
+
+
+def if_match_versions():
+    # None when there is no precondition (no If-Match, or If-Match: *),
+    # otherwise the versions of the strong entity tags
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return [int(tag) for tag in request.if_match.as_set() if tag.isdigit()]
+
+
+def tagged(response, record):
+    response.set_etag(str(record['version']))
+    return response
@@ -0,0 +1,224 @@
+import cProfile
+import heapq
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import tempfile
+import time
+import uuid
+
+from flask import g, request
+
+from auth.auth import has_permission
+from .sqlhooks import watch_sql
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Request profiling
+    a request runs under cProfile when it is sampled (PROFILE_SAMPLE_RATE,
+    0 by default) or when it sends X-Profile: 1 with a token that has the
+    view:profiles permission; the time spent in SQL statements is recorded
+    separately, with the slowest statements
+    the profiles are files in PROFILE_DIR, of which only the latest
+    PROFILE_KEEP are kept, and the id of a profile is sent back in the
+    X-Profile-Id header of the profiled response
+    a request that is not profiled only costs a random() and a header lookup
+'''
+
+SLOWEST_STATEMENTS = 20
+STATEMENT_LENGTH = 1000
+PROFILE_ID = re.compile(r'^[0-9]+-[0-9a-f]+$')
+
+
+class RequestProfile(object):
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.profile = cProfile.Profile()
+        self.started_at = time.time()
+        self.started = None
+        self.seconds = None
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.slowest = []
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        if self.seconds is None:
+            self.profile.disable()
+            self.seconds = time.perf_counter() - self.started
+
+    def on_sql(self, statement, parameters, seconds):
+        self.sql_statements += 1
+        self.sql_seconds += seconds
+        entry = (seconds, statement[:STATEMENT_LENGTH])
+        if len(self.slowest) < SLOWEST_STATEMENTS:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def summary(self):
+        return {
+            'trigger': self.trigger,
+            'started_at': self.started_at,
+            'seconds': self.seconds,
+            'sql': {
+                'statements': self.sql_statements,
+                'seconds': self.sql_seconds,
+                'slowest': [{'statement': statement, 'seconds': seconds}
+                            for seconds, statement
+                            in sorted(self.slowest, reverse=True)]
+            }
+        }
+
+
+'''
+ProfileStore
+    a ring of profiles on disk: <id>.prof holds the cProfile stats
+    (readable with pstats or snakeviz), <id>.json the request, its timing
+    and its SQL statements
+    ids sort by creation time, saving a profile deletes the oldest ones
+    beyond keep; several workers can share the directory
+'''
+
+
+class ProfileStore(object):
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+
+    def path(self, profile_id, extension):
+        if not PROFILE_ID.match(profile_id):
+            return None
+        return os.path.join(self.directory, profile_id + extension)
+
+    def save(self, profile, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex[:8])
+        meta = dict(meta, id=profile_id, **profile.summary())
+        profile.profile.dump_stats(self.path(profile_id, '.prof'))
+        temporary = self.path(profile_id, '.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(meta, f)
+        os.replace(temporary, self.path(profile_id, '.json'))
+        self.prune()
+        return profile_id
+
+    def ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len('.json')] for name in names
+                      if name.endswith('.json'))
+
+    def prune(self):
+        ids = self.ids()
+        for profile_id in ids[:max(len(ids) - self.keep, 0)]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(self.path(profile_id, extension))
+                except FileNotFoundError:
+                    pass
+
+    def load(self, profile_id):
+        path = self.path(profile_id, '.json')
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list(self):
+        profiles = (self.load(profile_id)
+                    for profile_id in reversed(self.ids()))
+        return [profile for profile in profiles if profile is not None]
+
+    def functions(self, profile_id, limit=30):
+        # the functions with the highest cumulative time
+        stats = pstats.Stats(self.path(profile_id, '.prof'))
+        stats.sort_stats('cumulative')
+        functions = []
+        for function in stats.fcn_list[:limit]:
+            calls, total_calls, total, cumulative, callers = \
+                stats.stats[function]
+            functions.append({
+                'function': pstats.func_std_string(function),
+                'calls': total_calls,
+                'seconds': total,
+                'cumulative_seconds': cumulative
+            })
+        return functions
+
+    def stats_path(self, profile_id):
+        path = self.path(profile_id, '.prof')
+        if path is None or not os.path.exists(path):
+            return None
+        return path
+
+
+def init_profiling(app):
+    directory = app.config['PROFILE_DIR'] or os.path.join(
+        tempfile.gettempdir(), 'capstone-profiles')
+    store = ProfileStore(directory, app.config['PROFILE_KEEP'])
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    app.extensions['profiles'] = store
+
+    @app.before_request
+    def start_profile():
+        if sample_rate and random.random() < sample_rate:
+            trigger = 'sample'
+        elif request.headers.get('X-Profile') == '1' and \
+                has_permission('view:profiles'):
+            trigger = 'header'
+        else:
+            return
+
+        profile = RequestProfile(trigger)
+        try:
+            profile.start()
+        except ValueError:
+            # another profiler is active, e.g. on Python 3.12+ where there
+            # can only be one per process
+            return
+        g.profile = profile
+        watch_sql(profile.on_sql)
+
+    @app.after_request
+    def save_profile(response):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return response
+
+        profile.stop()
+        try:
+            response.headers['X-Profile-Id'] = store.save(profile, {
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'status': response.status_code
+            })
+        except OSError:
+            logger.exception('Could not save the profile')
+        return response
+
+    @app.teardown_request
+    def stop_profile(error):
+        # a request that failed with an unhandled error skips after_request
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.stop()
+
+    return store
@@ -0,0 +1,235 @@
+import threading
+from datetime import datetime, timezone
+
+from flask import abort, current_app, request
+from sqlalchemy import exists, select
+from werkzeug.http import parse_date
+
+from models import db, Movie
+
+
+'''
+Request schemas
+    a Schema is built once from its (field, coerce, required) tuples,
+    coerce turns a JSON or CSV value into the column type; validate(body)
+    returns the coerced values or raises a ValidationError, before any
+    database work
+    partial=True validates the body of a PATCH: missing, null and empty
+    fields are left out instead of being required
+'''
+
+
+MAX_AGE = 150
+
+
+class ValidationError(ValueError):
+
+    def __init__(self, message, missing=False):
+        super().__init__(message)
+        self.missing = missing
+
+
+def text(value):
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+def integer(value):
+    # 45 and "45", but not true or 4.5
+    if isinstance(value, bool) or \
+            isinstance(value, float) and not value.is_integer():
+        raise TypeError(value)
+    return int(value)
+
+
+def identifier(value):
+    # a key of a PostgreSQL integer column
+    value = integer(value)
+    if not 0 < value < 2 ** 31:
+        raise ValueError(value)
+    return value
+
+
+def age(value):
+    # in years, well within the integer column
+    value = integer(value)
+    if not 0 <= value <= MAX_AGE:
+        raise ValueError(value)
+    return value
+
+
+def timestamp(value):
+    # ISO 8601, or the HTTP date format the API responds with
+    value = text(value)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        parsed = parse_date(value)
+        if parsed is None:
+            raise
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class Schema(object):
+
+    def __init__(self, name, fields):
+        self.name = name
+        # (field, coerce, required) tuples, in the order they are checked
+        self.fields = tuple(fields)
+
+    def validate(self, body, partial=False):
+        if not isinstance(body, dict):
+            raise ValidationError('Expected a JSON object')
+
+        values = {}
+        for field, coerce, required in self.fields:
+            value = body.get(field)
+            if value is None or value == '':
+                if required and not partial:
+                    raise ValidationError('Missing field ' + field,
+                                          missing=True)
+                continue
+            try:
+                values[field] = coerce(value)
+            except (TypeError, ValueError, OverflowError):
+                raise ValidationError('Invalid ' + field)
+        return values
+
+
+MOVIE = Schema('Movie', [
+    ('title', text, True),
+    ('release_date', timestamp, True),
+])
+
+ACTOR = Schema('Actor', [
+    ('name', text, True),
+    ('age', age, True),
+    ('gender', text, True),
+    ('movie_id', identifier, True),
+])
+
+
+'''
+IdSet
+    a set of ids as a bitmap, one bit per possible id, so the ids of
+    a million movies take 125 KB and a lookup is a byte index; it can be
+    sent to a process (see the import validation in flaskr/imports.py)
+'''
+
+
+class IdSet(object):
+
+    def __init__(self, ids=()):
+        self.bits = bytearray()
+        for id in ids:
+            self.add(id)
+
+    def add(self, id):
+        byte = id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits) +
+                                   len(self.bits) // 2))
+        self.bits[byte] |= 1 << (id & 7)
+
+    def discard(self, id):
+        byte = id >> 3
+        if 0 <= byte < len(self.bits):
+            self.bits[byte] &= ~(1 << (id & 7)) & 0xff
+
+    def __contains__(self, id):
+        byte = id >> 3
+        return 0 <= byte < len(self.bits) and \
+            bool(self.bits[byte] >> (id & 7) & 1)
+
+
+def load_movie_ids():
+    return IdSet(id for id, in db.session.execute(
+        select([Movie.__table__.c.id])))
+
+
+'''
+MovieIds
+    the movie ids of the catalogue, loaded on first use and kept current
+    by the movie invalidation events of all workers
+    once loaded, an id that is not in the set is rejected without a
+    query, so unknown ids cost no database work; a movie that another
+    worker has just created is rejected until its event arrives
+    without a NOTIFY_BACKEND the events of the other workers never arrive,
+    so an unknown id is looked up in the database instead
+    a movie deleted without an event is still caught by the foreign key
+'''
+
+
+class MovieIds(object):
+
+    def __init__(self, shared):
+        # shared: the events of the other workers reach this one
+        self.shared = shared
+        self.ids = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        ids = self.ids
+        if ids is None:
+            ids = self.ids = load_movie_ids()
+        return ids
+
+    def __contains__(self, movie_id):
+        ids = self.current()
+        if movie_id in ids:
+            return True
+        if self.shared:
+            return False
+        if not db.session.query(exists().where(
+                Movie.__table__.c.id == movie_id)).scalar():
+            return False
+        with self.lock:
+            ids.add(movie_id)
+        return True
+
+    def on_event(self, event):
+        # invalidation handler, see flaskr/notifications.py
+        ids = self.ids
+        if ids is None:
+            return
+        if event.action == 'import':
+            self.ids = None
+            return
+        with self.lock:
+            if event.action == 'insert':
+                ids.add(event.id)
+            elif event.action == 'delete':
+                ids.discard(event.id)
+
+
+def validated(schema, partial=False):
+    # the coerced values of the JSON body, or a 400 error
+    body = request.get_json()
+    if body is None:
+        if not partial:
+            abort(400)
+        body = {}
+
+    try:
+        values = schema.validate(body, partial)
+    except ValidationError as error:
+        if error.missing:
+            abort(400, "Missing field for " + schema.name)
+        abort(400, str(error))
+
+    movie_id = values.get('movie_id')
+    if movie_id is not None and \
+            movie_id not in current_app.extensions['movie_ids']:
+        abort(400, "Bad formatted request due to nonexistent movie id" +
+              str(movie_id))
+    return values
+
+
+def init_schemas(app, bus):
+    movie_ids = MovieIds(bus.backend is not None)
+    bus.subscribe(movie_ids.on_event, tables=('movies',))
+    app.extensions['movie_ids'] = movie_ids
+    return movie_ids
@@ -0,0 +1,103 @@
+import copy
+import os
+
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def parse_bool(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_mapping(value):
+    return dict(item.split('=', 1) for item in parse_list(value))
+
+
+'''
+FIELDS
+    name of each setting mapped to (parser, default)
+    the environment variable and the app.config key is the upper-cased name
+'''
+FIELDS = {
+    'database_url': (str, None),
+    'db_statement_timeout': (int, 30),
+    'auth0_domain': (str, None),
+    'algorithms': (parse_list, ('RS256',)),
+    'api_audience': (str, None),
+    'jwks_ttl': (int, 600),
+    'asgi_threads': (int, 32),
+    'asgi_stream_threads': (int, 64),
+    'asgi_buffer_bytes': (int, 1024 * 1024),
+    'rate_limits': (parse_mapping, {}),
+    'rate_limit_default': (str, None),
+    'rate_limit_backend': (str, 'memory'),
+    'idempotency_ttl': (int, 24 * 60 * 60),
+    'idempotency_purge_interval': (int, 10 * 60),
+    'changes_buffer': (int, 1000),
+    'changes_heartbeat': (int, 15),
+    'notify_backend': (str, 'auto'),
+    'notify_channel': (str, 'capstone_invalidations'),
+    'notify_poll_interval': (float, 1.0),
+    'notify_retention': (int, 60 * 60),
+    'coalesce_reads': (parse_bool, True),
+    'count_exact_threshold': (int, 10000),
+    'import_batch_size': (int, 500),
+    'import_max_errors': (int, 1000),
+    'jobs_threads': (int, 4),
+    'jobs_processes': (int, 0),
+    'jobs_poll_interval': (float, 1.0),
+    'jobs_stale_after': (int, 5 * 60),
+    'jobs_max_attempts': (int, 3),
+    'jobs_spool_dir': (str, None),
+    'profile_sample_rate': (float, 0.0),
+    'profile_dir': (str, None),
+    'profile_keep': (int, 100),
+    'slow_query_threshold': (float, 0.5),
+    'slow_query_log': (str, None),
+    'query_budget_mode': (str, 'log'),
+    'cors_max_age': (int, 2 * 60 * 60),
+    'read_model': (parse_bool, False),
+    'read_model_refresh': (int, 5 * 60),
+    'warmup_budget': (float, 10.0),
+    'audit_batch_size': (int, 100),
+    'audit_flush_interval': (float, 1.0),
+    'audit_queue_size': (int, 10000),
+    'audit_block_timeout': (float, 0.1),
+}
+
+
+'''
+Settings
+    explicit configuration passed to create_app
+    nothing is read from the environment unless from_env() is called,
+    so importing the app never fails because of a missing variable
+'''
+
+
+class Settings(object):
+
+    def __init__(self, **values):
+        unknown = set(values) - set(FIELDS)
+        if unknown:
+            raise TypeError('Unknown settings: ' + ', '.join(sorted(unknown)))
+
+        for name, (parse, default) in FIELDS.items():
+            setattr(self, name, values.get(name, copy.copy(default)))
+
+    @classmethod
+    def from_env(cls, environ=None):
+        if environ is None:
+            environ = os.environ
+
+        values = {}
+        for name, (parse, default) in FIELDS.items():
+            variable = name.upper()
+            if variable in environ:
+                values[name] = parse(environ[variable])
+        return cls(**values)
+
+    def apply(self, app):
+        for name in FIELDS:
+            app.config[name.upper()] = getattr(self, name)
+        app.config['SETTINGS'] = self
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+
+from flask import has_request_context, request
+
+from models import db
+from .sqlhooks import on_sql
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Slow-query log
+    every statement that takes at least SLOW_QUERY_THRESHOLD seconds
+    (0 turns the log off) is appended to the SLOW_QUERY_LOG file as a JSON
+    line with its normalized SQL, the types of its bind parameters and the
+    route that ran it
+    statements with the same normalized SQL share a fingerprint; the plan
+    of each fingerprint is captured once per worker process with EXPLAIN,
+    which does not run the statement, and logged as a 'plan' line
+    normalizing, writing and explaining happen in a background thread, the
+    statement itself only pays for a queue put (slow statements beyond
+    QUEUE_SIZE waiting ones are dropped and counted)
+    `python manage.py slow_queries` ranks the fingerprints by total time
+'''
+
+QUEUE_SIZE = 1000
+MAX_FINGERPRINTS = 10000
+MAX_STATEMENT = 4000
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+NORMALIZATIONS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|(?<!:):\w+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE),
+     'IN (...)'),
+    (re.compile(r'\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))+'), '(...), ...'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize(statement):
+    for pattern, replacement in NORMALIZATIONS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()[:MAX_STATEMENT]
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+def parameter_shape(parameters):
+    # the types of the bind parameters, never their values
+    if isinstance(parameters, dict):
+        if len(parameters) > 20:
+            return {'count': len(parameters), 'types': sorted(set(
+                type(value).__name__ for value in parameters.values()))}
+        return {name: type(value).__name__
+                for name, value in sorted(parameters.items())}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany
+            return {'rows': len(parameters),
+                    'row': parameter_shape(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+def current_route():
+    if not has_request_context():
+        return None
+    rule = request.url_rule
+    return request.method + ' ' + (rule.rule if rule else request.path)
+
+
+class SlowQueryLog(object):
+
+    def __init__(self, app, path, threshold):
+        self.app = app
+        self.path = path
+        self.threshold = threshold
+        self.metrics = app.extensions.get('metrics')
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.explained = set()
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def observe(self, statement, parameters, seconds):
+        # SQL listener, see flaskr/sqlhooks.py
+        if seconds < self.threshold:
+            return
+        self.ensure_started()
+        try:
+            self.queue.put_nowait((time.time(), statement, parameters,
+                                   seconds, current_route()))
+        except queue.Full:
+            self.count('slow_queries.dropped')
+
+    def ensure_started(self):
+        # like the notification listener, the thread is started lazily in
+        # each worker process
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name='slow-query-log',
+                             daemon=True).start()
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            try:
+                self.record(*entry)
+            except Exception:
+                logger.exception('Could not log a slow query')
+
+    def record(self, at, statement, parameters, seconds, route):
+        normalized = normalize(statement)
+        key = fingerprint(normalized)
+        logger.warning('Slow query %s took %.3fs: %s', key, seconds,
+                       normalized[:200])
+        self.count('slow_queries.logged')
+        self.write({
+            'type': 'query',
+            'at': at,
+            'fingerprint': key,
+            'seconds': seconds,
+            'statement': normalized,
+            'parameters': parameter_shape(parameters),
+            'route': route
+        })
+
+        if key in self.explained or \
+                not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return
+        if len(self.explained) >= MAX_FINGERPRINTS:
+            self.explained.clear()
+        self.explained.add(key)
+        self.write({
+            'type': 'plan',
+            'at': time.time(),
+            'fingerprint': key,
+            'plan': self.explain(statement, parameters)
+        })
+
+    def explain(self, statement, parameters):
+        engine = db.get_engine(self.app)
+        if engine.dialect.name == 'postgresql':
+            prefix = 'EXPLAIN (ANALYZE off) '
+        elif engine.dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+        else:
+            return None
+        if isinstance(parameters, list):
+            # executemany, the plan of the first row
+            parameters = parameters[0] if parameters else ()
+
+        # a connection outside of any app context, whose statements are
+        # therefore not observed themselves
+        with engine.connect() as connection:
+            rows = connection.execute(prefix + statement,
+                                      parameters).fetchall()
+        return '\n'.join(str(row[-1]) for row in rows) or None
+
+    def write(self, entry):
+        line = json.dumps(entry) + '\n'
+        # one write of a short line to a file opened for appending, so the
+        # lines of several processes do not interleave
+        with open(self.path, 'a', encoding='utf-8') as log:
+            log.write(line)
+
+    def count(self, name):
+        if self.metrics is not None:
+            self.metrics.inc(name)
+
+
+def slow_query_report(path, limit=20):
+    # the fingerprints of the log ranked by total time, with their plans
+    queries = {}
+    plans = {}
+    with open(path, encoding='utf-8') as log:
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            key = entry['fingerprint']
+            if entry['type'] == 'plan':
+                plans[key] = entry['plan']
+                continue
+            query = queries.setdefault(key, {
+                'fingerprint': key,
+                'statement': entry['statement'],
+                'parameters': entry['parameters'],
+                'calls': 0,
+                'total_seconds': 0.0,
+                'max_seconds': 0.0,
+                'routes': set()
+            })
+            query['calls'] += 1
+            query['total_seconds'] += entry['seconds']
+            query['max_seconds'] = max(query['max_seconds'], entry['seconds'])
+            query['routes'].add(entry['route'] or '(no request)')
+
+    ranked = sorted(queries.values(), key=lambda query: query['total_seconds'],
+                    reverse=True)[:limit]
+    for query in ranked:
+        query['mean_seconds'] = query['total_seconds'] / query['calls']
+        query['routes'] = sorted(query['routes'])
+        query['plan'] = plans.get(query['fingerprint'])
+    return ranked
+
+
+def slow_query_log_path(config):
+    return config['SLOW_QUERY_LOG'] or os.path.join(
+        tempfile.gettempdir(), 'capstone-slow-queries.jsonl')
+
+
+def init_slow_query_log(app):
+    threshold = app.config['SLOW_QUERY_THRESHOLD']
+    if threshold <= 0:
+        return None
+    log = SlowQueryLog(app, slow_query_log_path(app.config), threshold)
+    on_sql(app, log.observe)
+    app.extensions['slow_queries'] = log
+    return log
@@ -0,0 +1,567 @@
+import bisect
+import copy
+import logging
+import sys
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, select
+
+from models import db, Movie, Actor, castings, select_row
+from .listing import EXACT, integer_arg, page_bounds
+from .schemas import timestamp
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Read model
+    with READ_MODEL on, every worker keeps the whole catalogue in memory as
+    an immutable Snapshot and serves the read endpoints of movies, actors
+    and casts from it, without database work
+    a snapshot is loaded on the first read; write events of all workers
+    (see flaskr/notifications.py) are applied to a copy of it, which then
+    replaces it with a single reference assignment, so a request always
+    reads one consistent snapshot and never waits for a writer
+    READ_MODEL_REFRESH seconds after it was loaded, the snapshot is loaded
+    again in a background thread, which repairs anything an event did not
+    reach (e.g. a lost notification)
+    GET /metrics reports the size of the snapshot (read_model.bytes) and
+    how old it is (read_model.age_seconds since it was loaded,
+    read_model.event_age_seconds since the last event was applied)
+'''
+
+
+class MovieRecord(object):
+    __slots__ = ('id', 'title', 'release_date', 'version')
+
+    def __init__(self, id, title, release_date, version):
+        self.id = id
+        self.title = title
+        self.release_date = release_date
+        self.version = version
+
+    @classmethod
+    def from_row(cls, row):
+        release_date = row['release_date']
+        # events of other workers carry dates as JSON strings
+        if isinstance(release_date, str):
+            release_date = timestamp(release_date)
+        return cls(row['id'], row['title'], release_date, row['version'])
+
+    def format(self):
+        return {
+            'id': self.id,
+            'title': self.title,
+            'release_date': self.release_date,
+            'version': self.version
+        }
+
+
+class ActorRecord(object):
+    __slots__ = ('id', 'name', 'age', 'gender', 'movie_id', 'version')
+
+    def __init__(self, id, name, age, gender, movie_id, version):
+        self.id = id
+        self.name = name
+        self.age = age
+        self.gender = gender
+        self.movie_id = movie_id
+        self.version = version
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['name'], row['age'], row['gender'],
+                   row['movie_id'], row['version'])
+
+    def format(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'age': self.age,
+            'gender': self.gender,
+            'movie_id': self.movie_id,
+            'version': self.version
+        }
+
+
+def contains(value, part):
+    # the ILIKE '%part%' of flaskr/listing.py
+    return value is not None and part.lower() in value.lower()
+
+
+def page(records, args):
+    bounds = page_bounds(args)
+    if bounds is None:
+        return records
+    offset, limit = bounds
+    return records[offset:offset + limit]
+
+
+'''
+Snapshot
+    movies and actors by id, their ids in order, the movie ids by release
+    year, the actor ids by movie_id, and the castings both as the cast of
+    every movie and the parts of every actor, as (id, role) ordered by id
+    the methods answer the read endpoints with the same dicts as the
+    database queries; nothing is changed once a snapshot is built, a
+    Builder makes the next one
+'''
+
+INDEXES = ('movies', 'actors', 'movie_ids', 'actor_ids', 'movies_by_year',
+           'actors_by_movie', 'cast', 'parts')
+
+
+class Snapshot(object):
+
+    def __init__(self, built_at, updated_at, **indexes):
+        for name in INDEXES:
+            setattr(self, name, indexes[name])
+        self.built_at = built_at
+        self.updated_at = updated_at
+        self.size = None
+
+    @classmethod
+    def build(cls, movies, actors, roles, built_at):
+        # roles maps (movie_id, actor_id) to the role of the casting
+        movies_by_year, actors_by_movie, cast, parts = {}, {}, {}, {}
+        movie_ids = sorted(movies)
+        for id in movie_ids:
+            if movies[id].release_date is not None:
+                movies_by_year.setdefault(
+                    movies[id].release_date.year, []).append(id)
+        actor_ids = sorted(actors)
+        for id in actor_ids:
+            if actors[id].movie_id is not None:
+                actors_by_movie.setdefault(actors[id].movie_id, []).append(id)
+        for (movie_id, actor_id), role in sorted(roles.items()):
+            cast.setdefault(movie_id, []).append((actor_id, role))
+            parts.setdefault(actor_id, []).append((movie_id, role))
+        return cls(built_at, built_at, movies=movies, actors=actors,
+                   movie_ids=movie_ids, actor_ids=actor_ids,
+                   movies_by_year=frozen(movies_by_year),
+                   actors_by_movie=frozen(actors_by_movie),
+                   cast=frozen(cast), parts=frozen(parts))
+
+    def movie(self, id):
+        record = self.movies.get(id)
+        if record is None:
+            return None
+        movie = record.format()
+        movie['actors'] = [self.actors[actor_id].format()
+                           for actor_id, role in self.cast.get(id, ())]
+        return movie
+
+    def actor(self, id):
+        record = self.actors.get(id)
+        return None if record is None else record.format()
+
+    def list_movies(self, args):
+        # the movies of GET /movies and the (total, kind) of their count
+        title = args.get('title')
+        year = integer_arg(args, 'year')
+        ids = self.movie_ids if year is None \
+            else self.movies_by_year.get(year, ())
+        if title:
+            ids = [id for id in ids if contains(self.movies[id].title, title)]
+        return [self.movie(id) for id in page(ids, args)], (len(ids), EXACT)
+
+    def list_actors(self, args):
+        name = args.get('name')
+        gender = args.get('gender')
+        min_age = integer_arg(args, 'min_age')
+        max_age = integer_arg(args, 'max_age')
+        tests = []
+        if name:
+            tests.append(lambda actor: contains(actor.name, name))
+        if gender:
+            tests.append(lambda actor: actor.gender == gender)
+        if min_age is not None:
+            tests.append(lambda actor: actor.age is not None and
+                         actor.age >= min_age)
+        if max_age is not None:
+            tests.append(lambda actor: actor.age is not None and
+                         actor.age <= max_age)
+        ids = self.actor_ids
+        if tests:
+            ids = [id for id in ids
+                   if all(test(self.actors[id]) for test in tests)]
+        return [self.actors[id].format() for id in page(ids, args)], \
+            (len(ids), EXACT)
+
+    def movie_cast(self, id):
+        # as Movie.cast_by_id
+        if id not in self.movies:
+            return None
+        actors = []
+        for actor_id, role in self.cast.get(id, ()):
+            actor = self.actors[actor_id].format()
+            actor['role'] = role
+            actors.append(actor)
+        return actors
+
+    def actor_movies(self, id):
+        # as Actor.movies_by_id
+        if id not in self.actors:
+            return None
+        movies = []
+        for movie_id, role in self.parts.get(id, ()):
+            movie = self.movies[movie_id].format()
+            movie['role'] = role
+            movies.append(movie)
+        return movies
+
+    def memory_size(self):
+        # bytes of the records, their strings and the indexes, computed once
+        if self.size is None:
+            size = 0
+            for records in (self.movies, self.actors):
+                size += sys.getsizeof(records)
+                for record in records.values():
+                    size += sys.getsizeof(record)
+                    for name in record.__slots__:
+                        value = getattr(record, name)
+                        if isinstance(value, (str, datetime)):
+                            size += sys.getsizeof(value)
+            for index in (self.movies_by_year, self.actors_by_movie,
+                          self.cast, self.parts):
+                size += sys.getsizeof(index)
+                for entries in index.values():
+                    size += sys.getsizeof(entries)
+                    if entries and isinstance(entries[0], tuple):
+                        size += sum(map(sys.getsizeof, entries))
+            size += sys.getsizeof(self.movie_ids) + \
+                sys.getsizeof(self.actor_ids)
+            self.size = size
+        return self.size
+
+
+def frozen(index):
+    return {key: tuple(values) for key, values in index.items()}
+
+
+def with_item(items, item, key=None):
+    # the sorted tuple items with item added, replacing the one with the
+    # same key (the first element of (id, role) entries)
+    items = [other for other in items
+             if (other if key is None else key(other)) !=
+             (item if key is None else key(item))]
+    bisect.insort(items, item)
+    return tuple(items)
+
+
+def without_item(items, item, key=None):
+    return tuple(other for other in items
+                 if (other if key is None else key(other)) != item)
+
+
+def first(entry):
+    return entry[0]
+
+
+'''
+Builder
+    makes the next snapshot from the indexes of the current one, updating
+    only the entries a write changes
+    an index is copied (a shallow copy, the records and tuples are shared)
+    when the builder first uses it, the others are the current snapshot's;
+    an event still costs a copy of every index it touches, O(movies) or
+    O(actors), which is what keeps the snapshots immutable without
+    persistent data structures; current() reads an index without copying it
+    deleting an actor removes its castings; deleting a movie removes its
+    castings and clears or deletes the actors created for it, following the
+    movie_delete rule of the migrations, which the caller tells by reading
+    those actors again (see delete_movie())
+'''
+
+
+class Builder(object):
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.built_at = snapshot.built_at
+
+    def __getattr__(self, name):
+        # the first use of an index, see the docstring
+        if name not in INDEXES:
+            raise AttributeError(name)
+        index = copy.copy(getattr(self.snapshot, name))
+        setattr(self, name, index)
+        return index
+
+    def current(self, name):
+        return vars(self).get(name, getattr(self.snapshot, name))
+
+    def update(self, index, key, items):
+        if items:
+            index[key] = items
+        else:
+            index.pop(key, None)
+
+    def put_movie(self, row):
+        record = MovieRecord.from_row(row)
+        old = self.movies.get(record.id)
+        self.movies[record.id] = record
+        if old is None:
+            bisect.insort(self.movie_ids, record.id)
+        else:
+            self.move(self.movies_by_year, record.id, year(old))
+        self.move(self.movies_by_year, record.id, None, year(record))
+
+    def delete_movie(self, id, kept_actors):
+        # kept_actors are the rows of the actors created for the movie that
+        # the deletion cleared, by id; the others were deleted with it
+        old = self.movies.pop(id, None)
+        if old is None:
+            return
+        del self.movie_ids[bisect.bisect_left(self.movie_ids, id)]
+        self.move(self.movies_by_year, id, year(old))
+        for actor_id, role in self.cast.pop(id, ()):
+            self.update(self.parts, actor_id,
+                        without_item(self.parts[actor_id], id, first))
+        for actor_id in self.actors_by_movie.pop(id, ()):
+            row = kept_actors.get(actor_id)
+            if row is None:
+                self.delete_actor(actor_id)
+            else:
+                self.put_actor(row)
+
+    def put_actor(self, row):
+        record = ActorRecord.from_row(row)
+        old = self.actors.get(record.id)
+        self.actors[record.id] = record
+        if old is None:
+            bisect.insort(self.actor_ids, record.id)
+        else:
+            self.move(self.actors_by_movie, record.id, old.movie_id)
+        self.move(self.actors_by_movie, record.id, None, record.movie_id)
+
+    def delete_actor(self, id):
+        old = self.actors.pop(id, None)
+        if old is None:
+            return
+        del self.actor_ids[bisect.bisect_left(self.actor_ids, id)]
+        self.move(self.actors_by_movie, id, old.movie_id)
+        for movie_id, role in self.parts.pop(id, ()):
+            self.update(self.cast, movie_id,
+                        without_item(self.cast[movie_id], id, first))
+
+    def move(self, index, id, old_key, new_key=None):
+        # takes id out of the ids of old_key and adds it to new_key's
+        if old_key is not None:
+            self.update(index, old_key,
+                        without_item(index.get(old_key, ()), id))
+        if new_key is not None:
+            index[new_key] = with_item(index.get(new_key, ()), id)
+
+    def put_casting(self, row):
+        movie_id, actor_id = row['movie_id'], row['actor_id']
+        if movie_id not in self.current('movies') or \
+                actor_id not in self.current('actors'):
+            return
+        self.cast[movie_id] = with_item(
+            self.cast.get(movie_id, ()), (actor_id, row.get('role')), first)
+        self.parts[actor_id] = with_item(
+            self.parts.get(actor_id, ()), (movie_id, row.get('role')), first)
+
+    def delete_casting(self, row):
+        movie_id, actor_id = row['movie_id'], row['actor_id']
+        self.update(self.cast, movie_id,
+                    without_item(self.cast.get(movie_id, ()), actor_id, first))
+        self.update(self.parts, actor_id,
+                    without_item(self.parts.get(actor_id, ()), movie_id,
+                                 first))
+
+    def build(self):
+        return Snapshot(self.built_at, time.time(),
+                        **{name: self.current(name) for name in INDEXES})
+
+
+def year(movie):
+    return None if movie.release_date is None else movie.release_date.year
+
+
+def load_snapshot():
+    now = time.time()
+    movies = {row['id']: MovieRecord.from_row(row)
+              for row in db.session.execute(Movie.__table__.select())}
+    actors = {row['id']: ActorRecord.from_row(row)
+              for row in db.session.execute(Actor.__table__.select())}
+    roles = {(row.movie_id, row.actor_id): row.role
+             for row in db.session.execute(castings.select())}
+    db.session.commit()
+    return Snapshot.build(movies, actors, roles, now)
+
+
+MOVIE_FIELDS = {'id', 'title', 'release_date', 'version'}
+ACTOR_FIELDS = {'id', 'name', 'age', 'gender', 'movie_id', 'version'}
+
+
+def complete_row(table, event, fields):
+    # the record of the event, or the row itself when the event was
+    # trimmed to the id (see notifications.encode); None if it is gone
+    if fields <= set(event.record):
+        return event.record
+    return select_row(table, event.id)
+
+
+def delete_movie(builder, id):
+    # the actors created for the movie are read again: the ones left were
+    # cleared by the deletion, the others deleted with it
+    actors = Actor.__table__
+    actor_ids = builder.current('actors_by_movie').get(id, ())
+    kept = {}
+    if actor_ids:
+        kept = {row['id']: row for row in db.session.execute(
+            actors.select().where(actors.c.id.in_(actor_ids)))}
+    builder.delete_movie(id, kept)
+
+
+def apply_event(builder, event):
+    movies = Movie.__table__
+    actors = Actor.__table__
+    if event.action == 'import':
+        # a committed import batch, only its id range is known
+        table = movies if event.table == 'movies' else actors
+        rows = db.session.execute(table.select().where(and_(
+            table.c.id >= event.record['min_id'],
+            table.c.id <= event.record['max_id']))).fetchall()
+        put = builder.put_movie if table is movies else builder.put_actor
+        for row in rows:
+            put(row)
+        if table is actors:
+            for row in db.session.execute(castings.select().where(
+                    castings.c.actor_id.in_(
+                        select([actors.c.id]).where(and_(
+                            actors.c.id >= event.record['min_id'],
+                            actors.c.id <= event.record['max_id']))))):
+                # put_casting takes the records of castings events, dicts
+                builder.put_casting(dict(row))
+        db.session.commit()
+    elif event.table == 'castings':
+        if event.action == 'delete':
+            builder.delete_casting(event.record)
+        else:
+            builder.put_casting(event.record)
+    elif event.action == 'delete':
+        if event.table == 'movies':
+            delete_movie(builder, event.id)
+        else:
+            builder.delete_actor(event.id)
+    elif event.table == 'movies':
+        row = complete_row(movies, event, MOVIE_FIELDS)
+        if row is None:
+            delete_movie(builder, event.id)
+        else:
+            builder.put_movie(row)
+    else:
+        row = complete_row(actors, event, ACTOR_FIELDS)
+        if row is None:
+            builder.delete_actor(event.id)
+        else:
+            builder.put_actor(row)
+
+
+'''
+ReadModel
+    holds the current snapshot of the worker, see current()
+    events are applied under the lock, in the order they arrive; while a
+    refresh loads a new snapshot, they are also kept and applied again to
+    the loaded one before it replaces the current snapshot
+'''
+
+
+class ReadModel(object):
+
+    def __init__(self, app, refresh):
+        self.app = app
+        self.refresh = refresh
+        self.snapshot = None
+        self.replay = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                if self.snapshot is None:
+                    self.snapshot = load_snapshot()
+                snapshot = self.snapshot
+        elif time.time() - snapshot.built_at > self.refresh and \
+                self.replay is None:
+            self.start_refresh()
+        return snapshot
+
+    def on_event(self, event):
+        # invalidation handler, see flaskr/notifications.py
+        with self.lock:
+            if self.replay is not None:
+                self.replay.append(event)
+            if self.snapshot is not None:
+                self.snapshot = self.applied(self.snapshot, [event])
+
+    def applied(self, snapshot, events):
+        builder = Builder(snapshot)
+        for event in events:
+            try:
+                apply_event(builder, event)
+            except Exception:
+                db.session.rollback()
+                logger.exception('Could not apply %s.%s to the read model',
+                                 event.table, event.action)
+        return builder.build()
+
+    def start_refresh(self):
+        with self.lock:
+            if self.replay is not None:
+                return
+            self.replay = []
+        threading.Thread(target=self.run_refresh, name='read-model-refresh',
+                         daemon=True).start()
+
+    def run_refresh(self):
+        try:
+            with self.app.app_context():
+                snapshot = load_snapshot()
+                with self.lock:
+                    if self.replay:
+                        snapshot = self.applied(snapshot, self.replay)
+                    self.snapshot = snapshot
+        except Exception:
+            logger.exception('Could not refresh the read model')
+        finally:
+            with self.lock:
+                self.replay = None
+
+    def gauges(self):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return {}
+        now = time.time()
+        return {
+            'read_model.bytes': snapshot.memory_size(),
+            'read_model.movies': len(snapshot.movies),
+            'read_model.actors': len(snapshot.actors),
+            'read_model.age_seconds': round(now - snapshot.built_at, 3),
+            'read_model.event_age_seconds': round(
+                now - snapshot.updated_at, 3)
+        }
+
+
+def read_snapshot():
+    # the snapshot to serve a read from, or None without READ_MODEL
+    model = current_app.extensions.get('read_model')
+    return None if model is None else model.current()
+
+
+def init_read_model(app, bus):
+    if not app.config['READ_MODEL']:
+        return None
+    model = ReadModel(app, app.config['READ_MODEL_REFRESH'])
+    bus.subscribe(model.on_event, tables=('movies', 'actors', 'castings'))
+    app.extensions['metrics'].collect(model.gauges)
+    app.extensions['read_model'] = model
+    return model
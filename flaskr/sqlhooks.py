@@ -0,0 +1,47 @@
+import time
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+SQL hooks
+    time every statement SQLAlchemy sends to the database
+    on_sql(app, listener) calls listener(statement, parameters, seconds)
+    after every statement of the app, in requests, jobs and commands
+    watch_sql(observer) does the same for the statements of the current
+    request (or app context) only, until unwatch_sql(observer)
+'''
+
+
+def on_sql(app, listener):
+    app.extensions.setdefault('sql_listeners', []).append(listener)
+
+
+def watch_sql(observer):
+    g.setdefault('sql_observers', []).append(observer)
+
+
+def unwatch_sql(observer):
+    g.sql_observers.remove(observer)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_timer(connection, cursor, statement, parameters, context,
+                executemany):
+    connection.info['statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_timer(connection, cursor, statement, parameters, context,
+               executemany):
+    if not has_app_context():
+        return
+    observers = current_app.extensions.get('sql_listeners', []) + \
+        g.get('sql_observers', [])
+    if not observers:
+        return
+    seconds = time.perf_counter() - connection.info['statement_started']
+    for observer in observers:
+        observer(statement, parameters, seconds)
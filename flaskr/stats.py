@@ -0,0 +1,85 @@
+from sqlalchemy import BigInteger, Integer, String, case, cast, func, \
+    literal, select, union_all
+
+from models import db, Movie, Actor, castings, catalogue_stats
+
+
+'''
+Catalogue statistics
+    on PostgreSQL the catalogue_stats table holds one counter per
+    (metric, bucket) and is kept current by triggers on movies, actors and
+    castings (see the catalogue_stats, castings and catalogue_stats_slots
+    migrations), so reading the statistics costs the same for any catalogue
+    size; a counter is spread over up to 16 slots, picked by the backend
+    of the writing connection, so that concurrent writes do not queue on
+    one row, and is read as their sum; rebuild_stats() recomputes the
+    counters from scratch, e.g. after a bulk load with triggers disabled
+    other databases compute the same rows with aggregate queries
+'''
+
+
+def stats_query():
+    movies = Movie.__table__
+    actors = Actor.__table__
+    age_bucket = case(
+        [(actors.c.age.is_(None), 'unknown')],
+        else_=cast(actors.c.age / 10 * 10, String) + '-' +
+        cast(actors.c.age / 10 * 10 + 9, String))
+    gender = func.coalesce(actors.c.gender, 'unknown')
+    year = func.coalesce(cast(cast(
+        func.extract('year', movies.c.release_date), Integer), String),
+        'unknown')
+
+    return union_all(
+        select([literal('movies').label('metric'),
+                literal('').label('bucket'),
+                func.count().label('value')]).select_from(movies),
+        select([literal('actors'), literal(''), func.count()])
+        .select_from(actors),
+        select([literal('cast_actors'), literal(''), func.count()])
+        .select_from(castings),
+        select([literal('actors_by_gender'), gender, func.count()])
+        .group_by(gender),
+        select([literal('actors_by_age'), age_bucket, func.count()])
+        .group_by(age_bucket),
+        select([literal('releases_by_year'), year, func.count()])
+        .group_by(year),
+    )
+
+
+def maintained_by_triggers():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def rebuild_stats():
+    db.session.execute(catalogue_stats.delete())
+    db.session.execute(catalogue_stats.insert().from_select(
+        ['metric', 'bucket', 'value'], stats_query()))
+    db.session.commit()
+
+
+def read_stats():
+    if maintained_by_triggers():
+        value = cast(func.sum(catalogue_stats.c.value), BigInteger)
+        rows = db.session.execute(
+            select([catalogue_stats.c.metric, catalogue_stats.c.bucket,
+                    value])
+            .group_by(catalogue_stats.c.metric, catalogue_stats.c.bucket)
+            .having(value != 0)).fetchall()
+    else:
+        rows = db.session.execute(stats_query()).fetchall()
+
+    counters = {}
+    for metric, bucket, value in rows:
+        counters.setdefault(metric, {})[bucket] = value
+
+    movies = counters.get('movies', {}).get('', 0)
+    cast_actors = counters.get('cast_actors', {}).get('', 0)
+    return {
+        'movies': movies,
+        'actors': counters.get('actors', {}).get('', 0),
+        'actors_per_movie': round(cast_actors / movies, 2) if movies else 0,
+        'actors_by_gender': counters.get('actors_by_gender', {}),
+        'actors_by_age': counters.get('actors_by_age', {}),
+        'releases_per_year': counters.get('releases_by_year', {})
+    }
@@ -0,0 +1,146 @@
+import logging
+import os
+import threading
+import time
+
+from werkzeug.datastructures import MultiDict
+
+from auth.auth import get_jwks
+from models import db, Movie, Actor
+from .documents import movie_page
+from .listing import count_rows
+from .stats import read_stats
+
+
+logger = logging.getLogger(__name__)
+
+
+'''
+Warm-up
+    a new worker prepares what its first requests would otherwise wait
+    for, in a background thread: the JWKS of AUTH0_DOMAIN, the connections
+    of the database pool, the in-process state (movie ids, read model,
+    invalidation listener) and the first pages of the hot reads
+    GET /ready answers 503 until the warm-up is done, or until
+    WARMUP_BUDGET seconds have passed, so a slow step delays the worker
+    by at most that long; steps not started by then are skipped
+    the warm-up starts in the gunicorn post_fork hook, when the ASGI app is
+    created or on the first GET /ready, once in every worker process
+'''
+
+
+def warm_jwks(app, remaining):
+    if not app.config['AUTH0_DOMAIN']:
+        return 'no AUTH0_DOMAIN'
+    get_jwks(app.config['AUTH0_DOMAIN'], app.config['JWKS_TTL'],
+             timeout=remaining)
+
+
+def warm_pool(app, remaining):
+    # checks out as many connections as the pool keeps, all at once,
+    # so that each of them is opened
+    engine = db.get_engine(app)
+    size = engine.pool.size() if hasattr(engine.pool, 'size') else 1
+    connections = []
+    try:
+        for _ in range(size):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.scalar('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
+    return 'pool size {}'.format(size)
+
+
+def warm_state(app, remaining):
+    app.extensions['movie_ids'].current()
+    if 'read_model' in app.extensions:
+        app.extensions['read_model'].current()
+    app.extensions['notifications'].ensure_started()
+
+
+def warm_queries(app, remaining):
+    args = MultiDict({'page': '1', 'per_page': '10'})
+    threshold = app.config['COUNT_EXACT_THRESHOLD']
+    movie_page([], args)
+    count_rows(Movie.__table__, [], threshold)
+    Actor.query.order_by(Actor.id).limit(10).all()
+    count_rows(Actor.__table__, [], threshold)
+    read_stats()
+    db.session.commit()
+
+
+STEPS = (
+    ('jwks', warm_jwks),
+    ('database_pool', warm_pool),
+    ('state', warm_state),
+    ('queries', warm_queries)
+)
+
+
+class Warmup(object):
+
+    def __init__(self, app, budget):
+        self.app = app
+        self.budget = budget
+        self.pid = None
+        self.started_at = None
+        self.steps = {}
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.started_at = time.monotonic()
+            self.steps = {name: 'pending' for name, step in STEPS}
+            self.done = threading.Event()
+            threading.Thread(target=self.run, name='warmup',
+                             daemon=True).start()
+
+    def run(self):
+        deadline = self.started_at + self.budget
+        with self.app.app_context():
+            for name, step in STEPS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.steps[name] = 'skipped'
+                    continue
+                self.steps[name] = 'running'
+                started_at = time.monotonic()
+                try:
+                    note = step(self.app, remaining)
+                except Exception as error:
+                    db.session.rollback()
+                    logger.warning('Warm-up step %s failed: %s', name, error)
+                    self.steps[name] = 'failed: ' + str(error)
+                    continue
+                self.steps[name] = 'done in {:.3f}s'.format(
+                    time.monotonic() - started_at)
+                if note:
+                    self.steps[name] += ', ' + note
+            db.session.remove()
+        self.app.extensions['metrics'].set(
+            'warmup.seconds', round(time.monotonic() - self.started_at, 3))
+        self.done.set()
+
+    def status(self):
+        self.start()
+        elapsed = time.monotonic() - self.started_at
+        return {
+            'ready': self.done.is_set() or elapsed >= self.budget,
+            'warmed_up': self.done.is_set(),
+            'seconds': round(elapsed, 3),
+            'steps': dict(self.steps)
+        }
+
+
+def init_warmup(app):
+    warmup = Warmup(app, app.config['WARMUP_BUDGET'])
+    app.extensions['warmup'] = warmup
+    return warmup
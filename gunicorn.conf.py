@@ -0,0 +1,74 @@
+# Gunicorn configuration, used by the Procfile:
+#   gunicorn -c gunicorn.conf.py 'flaskr:create_app()'
+#
+# The defaults were picked with benchmarks/gunicorn_matrix.py, the
+# environment variables below override them.
+import os
+
+from flaskr.settings import Settings
+
+
+def available_cores():
+    # the cores this process may run on, not all the cores of the host
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# A request mostly waits for PostgreSQL, Auth0 or the client, so every
+# worker process runs several requests in threads (gthread); two processes
+# per core keep the CPU busy while a thread of one of them holds the GIL.
+# More threads kept paying off in the matrix, but every thread may hold a
+# database connection; 8 stays within the pool of a worker (5 connections
+# and 10 overflow).
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Besides its threads, a worker holds up to 3 connections of its own: the
+# LISTEN connection of the invalidation listener, the audit log flusher
+# and the read model refresh (the warm-up only uses pool connections
+# before the worker is ready). The default number of workers keeps all of
+# them within DB_MAX_CONNECTIONS (PostgreSQL's max_connections, default
+# 100) less 20 for the job workers, migrations and psql: 7 workers of 8
+# threads at most.
+# WEB_CONCURRENCY, which Heroku sets from the dyno size, overrides it.
+connections_per_worker = threads + 3
+max_workers = max(1, (int(os.environ.get('DB_MAX_CONNECTIONS', 100)) - 20)
+                  // connections_per_worker)
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             min(available_cores() * 2, max_workers)))
+
+# A GET /changes subscriber keeps one of the threads of its worker for as
+# long as the stream stays open: at most workers * threads subscribers and
+# requests are served at once. Serve the change feed from the ASGI app
+# (flaskr/asgi.py) when there are more than a few subscribers.
+
+# Recycle workers to bound slow memory growth; the jitter keeps all
+# workers from restarting at the same moment.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER',
+                                         max_requests // 10))
+
+# PostgreSQL cancels a statement after DB_STATEMENT_TIMEOUT seconds, so a
+# request is given that long and a margin before its worker is killed, and
+# a worker stopping (max_requests, deploys) as long to finish its requests.
+statement_timeout = Settings.from_env().db_statement_timeout or 30
+timeout = statement_timeout + 10
+graceful_timeout = statement_timeout + 10
+# connections are reused by the router in front of the app
+keepalive = 5
+
+# Build the app once in the master and fork workers from it,
+# instead of importing and creating the app again in every worker.
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Connections opened by the master must not be shared between
+    # the forked workers, each worker starts with an empty pool.
+    from models import dispose_engines
+    app = server.app.wsgi()
+    dispose_engines(app)
+    # GET /ready answers 503 until the worker is warmed up
+    app.extensions['warmup'].start()
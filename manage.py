@@ -1,15 +1,73 @@
+import json
+
 from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import MigrateCommand
 
 from flaskr import create_app
-from models import db
+from flaskr.documents import check_documents as check_movie_documents, \
+    rebuild_documents as rebuild_movie_documents
+from flaskr.jobs import Worker
+from flaskr.slowlog import slow_query_log_path, slow_query_report
+from flaskr.stats import rebuild_stats as rebuild
 
 app = create_app()
-migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def rebuild_stats():
+    """Recompute the catalogue_stats counters from the tables"""
+    rebuild()
+
+
+@manager.command
+def rebuild_documents():
+    """Regenerate the movie_documents of all movies"""
+    print('{} documents rebuilt'.format(rebuild_movie_documents()))
+
+
+@manager.command
+def check_documents():
+    """Report movies whose document is missing or outdated"""
+    report = check_movie_documents()
+    print('{} movies, {} documents missing, {} outdated'.format(
+        report['movies'], len(report['missing']), len(report['outdated'])))
+    for kind in ('missing', 'outdated'):
+        if report[kind]:
+            print(kind + ': ' + ' '.join(map(str, report[kind][:100])))
+    if report['missing'] or report['outdated']:
+        raise SystemExit(1)
+
+
+@manager.command
+def purge_idempotency_keys():
+    """Delete the expired idempotency keys"""
+    purged = app.extensions['idempotency'].purge()
+    print('{} expired idempotency keys deleted'.format(purged))
+
+
+@manager.command
+def worker():
+    """Run queued background jobs until stopped"""
+    Worker(app).run()
+
+
+@manager.option('-l', '--limit', dest='limit', type=int, default=20)
+def slow_queries(limit):
+    """Rank the statements of the slow-query log by total time"""
+    for query in slow_query_report(slow_query_log_path(app.config), limit):
+        print('{fingerprint}  {total_seconds:.3f}s total  {calls} calls  '
+              '{mean_seconds:.3f}s mean  {max_seconds:.3f}s max'
+              .format(**query))
+        print('    ' + query['statement'])
+        print('    parameters: ' + json.dumps(query['parameters']))
+        print('    routes: ' + ', '.join(query['routes']))
+        for line in (query['plan'] or '(no plan)').split('\n'):
+            print('    | ' + line)
+        print()
+
+
 if __name__ == '__main__':
     manager.run()
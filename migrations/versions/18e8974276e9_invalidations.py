@@ -0,0 +1,33 @@
+"""invalidation events of the polling notification backend
+
+Revision ID: 18e8974276e9
+Revises: 90d9038dc8ad
+Create Date: 2026-10-19 10:02:17.540921
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '18e8974276e9'
+down_revision = '90d9038dc8ad'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('invalidations',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('payload', sa.String(), nullable=False),
+                    sa.Column('created_at', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_invalidations_created_at'), 'invalidations',
+                    ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_invalidations_created_at'),
+                  table_name='invalidations')
+    op.drop_table('invalidations')
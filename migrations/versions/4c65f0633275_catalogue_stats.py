@@ -0,0 +1,135 @@
+"""catalogue statistics maintained by triggers
+
+Revision ID: 4c65f0633275
+Revises: 18e8974276e9
+Create Date: 2026-10-19 10:48:51.203377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c65f0633275'
+down_revision = '18e8974276e9'
+branch_labels = None
+depends_on = None
+
+
+FUNCTIONS = """
+CREATE FUNCTION catalogue_stats_bump(p_metric text, p_bucket text,
+                                     p_delta bigint) RETURNS void AS $$
+BEGIN
+    INSERT INTO catalogue_stats (metric, bucket, value)
+    VALUES (p_metric, p_bucket, p_delta)
+    ON CONFLICT (metric, bucket)
+    DO UPDATE SET value = catalogue_stats.value + EXCLUDED.value;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION catalogue_stats_age_bucket(p_age integer) RETURNS text AS $$
+    SELECT CASE WHEN p_age IS NULL THEN 'unknown'
+           ELSE (p_age / 10 * 10)::text || '-' || (p_age / 10 * 10 + 9)::text
+           END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION catalogue_stats_year(p_date timestamp) RETURNS text AS $$
+    SELECT coalesce(extract(year FROM p_date)::integer::text, 'unknown')
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE FUNCTION catalogue_stats_actors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM catalogue_stats_bump('actors', '', -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(OLD.gender, 'unknown'), -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(OLD.age), -1);
+        IF OLD.movie_id IS NOT NULL THEN
+            PERFORM catalogue_stats_bump('cast_actors', '', -1);
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM catalogue_stats_bump('actors', '', 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(NEW.gender, 'unknown'), 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(NEW.age), 1);
+        IF NEW.movie_id IS NOT NULL THEN
+            PERFORM catalogue_stats_bump('cast_actors', '', 1);
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION catalogue_stats_movies() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM catalogue_stats_bump('movies', '', -1);
+        PERFORM catalogue_stats_bump(
+            'releases_by_year', catalogue_stats_year(OLD.release_date), -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM catalogue_stats_bump('movies', '', 1);
+        PERFORM catalogue_stats_bump(
+            'releases_by_year', catalogue_stats_year(NEW.release_date), 1);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+TRIGGERS = """
+CREATE TRIGGER catalogue_stats_actors
+    AFTER INSERT OR DELETE OR UPDATE OF age, gender, movie_id ON actors
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_stats_actors();
+
+CREATE TRIGGER catalogue_stats_movies
+    AFTER INSERT OR DELETE OR UPDATE OF release_date ON movies
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_stats_movies();
+"""
+
+INITIAL_COUNTERS = """
+INSERT INTO catalogue_stats (metric, bucket, value)
+SELECT 'movies', '', count(*) FROM movies
+UNION ALL
+SELECT 'actors', '', count(*) FROM actors
+UNION ALL
+SELECT 'cast_actors', '', count(movie_id) FROM actors
+UNION ALL
+SELECT 'actors_by_gender', coalesce(gender, 'unknown'), count(*)
+FROM actors GROUP BY 2
+UNION ALL
+SELECT 'actors_by_age', catalogue_stats_age_bucket(age), count(*)
+FROM actors GROUP BY 2
+UNION ALL
+SELECT 'releases_by_year', catalogue_stats_year(release_date), count(*)
+FROM movies GROUP BY 2;
+"""
+
+
+def upgrade():
+    op.create_table('catalogue_stats',
+                    sa.Column('metric', sa.String(), nullable=False),
+                    sa.Column('bucket', sa.String(), nullable=False),
+                    sa.Column('value', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('metric', 'bucket')
+                    )
+    op.execute(FUNCTIONS)
+    # the tables are locked so that no write is missed between
+    # the initial counts and the triggers
+    op.execute('LOCK TABLE movies, actors IN SHARE MODE')
+    op.execute(TRIGGERS)
+    op.execute(INITIAL_COUNTERS)
+
+
+def downgrade():
+    op.execute('DROP TRIGGER catalogue_stats_movies ON movies')
+    op.execute('DROP TRIGGER catalogue_stats_actors ON actors')
+    op.execute('DROP FUNCTION catalogue_stats_movies()')
+    op.execute('DROP FUNCTION catalogue_stats_actors()')
+    op.execute('DROP FUNCTION catalogue_stats_year(timestamp)')
+    op.execute('DROP FUNCTION catalogue_stats_age_bucket(integer)')
+    op.execute('DROP FUNCTION catalogue_stats_bump(text, text, bigint)')
+    op.drop_table('catalogue_stats')
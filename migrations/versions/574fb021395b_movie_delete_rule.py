@@ -0,0 +1,41 @@
+"""ON DELETE rule of actors.movie_id
+
+Revision ID: 574fb021395b
+Revises: c1bd1a574d4d
+Create Date: 2026-10-19 17:20:41.207356
+
+"""
+from alembic import context, op
+
+
+# revision identifiers, used by Alembic.
+revision = '574fb021395b'
+down_revision = 'c1bd1a574d4d'
+branch_labels = None
+depends_on = None
+
+
+# what deleting a movie does to the actors created for it:
+#   flask db upgrade                        clears their movie_id (default)
+#   flask db -x movie_delete=cascade upgrade  deletes them as well
+RULES = {
+    'set_null': 'SET NULL',
+    'cascade': 'CASCADE'
+}
+
+
+def upgrade():
+    rule = context.get_x_argument(as_dictionary=True).get(
+        'movie_delete', 'set_null')
+    if rule not in RULES:
+        raise ValueError('movie_delete must be one of ' + ', '.join(RULES))
+
+    op.drop_constraint('actors_movie_id_fkey', 'actors', type_='foreignkey')
+    op.create_foreign_key('actors_movie_id_fkey', 'actors', 'movies',
+                          ['movie_id'], ['id'], ondelete=RULES[rule])
+
+
+def downgrade():
+    op.drop_constraint('actors_movie_id_fkey', 'actors', type_='foreignkey')
+    op.create_foreign_key('actors_movie_id_fkey', 'actors', 'movies',
+                          ['movie_id'], ['id'])
@@ -0,0 +1,40 @@
+"""audit log
+
+Revision ID: 69b0ae909e72
+Revises: aa1377f8f0b6
+Create Date: 2026-10-19 21:47:05.381920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '69b0ae909e72'
+down_revision = 'aa1377f8f0b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('audit_log',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('at', sa.Float(), nullable=False),
+                    sa.Column('actor', sa.String(), nullable=True),
+                    sa.Column('action', sa.String(), nullable=False),
+                    sa.Column('table_name', sa.String(), nullable=False),
+                    sa.Column('record_id', sa.Integer(), nullable=True),
+                    sa.Column('record', sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_audit_log_actor_id', 'audit_log', ['actor', 'id'],
+                    unique=False)
+    op.create_index('ix_audit_log_table_name_record_id_id', 'audit_log',
+                    ['table_name', 'record_id', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_audit_log_table_name_record_id_id',
+                  table_name='audit_log')
+    op.drop_index('ix_audit_log_actor_id', table_name='audit_log')
+    op.drop_table('audit_log')
@@ -0,0 +1,190 @@
+"""catalogue statistics spread over slots
+
+Revision ID: 70aa4db0d817
+Revises: f1cc8a7b6c13
+Create Date: 2026-10-20 09:14:37.552904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '70aa4db0d817'
+down_revision = 'f1cc8a7b6c13'
+branch_labels = None
+depends_on = None
+
+
+# every counter is spread over up to 16 rows, one per slot, so that
+# concurrent writes of different connections do not wait for each other on
+# the row of a hot counter (the movie and actor totals); readers sum them
+# updates only move a row between the buckets of the columns that changed
+FUNCTIONS = """
+CREATE OR REPLACE FUNCTION catalogue_stats_bump(p_metric text, p_bucket text,
+                                                p_delta bigint)
+RETURNS void AS $$
+BEGIN
+    INSERT INTO catalogue_stats (metric, bucket, slot, value)
+    VALUES (p_metric, p_bucket, pg_backend_pid() % 16, p_delta)
+    ON CONFLICT (metric, bucket, slot)
+    DO UPDATE SET value = catalogue_stats.value + EXCLUDED.value;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION catalogue_stats_move(p_metric text, p_from text,
+                                     p_to text) RETURNS void AS $$
+BEGIN
+    -- a row leaves the p_from bucket for the p_to one, NULL is none
+    IF p_from IS NOT DISTINCT FROM p_to THEN
+        RETURN;
+    END IF;
+    IF p_from IS NOT NULL THEN
+        PERFORM catalogue_stats_bump(p_metric, p_from, -1);
+    END IF;
+    IF p_to IS NOT NULL THEN
+        PERFORM catalogue_stats_bump(p_metric, p_to, 1);
+    END IF;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION catalogue_stats_actors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM catalogue_stats_move('actors', NULL, '');
+        PERFORM catalogue_stats_move(
+            'actors_by_gender', NULL, coalesce(NEW.gender, 'unknown'));
+        PERFORM catalogue_stats_move(
+            'actors_by_age', NULL, catalogue_stats_age_bucket(NEW.age));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM catalogue_stats_move('actors', '', NULL);
+        PERFORM catalogue_stats_move(
+            'actors_by_gender', coalesce(OLD.gender, 'unknown'), NULL);
+        PERFORM catalogue_stats_move(
+            'actors_by_age', catalogue_stats_age_bucket(OLD.age), NULL);
+    ELSE
+        PERFORM catalogue_stats_move(
+            'actors_by_gender', coalesce(OLD.gender, 'unknown'),
+            coalesce(NEW.gender, 'unknown'));
+        PERFORM catalogue_stats_move(
+            'actors_by_age', catalogue_stats_age_bucket(OLD.age),
+            catalogue_stats_age_bucket(NEW.age));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION catalogue_stats_movies() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM catalogue_stats_move('movies', NULL, '');
+        PERFORM catalogue_stats_move(
+            'releases_by_year', NULL, catalogue_stats_year(NEW.release_date));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM catalogue_stats_move('movies', '', NULL);
+        PERFORM catalogue_stats_move(
+            'releases_by_year', catalogue_stats_year(OLD.release_date), NULL);
+    ELSE
+        PERFORM catalogue_stats_move(
+            'releases_by_year', catalogue_stats_year(OLD.release_date),
+            catalogue_stats_year(NEW.release_date));
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER catalogue_stats_actors ON actors;
+
+CREATE TRIGGER catalogue_stats_actors
+    AFTER INSERT OR DELETE OR UPDATE OF age, gender ON actors
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_stats_actors();
+"""
+
+PREVIOUS_FUNCTIONS = """
+CREATE OR REPLACE FUNCTION catalogue_stats_bump(p_metric text, p_bucket text,
+                                                p_delta bigint)
+RETURNS void AS $$
+BEGIN
+    INSERT INTO catalogue_stats (metric, bucket, value)
+    VALUES (p_metric, p_bucket, p_delta)
+    ON CONFLICT (metric, bucket)
+    DO UPDATE SET value = catalogue_stats.value + EXCLUDED.value;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION catalogue_stats_actors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM catalogue_stats_bump('actors', '', -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(OLD.gender, 'unknown'), -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(OLD.age), -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM catalogue_stats_bump('actors', '', 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(NEW.gender, 'unknown'), 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(NEW.age), 1);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION catalogue_stats_movies() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM catalogue_stats_bump('movies', '', -1);
+        PERFORM catalogue_stats_bump(
+            'releases_by_year', catalogue_stats_year(OLD.release_date), -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM catalogue_stats_bump('movies', '', 1);
+        PERFORM catalogue_stats_bump(
+            'releases_by_year', catalogue_stats_year(NEW.release_date), 1);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION catalogue_stats_move(text, text, text);
+
+DROP TRIGGER catalogue_stats_actors ON actors;
+
+CREATE TRIGGER catalogue_stats_actors
+    AFTER INSERT OR DELETE OR UPDATE OF age, gender, movie_id ON actors
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_stats_actors();
+"""
+
+# the slots of every counter added up in slot 0
+MERGE_SLOTS = """
+CREATE TEMPORARY TABLE merged_stats ON COMMIT DROP AS
+SELECT metric, bucket, sum(value) AS value
+FROM catalogue_stats GROUP BY metric, bucket;
+DELETE FROM catalogue_stats;
+INSERT INTO catalogue_stats (metric, bucket, slot, value)
+SELECT metric, bucket, 0, value FROM merged_stats;
+"""
+
+
+def upgrade():
+    op.add_column('catalogue_stats',
+                  sa.Column('slot', sa.SmallInteger(), nullable=False,
+                            server_default='0'))
+    op.drop_constraint('catalogue_stats_pkey', 'catalogue_stats',
+                       type_='primary')
+    op.create_primary_key('catalogue_stats_pkey', 'catalogue_stats',
+                          ['metric', 'bucket', 'slot'])
+    op.execute(FUNCTIONS)
+
+
+def downgrade():
+    op.execute('LOCK TABLE catalogue_stats IN EXCLUSIVE MODE')
+    op.execute(MERGE_SLOTS)
+    op.execute(PREVIOUS_FUNCTIONS)
+    op.drop_constraint('catalogue_stats_pkey', 'catalogue_stats',
+                       type_='primary')
+    op.create_primary_key('catalogue_stats_pkey', 'catalogue_stats',
+                          ['metric', 'bucket'])
+    op.drop_column('catalogue_stats', 'slot')
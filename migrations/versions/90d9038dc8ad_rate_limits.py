@@ -0,0 +1,30 @@
+"""rate limit buckets
+
+Revision ID: 90d9038dc8ad
+Revises: 8afb811f475c
+Create Date: 2026-10-19 09:12:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '90d9038dc8ad'
+down_revision = '8afb811f475c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_limits',
+                    sa.Column('key', sa.String(), nullable=False),
+                    sa.Column('tokens', sa.Float(), nullable=False),
+                    sa.Column('updated_at', sa.Float(), nullable=False),
+                    sa.Column('admitted', sa.Boolean(), nullable=False),
+                    sa.PrimaryKeyConstraint('key')
+                    )
+
+
+def downgrade():
+    op.drop_table('rate_limits')
@@ -0,0 +1,33 @@
+"""movie documents
+
+Revision ID: aa1377f8f0b6
+Revises: 574fb021395b
+Create Date: 2026-10-19 19:02:13.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aa1377f8f0b6'
+down_revision = '574fb021395b'
+branch_labels = None
+depends_on = None
+
+
+# the documents are written by the app, run `python manage.py
+# rebuild_documents` after upgrading; until then GET /movies serializes
+# the movies without one
+def upgrade():
+    op.create_table('movie_documents',
+                    sa.Column('movie_id', sa.Integer(), nullable=False),
+                    sa.Column('document', sa.String(), nullable=False),
+                    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('movie_id')
+                    )
+
+
+def downgrade():
+    op.drop_table('movie_documents')
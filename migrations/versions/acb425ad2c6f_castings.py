@@ -0,0 +1,118 @@
+"""castings of actors in movies
+
+Revision ID: acb425ad2c6f
+Revises: 4c65f0633275
+Create Date: 2026-10-19 13:02:17.418532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'acb425ad2c6f'
+down_revision = '4c65f0633275'
+branch_labels = None
+depends_on = None
+
+
+# cast_actors now counts castings instead of actors with a movie_id
+ACTORS_FUNCTION = """
+CREATE OR REPLACE FUNCTION catalogue_stats_actors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM catalogue_stats_bump('actors', '', -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(OLD.gender, 'unknown'), -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(OLD.age), -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM catalogue_stats_bump('actors', '', 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(NEW.gender, 'unknown'), 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(NEW.age), 1);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION catalogue_stats_castings() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM catalogue_stats_bump('cast_actors', '', -1);
+    ELSE
+        PERFORM catalogue_stats_bump('cast_actors', '', 1);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER catalogue_stats_castings
+    AFTER INSERT OR DELETE ON castings
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_stats_castings();
+"""
+
+PREVIOUS_ACTORS_FUNCTION = """
+CREATE OR REPLACE FUNCTION catalogue_stats_actors() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM catalogue_stats_bump('actors', '', -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(OLD.gender, 'unknown'), -1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(OLD.age), -1);
+        IF OLD.movie_id IS NOT NULL THEN
+            PERFORM catalogue_stats_bump('cast_actors', '', -1);
+        END IF;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM catalogue_stats_bump('actors', '', 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_gender', coalesce(NEW.gender, 'unknown'), 1);
+        PERFORM catalogue_stats_bump(
+            'actors_by_age', catalogue_stats_age_bucket(NEW.age), 1);
+        IF NEW.movie_id IS NOT NULL THEN
+            PERFORM catalogue_stats_bump('cast_actors', '', 1);
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade():
+    op.create_table('castings',
+                    sa.Column('movie_id', sa.Integer(), nullable=False),
+                    sa.Column('actor_id', sa.Integer(), nullable=False),
+                    sa.Column('role', sa.String(), nullable=True),
+                    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'],
+                                            ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+                    )
+    op.create_index('ix_castings_actor_id_movie_id', 'castings',
+                    ['actor_id', 'movie_id'], unique=False)
+
+    # no casting may be missed between the copy and the new triggers
+    op.execute('LOCK TABLE movies, actors IN SHARE MODE')
+    op.execute('INSERT INTO castings (movie_id, actor_id) '
+               'SELECT movie_id, id FROM actors WHERE movie_id IS NOT NULL')
+    op.execute(ACTORS_FUNCTION)
+    op.execute("UPDATE catalogue_stats SET value = "
+               "(SELECT count(*) FROM castings) WHERE metric = 'cast_actors'")
+
+
+def downgrade():
+    op.execute('LOCK TABLE movies, actors IN SHARE MODE')
+    op.execute('DROP TRIGGER catalogue_stats_castings ON castings')
+    op.execute('DROP FUNCTION catalogue_stats_castings()')
+    op.execute(PREVIOUS_ACTORS_FUNCTION)
+    op.execute("UPDATE catalogue_stats SET value = "
+               "(SELECT count(movie_id) FROM actors) "
+               "WHERE metric = 'cast_actors'")
+    op.drop_index('ix_castings_actor_id_movie_id', table_name='castings')
+    op.drop_table('castings')
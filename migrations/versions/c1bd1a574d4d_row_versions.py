@@ -0,0 +1,28 @@
+"""versions of movies and actors for optimistic concurrency
+
+Revision ID: c1bd1a574d4d
+Revises: e806a5c79ba6
+Create Date: 2026-10-19 16:05:12.830114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c1bd1a574d4d'
+down_revision = 'e806a5c79ba6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movies', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+    op.add_column('actors', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
@@ -0,0 +1,41 @@
+"""background jobs
+
+Revision ID: e806a5c79ba6
+Revises: acb425ad2c6f
+Create Date: 2026-10-19 15:21:40.662170
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e806a5c79ba6'
+down_revision = 'acb425ad2c6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('kind', sa.String(), nullable=False),
+                    sa.Column('owner', sa.String(), nullable=False),
+                    sa.Column('params', sa.String(), nullable=False),
+                    sa.Column('status', sa.String(), nullable=False),
+                    sa.Column('progress', sa.Integer(), nullable=False),
+                    sa.Column('total', sa.Integer(), nullable=True),
+                    sa.Column('result', sa.String(), nullable=True),
+                    sa.Column('error', sa.String(), nullable=True),
+                    sa.Column('attempts', sa.Integer(), nullable=False),
+                    sa.Column('created_at', sa.Float(), nullable=False),
+                    sa.Column('updated_at', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_jobs_status_id', 'jobs', ['status', 'id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_jobs_status_id', table_name='jobs')
+    op.drop_table('jobs')
@@ -0,0 +1,36 @@
+"""idempotency keys
+
+Revision ID: f1cc8a7b6c13
+Revises: 69b0ae909e72
+Create Date: 2026-10-19 23:05:12.406318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1cc8a7b6c13'
+down_revision = '69b0ae909e72'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+                    sa.Column('key', sa.String(), nullable=False),
+                    sa.Column('fingerprint', sa.String(), nullable=False),
+                    sa.Column('expires_at', sa.Float(), nullable=False),
+                    sa.Column('status', sa.Integer(), nullable=True),
+                    sa.Column('headers', sa.String(), nullable=True),
+                    sa.Column('body', sa.LargeBinary(), nullable=True),
+                    sa.PrimaryKeyConstraint('key')
+                    )
+    op.create_index('ix_idempotency_keys_expires_at', 'idempotency_keys',
+                    ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_keys_expires_at',
+                  table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -1,31 +1,390 @@
 import os
 from sqlalchemy import ForeignKey, Column, String, Integer, \
-                    DateTime, create_engine
-from sqlalchemy.orm import relationship
+                    BigInteger, DateTime, Float, Boolean, Index, LargeBinary, \
+                    SmallInteger, \
+                    create_engine, event, exists, false, literal, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import backref, relationship
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 import json
-import os
-from flask_migrate import Migrate
 
 database_name = "capstone"
 # database_path = "postgres://{}/{}".format('localhost:5432', database_name)
-database_path = "postgres:///{}".format(database_name)
-database_path = os.environ['DATABASE_URL']
+default_database_path = "postgres:///{}".format(database_name)
 db = SQLAlchemy()
 
 '''
 setup_db(app)
         binds a flask application and a SQLAlchemy service
+        the database path defaults to the DATABASE_URL of the app settings
+        no engine is created here, it is built on the first query
+        PostgreSQL cancels statements that run longer than the
+        DB_STATEMENT_TIMEOUT seconds of the settings (0 for no limit)
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = app.config.get('DATABASE_URL') or \
+            default_database_path
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    statement_timeout = app.config.get('DB_STATEMENT_TIMEOUT')
+    if statement_timeout and database_path.startswith('postgres'):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {'connect_args': {
+            'options': '-c statement_timeout={}'.format(
+                statement_timeout * 1000)}}
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)
+
+
+@event.listens_for(Engine, 'connect')
+def enforce_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys, and so their ON DELETE rules, unless
+    # they are enabled on every connection
+    if type(dbapi_connection).__module__ == 'sqlite3':
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+'''
+dispose_engines(app)
+        drops pooled connections inherited from a parent process
+        called from the gunicorn post_fork hook when the app is preloaded
+'''
+
+
+def dispose_engines(app):
+    db.get_engine(app).dispose()
+
+
+'''
+on_write(app, listener)
+        registers listener(action, table, record) on the app, it is called
+        after every committed write of a Movie or an Actor
+        action is 'insert', 'update' or 'delete', table the table name and
+        record the written row as a dict (for deletes the key, with what
+        the ON DELETE rules changed, see delete_rows)
+        with in_transaction=True the listener is called before the commit
+        instead, in the transaction of the write: what it writes with
+        db.session is committed with the write, and an exception it raises
+        fails the write
+commit_write(*writes)
+        commits the session with the (action, table, record) writes it
+        holds, calling the listeners of each write around the commit
+        the movies whose cast the writes changed (see cast_movie_ids) are
+        updated too, their version incremented in the same transaction, so
+        that the ETag of GET /movies/<id>, which includes the cast, follows
+        it; their updates are written after the others
+'''
+
+
+def on_write(app, listener, in_transaction=False):
+    key = 'transaction_listeners' if in_transaction else 'write_listeners'
+    app.extensions.setdefault(key, []).append(listener)
+
+
+def notify_write(action, table, record):
+    for listener in current_app.extensions.get('write_listeners', ()):
+        listener(action, table, record)
+
+
+def commit_write(*writes):
+    writes += touch_movies(writes)
+    listeners = current_app.extensions.get('transaction_listeners', ())
+    for write in writes:
+        for listener in listeners:
+            listener(*write)
+    db.session.commit()
+    for write in writes:
+        notify_write(*write)
+
+
+def row_dict(instance):
+    return {column.name: getattr(instance, column.name)
+            for column in instance.__table__.columns}
+
+
+'''
+insert_returning(table, values) / update_returning(table, id, values)
+        write a row and read it back in the same statement with
+        INSERT/UPDATE ... RETURNING, without building an ORM instance
+        dialects without RETURNING fall back to a follow-up SELECT
+        return the row as a dict, or None if no row has the given id
+delete_by_id(table, id)
+        deletes a row with a single DELETE, without loading it or its
+        relationships; the ON DELETE rules of the foreign keys remove its
+        castings and clear actors.movie_id, without write events of their own
+        returns whether there was a row with the given id
+delete_rows(table, ids)
+        deletes the movies or actors with the given ids and returns the
+        delete event records of the ones that existed, by id: with the
+        actor_ids whose movie_id the deletion of a movie clears (or who are
+        deleted with it, see the movie_delete rule of the migrations) and
+        the movie_ids of the other movies these actors are cast in, or the
+        movie_ids whose cast an actor leaves
+        with RETURNING, the DELETE is a CTE of the statement that reads
+        these ids, which sees the rows as they were before the statement;
+        other dialects read them first
+'''
+
+
+def supports_returning():
+    # the dialect only knows once the engine has connected
+    return db.session.connection().dialect.implicit_returning
+
+
+def select_row(table, id):
+    row = db.session.execute(
+        table.select().where(table.c.id == id)).fetchone()
+    return None if row is None else dict(row)
+
+
+def insert_row(table, values):
+    statement = table.insert().values(**values)
+    if supports_returning():
+        return dict(db.session.execute(
+            statement.returning(*table.c)).fetchone())
+    result = db.session.execute(statement)
+    return select_row(table, result.inserted_primary_key[0])
+
+
+'''
+Optimistic concurrency
+        movies and actors carry a version that every update increments
+        with versions, update_row() only changes the row while its version
+        is one of them, in the same UPDATE statement and without locking
+        the row first; VersionConflict is raised when the row exists with
+        another version
+'''
+
+
+class VersionConflict(Exception):
+    pass
+
+
+def check_version(row, versions):
+    if row is not None and versions is not None and \
+            row['version'] not in versions:
+        raise VersionConflict(row['version'])
+
+
+def update_row(table, id, values, versions=None):
+    statement = table.update().where(table.c.id == id).values(**values)
+    if 'version' in table.c:
+        statement = statement.values(version=table.c.version + 1)
+    if versions is not None:
+        statement = statement.where(
+            table.c.version.in_(versions) if versions else false())
+
+    if supports_returning():
+        row = db.session.execute(statement.returning(*table.c)).fetchone()
+        row = None if row is None else dict(row)
+    else:
+        result = db.session.execute(statement)
+        row = select_row(table, id) if result.rowcount else None
+
+    if row is None and versions is not None:
+        check_version(select_row(table, id), versions)
+    return row
+
+
+def insert_returning(table, values):
+    row = insert_row(table, values)
+    commit_write(('insert', table.name, row))
+    return row
+
+
+def update_returning(table, id, values, versions=None):
+    if not values:
+        row = select_row(table, id)
+        check_version(row, versions)
+        return row
+
+    row = update_row(table, id, values, versions)
+    if row is None:
+        db.session.commit()
+    else:
+        commit_write(('update', table.name, row))
+    return row
+
+
+def delete_by_id(table, id):
+    records = delete_rows(table, [id])
+    if not records:
+        db.session.commit()
+        return False
+    commit_write(('delete', table.name, records[id]))
+    return True
+
+
+def delete_rows(table, ids):
+    effects = delete_effects(table, ids)
+    statement = table.delete().where(table.c.id.in_(ids))
+    if not supports_returning():
+        rows = db.session.execute(effects).fetchall()
+        existing = [id for id, in db.session.execute(
+            select([table.c.id]).where(table.c.id.in_(ids)))]
+        db.session.execute(statement)
+        return delete_records(table, existing, rows)
+
+    deleted = statement.returning(table.c.id).cte('deleted')
+    effects = effects.cte('effects')
+    columns = [deleted.c.id] + \
+        [column for column in effects.c if column.name != 'id']
+    rows = db.session.execute(
+        select(columns)
+        .select_from(deleted.outerjoin(effects,
+                                       effects.c.id == deleted.c.id))
+        .order_by(*columns)).fetchall()
+    return delete_records(table, sorted({row.id for row in rows}), rows)
+
+
+def delete_effects(table, ids):
+    # (id, actor_id, movie_id) of the actors created for the movies and
+    # their castings, or (id, movie_id) of the castings of the actors
+    if table.name == 'movies':
+        actors = Actor.__table__
+        return select([actors.c.movie_id.label('id'),
+                       actors.c.id.label('actor_id'), castings.c.movie_id]) \
+            .select_from(actors.outerjoin(
+                castings, castings.c.actor_id == actors.c.id)) \
+            .where(actors.c.movie_id.in_(ids)) \
+            .order_by(actors.c.movie_id, actors.c.id, castings.c.movie_id)
+    return select([castings.c.actor_id.label('id'), castings.c.movie_id]) \
+        .where(castings.c.actor_id.in_(ids)) \
+        .order_by(castings.c.actor_id, castings.c.movie_id)
+
+
+def delete_records(table, ids, rows):
+    # the event records of the deleted ids, from the rows of delete_effects
+    if table.name == 'actors':
+        records = {id: {'id': id, 'movie_ids': []} for id in ids}
+        for row in rows:
+            if row.id in records and row.movie_id is not None:
+                records[row.id]['movie_ids'].append(row.movie_id)
+        return records
+
+    records = {id: {'id': id, 'actor_ids': [], 'movie_ids': []}
+               for id in ids}
+    for row in rows:
+        record = records.get(row.id)
+        if record is None or row.actor_id is None:
+            continue
+        if row.actor_id not in record['actor_ids']:
+            record['actor_ids'].append(row.actor_id)
+        if row.movie_id is not None and row.movie_id not in ids and \
+                row.movie_id not in record['movie_ids']:
+            record['movie_ids'].append(row.movie_id)
+    return records
+
+
+'''
+cast_movie_ids(action, table, record)
+        the ids of the movies whose cast a write changed, besides the
+        movies it wrote: the movie of a casting, the movies of an actor (of
+        the actors of an import), the movies a deleted actor left or the
+        other movies of the actors a deleted movie cleared or deleted
+touch_movies(writes)
+        increments the version of these movies, locked in id order, and
+        returns their updates as writes
+'''
+
+
+def cast_movie_ids(action, table, record):
+    if table == castings.name:
+        return [record['movie_id']]
+    if action == 'delete':
+        return record.get('movie_ids', [])
+    if table != 'actors':
+        return []
+    if action == 'import':
+        where = castings.c.actor_id.between(record['min_id'],
+                                            record['max_id'])
+    else:
+        where = castings.c.actor_id == record['id']
+    return [id for id, in db.session.execute(
+        select([castings.c.movie_id]).distinct().where(where))]
+
+
+def touch_movies(writes):
+    written = {record['id'] for action, table, record in writes
+               if table == 'movies' and action != 'import'}
+    ids = set()
+    for write in writes:
+        ids.update(cast_movie_ids(*write))
+    ids = sorted(ids - written)
+    if not ids:
+        return ()
+
+    movies = Movie.__table__
+    db.session.execute(
+        select([movies.c.id]).where(movies.c.id.in_(ids))
+        .order_by(movies.c.id).with_for_update(key_share=True)).fetchall()
+    statement = movies.update().where(movies.c.id.in_(ids)) \
+        .values(version=movies.c.version + 1)
+    if supports_returning():
+        rows = db.session.execute(statement.returning(*movies.c)).fetchall()
+    else:
+        db.session.execute(statement)
+        rows = db.session.execute(
+            movies.select().where(movies.c.id.in_(ids))).fetchall()
+    return tuple(('update', movies.name, dict(row))
+                 for row in sorted(rows, key=lambda row: row.id))
+
+
+'''
+castings
+        the many-to-many association of movies and actors, with the role
+        the primary key (movie_id, actor_id) serves the cast of a movie,
+        the (actor_id, movie_id) index the movies of an actor
+'''
+
+castings = db.Table(
+    'castings',
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    Column('role', String, nullable=True),
+    Index('ix_castings_actor_id_movie_id', 'actor_id', 'movie_id')
+)
+
+
+'''
+add_casting(movie_id, actor_id, role=None)
+        casts an existing actor in an existing movie, in the current
+        transaction; a single INSERT ... SELECT checks that both exist and
+        that the actor is not already cast in the movie
+        returns the casting as a dict, or None if nothing was inserted
+'''
+
+
+def add_casting(movie_id, actor_id, role=None):
+    movies = Movie.__table__
+    actors = Actor.__table__
+    already_cast = exists().where(castings.c.movie_id == movie_id) \
+        .where(castings.c.actor_id == actor_id)
+    source = select([movies.c.id, actors.c.id,
+                     literal(role, type_=String)]) \
+        .where(movies.c.id == movie_id) \
+        .where(actors.c.id == actor_id) \
+        .where(~already_cast)
+    result = db.session.execute(castings.insert().from_select(
+        ['movie_id', 'actor_id', 'role'], source))
+    if result.rowcount == 0:
+        return None
+    return {'movie_id': movie_id, 'actor_id': actor_id, 'role': role}
+
+
+def remove_casting(movie_id, actor_id):
+    result = db.session.execute(castings.delete()
+                                .where(castings.c.movie_id == movie_id)
+                                .where(castings.c.actor_id == actor_id))
+    return result.rowcount > 0
 
 
 '''
@@ -40,7 +399,14 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String)
     release_date = Column(DateTime)
-    actors = relationship('Actor', backref="movie", lazy=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # the database clears actors.movie_id and removes the castings of a
+    # deleted movie, so the ORM does not have to load them first
+    actors = relationship('Actor', backref="movie", lazy=True,
+                          passive_deletes=True)
+    cast = relationship('Actor', secondary=castings, lazy=True,
+                        passive_deletes=True,
+                        backref=backref('movies', passive_deletes=True))
 
     def __init__(self, title, release_date):
         self.title = title
@@ -48,23 +414,64 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        record = row_dict(self)
+        commit_write(('insert', self.__tablename__, record))
 
     def update(self):
-        db.session.commit()
+        record = row_dict(self)
+        commit_write(('update', self.__tablename__, record))
 
     def delete(self):
+        record = {'id': self.id}
         db.session.delete(self)
-        db.session.commit()
+        commit_write(('delete', self.__tablename__, record))
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
             'release_date': self.release_date,
-            'actors': list(map(lambda actor: actor.format(), self.actors))
+            'version': self.version,
+            'actors': list(map(lambda actor: actor.format(), self.cast))
         }
 
+    @classmethod
+    def create(cls, **values):
+        movie = insert_returning(cls.__table__, values)
+        movie['actors'] = []
+        return movie
+
+    @classmethod
+    def update_by_id(cls, id, versions=None, **values):
+        return update_returning(cls.__table__, id, values, versions)
+
+    @classmethod
+    def delete_by_id(cls, id):
+        return delete_by_id(cls.__table__, id)
+
+    @classmethod
+    def cast_by_id(cls, id):
+        # one query: the movie, left joined to its castings and actors;
+        # None if there is no such movie
+        actors = Actor.__table__
+        rows = db.session.execute(
+            select([cls.__table__.c.id.label('found'), castings.c.role,
+                    actors])
+            .select_from(cls.__table__
+                         .outerjoin(castings,
+                                    castings.c.movie_id == cls.id)
+                         .outerjoin(actors,
+                                    actors.c.id == castings.c.actor_id))
+            .where(cls.id == id)
+            .order_by(actors.c.id)).fetchall()
+        if not rows:
+            return None
+        return [{'id': row.id, 'name': row.name, 'age': row.age,
+                 'gender': row.gender, 'movie_id': row.movie_id,
+                 'version': row.version, 'role': row.role}
+                for row in rows if row.id is not None]
+
 '''
 Actor
 '''
@@ -78,7 +485,9 @@ class Actor(db.Model):
     name = Column(String)
     age = Column(Integer)
     gender = Column(String)
-    movie_id = Column(Integer, ForeignKey('movies.id'), nullable=True)
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='SET NULL'),
+                      nullable=True)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
 
     def __init__(self, name, age, gender, movie_id):
         self.name = name
@@ -88,14 +497,18 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        record = row_dict(self)
+        commit_write(('insert', self.__tablename__, record))
 
     def update(self):
-        db.session.commit()
+        record = row_dict(self)
+        commit_write(('update', self.__tablename__, record))
 
     def delete(self):
+        record = {'id': self.id}
         db.session.delete(self)
-        db.session.commit()
+        commit_write(('delete', self.__tablename__, record))
 
     def format(self):
         return {
@@ -103,5 +516,197 @@ class Actor(db.Model):
             'name': self.name,
             'age': self.age,
             'gender': self.gender,
-            "movie_id": self.movie_id
+            "movie_id": self.movie_id,
+            'version': self.version
         }
+
+    '''
+    movie_id is the movie the actor was created for, the actor is cast in
+    it when it is set; further roles are added as castings
+    '''
+
+    @classmethod
+    def create(cls, **values):
+        actor = insert_row(cls.__table__, values)
+        casting = None
+        if actor['movie_id'] is not None:
+            casting = add_casting(actor['movie_id'], actor['id'])
+        writes = [('insert', cls.__tablename__, actor)]
+        if casting is not None:
+            writes.append(('insert', castings.name, casting))
+        commit_write(*writes)
+        return actor
+
+    @classmethod
+    def update_by_id(cls, id, versions=None, **values):
+        if 'movie_id' not in values:
+            return update_returning(cls.__table__, id, values, versions)
+
+        # a new movie_id moves the actor's casting from the previous movie
+        # to the new one, in the same transaction
+        previous = db.session.execute(
+            select([cls.movie_id]).where(cls.id == id)
+            .with_for_update()).scalar()
+        actor = update_row(cls.__table__, id, values, versions)
+        removed = added = None
+        if actor is not None:
+            if previous is not None and previous != actor['movie_id'] and \
+                    remove_casting(previous, actor['id']):
+                removed = {'movie_id': previous, 'actor_id': actor['id']}
+            if actor['movie_id'] is not None:
+                added = add_casting(actor['movie_id'], actor['id'])
+        writes = []
+        if actor is not None:
+            writes.append(('update', cls.__tablename__, actor))
+        if removed is not None:
+            writes.append(('delete', castings.name, removed))
+        if added is not None:
+            writes.append(('insert', castings.name, added))
+        commit_write(*writes)
+        return actor
+
+    @classmethod
+    def delete_by_id(cls, id):
+        return delete_by_id(cls.__table__, id)
+
+    @classmethod
+    def movies_by_id(cls, id):
+        # one query: the actor, left joined to its castings and movies;
+        # None if there is no such actor
+        movies = Movie.__table__
+        rows = db.session.execute(
+            select([cls.__table__.c.id.label('found'), castings.c.role,
+                    movies])
+            .select_from(cls.__table__
+                         .outerjoin(castings,
+                                    castings.c.actor_id == cls.id)
+                         .outerjoin(movies,
+                                    movies.c.id == castings.c.movie_id))
+            .where(cls.id == id)
+            .order_by(movies.c.id)).fetchall()
+        if not rows:
+            return None
+        return [{'id': row.id, 'title': row.title,
+                 'release_date': row.release_date,
+                 'version': row.version, 'role': row.role}
+                for row in rows if row.id is not None]
+
+
+'''
+rate_limits
+    token buckets of the shared rate limiter backend, see auth/ratelimit.py
+'''
+
+rate_limits = db.Table(
+    'rate_limits',
+    Column('key', String, primary_key=True),
+    Column('tokens', Float, nullable=False),
+    Column('updated_at', Float, nullable=False),
+    Column('admitted', Boolean, nullable=False)
+)
+
+
+'''
+idempotency_keys
+    Idempotency-Key requests and their stored responses, claimed in the
+    transaction of the write, see flaskr/idempotency.py
+'''
+
+idempotency_keys = db.Table(
+    'idempotency_keys',
+    Column('key', String, primary_key=True),
+    Column('fingerprint', String, nullable=False),
+    Column('expires_at', Float, nullable=False, index=True),
+    Column('status', Integer, nullable=True),
+    Column('headers', String, nullable=True),
+    Column('body', LargeBinary, nullable=True)
+)
+
+
+'''
+invalidations
+    invalidation events of the polling notification backend,
+    see flaskr/notifications.py
+'''
+
+invalidations = db.Table(
+    'invalidations',
+    Column('id', Integer, primary_key=True),
+    Column('payload', String, nullable=False),
+    Column('created_at', Float, nullable=False, index=True)
+)
+
+
+'''
+catalogue_stats
+    counters of GET /stats, maintained by triggers on movies and actors,
+    see flaskr/stats.py; a counter is the sum of its slots
+'''
+
+catalogue_stats = db.Table(
+    'catalogue_stats',
+    Column('metric', String, primary_key=True),
+    Column('bucket', String, primary_key=True),
+    Column('slot', SmallInteger, primary_key=True, server_default='0'),
+    Column('value', BigInteger, nullable=False)
+)
+
+
+'''
+jobs
+    background jobs run by `manage.py worker`, see flaskr/jobs.py
+    params and result are JSON documents
+'''
+
+jobs = db.Table(
+    'jobs',
+    Column('id', Integer, primary_key=True),
+    Column('kind', String, nullable=False),
+    Column('owner', String, nullable=False),
+    Column('params', String, nullable=False),
+    Column('status', String, nullable=False),
+    Column('progress', Integer, nullable=False),
+    Column('total', Integer, nullable=True),
+    Column('result', String, nullable=True),
+    Column('error', String, nullable=True),
+    Column('attempts', Integer, nullable=False),
+    Column('created_at', Float, nullable=False),
+    Column('updated_at', Float, nullable=False),
+    Index('ix_jobs_status_id', 'status', 'id')
+)
+
+
+'''
+movie_documents
+    the JSON of every movie as GET /movies returns it, with its cast,
+    regenerated after the writes that change it, see flaskr/documents.py
+'''
+
+movie_documents = db.Table(
+    'movie_documents',
+    Column('movie_id', Integer,
+           ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('document', String, nullable=False)
+)
+
+
+'''
+audit_log
+    who wrote what: a row per committed write, with the JWT sub of the
+    request (or the owner of the job) that made it and the written record
+    as JSON, appended in batches, see flaskr/audit.py
+'''
+
+audit_log = db.Table(
+    'audit_log',
+    Column('id', Integer, primary_key=True),
+    Column('at', Float, nullable=False),
+    Column('actor', String, nullable=True),
+    Column('action', String, nullable=False),
+    Column('table_name', String, nullable=False),
+    Column('record_id', Integer, nullable=True),
+    Column('record', String, nullable=False),
+    Index('ix_audit_log_actor_id', 'actor', 'id'),
+    Index('ix_audit_log_table_name_record_id_id', 'table_name', 'record_id',
+          'id')
+)
@@ -1,20 +1,40 @@
 import os
 import unittest
 import json
+import asyncio
+import tempfile
+import threading
+import time
+from unittest import mock
+from urllib.error import URLError
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwt
+from werkzeug.datastructures import MultiDict
 
 from flaskr import create_app
-from models import setup_db, Movie, Actor
+from flaskr.asgi import AsgiApp
+from flaskr.audit import audit_page
+from flaskr.budgets import QueryBudgetExceeded, query_budget
+from flaskr.documents import check_documents
+from flaskr.imports import create_importer
+from flaskr.jobs import Worker
+from flaskr.settings import Settings
+from flaskr.slowlog import slow_query_report
+from models import setup_db, db, dispose_engines, jobs, idempotency_keys, \
+    Movie, Actor
 
 
 class CapstoneTestCase(unittest.TestCase):
 
     def setUp(self):
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = "capstone_test"
         self.database_path = "postgres:///{}".format(self.database_name)
+        settings = Settings.from_env()
+        settings.query_budget_mode = 'enforce'
+        settings.audit_flush_interval = 0.05
+        self.app = create_app(settings)
         setup_db(self.app, self.database_path)
+        self.client = self.app.test_client
 
         # binds the app to the current context
         with self.app.app_context():
@@ -50,7 +70,15 @@ class CapstoneTestCase(unittest.TestCase):
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        # the audit writer would otherwise reconnect after the dispose
+        self.app.extensions['audit'].flush()
+        dispose_engines(self.app)
+
+    def test_create_app_without_environment(self):
+        app = create_app(Settings.from_env({}))
+
+        self.assertIsNone(app.config['AUTH0_DOMAIN'])
+        self.assertEqual(list(app.config['ALGORITHMS']), ['RS256'])
 
     def test_get_movies(self):
         header_obj = {
@@ -63,6 +91,93 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(type(data["movies"]), type([]))
 
+    def test_get_movies_asgi(self):
+        asgi_app = AsgiApp(self.app)
+        messages = []
+        requests = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            # like a server, block until the client disconnects
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/movies',
+            'query_string': b'',
+            'headers': [(
+                b'authorization',
+                self.auth_headers["Casting Assistant"].encode())],
+        }
+        asyncio.get_event_loop().run_until_complete(
+            asgi_app(scope, receive, send))
+        data = json.loads(b''.join(
+            message.get('body', b'') for message in messages[1:]))
+
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(type(data["movies"]), type([]))
+
+    def test_get_changes_asgi_uses_stream_threads(self):
+        settings = Settings.from_env()
+        settings.changes_heartbeat = 0.1
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        asgi_app = AsgiApp(app)
+        messages = []
+        requests = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await asyncio.sleep(0.5)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/changes',
+            'query_string': b'',
+            'headers': [(
+                b'authorization',
+                self.auth_headers["Casting Assistant"].encode())],
+        }
+        asyncio.get_event_loop().run_until_complete(
+            asgi_app(scope, receive, send))
+
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertTrue(asgi_app.stream_executor._threads)
+        dispose_engines(app)
+
+    def test_get_movies_coalesced(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        status_codes = []
+
+        def get_movies():
+            res = self.client().get('/movies', headers=header_obj)
+            status_codes.append(res.status_code)
+
+        threads = [threading.Thread(target=get_movies) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        metrics = self.app.extensions['metrics'].snapshot()
+
+        self.assertEqual(status_codes, [200] * 10)
+        self.assertEqual(metrics.get('coalescing.executed', 0) +
+                         metrics.get('coalescing.coalesced', 0), 10)
+
     def test_get_actors(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Assistant"]
@@ -74,6 +189,28 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(type(data["actors"]), type([]))
 
+    def test_get_actors_paged(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/actors?gender=F&page=1&per_page=1',
+                                headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertEqual(data['actors'][0]['gender'], 'F')
+        self.assertGreaterEqual(int(res.headers['X-Total-Count']), 1)
+        self.assertEqual(res.headers['X-Total-Count-Type'], 'exact')
+
+    def test_get_movies_fail_400(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/movies?year=last', headers=header_obj)
+
+        self.assertEqual(res.status_code, 400)
+
     def test_get_actors_by_director(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Director"]
@@ -85,6 +222,258 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertEqual(type(data["actors"]), type([]))
 
+    def test_get_movie_fail_404(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/movies/-100', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_get_movie_actors(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        res = self.client().post('/actors', json=self.actor,
+                                 headers=header_obj)
+        actor_id = json.loads(res.data)['actor']['id']
+
+        res = self.client().get('/movies/2/actors', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertIn(actor_id, [actor['id'] for actor in data['actors']])
+
+    def test_get_actor_movies_fail_404(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/actors/-100/movies', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_create_casting(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        res = self.client().post('/actors', json=self.actor,
+                                 headers=header_obj)
+        actor_id = json.loads(res.data)['actor']['id']
+
+        res = self.client().post('/movies/3/actors', json={
+            'actor_id': actor_id,
+            'role': 'Narrator'
+        }, headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['casting']['role'], 'Narrator')
+
+        res = self.client().get('/actors/{}/movies'.format(actor_id),
+                                headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(sorted(movie['id'] for movie in data['movies']),
+                         [2, 3])
+
+        res = self.client().post('/movies/3/actors', json={
+            'actor_id': actor_id
+        }, headers=header_obj)
+
+        self.assertEqual(res.status_code, 409)
+
+    def test_delete_casting(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        res = self.client().post('/actors', json=self.actor,
+                                 headers=header_obj)
+        actor_id = json.loads(res.data)['actor']['id']
+
+        res = self.client().delete('/movies/2/actors/{}'.format(actor_id),
+                                   headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted']['actor_id'], actor_id)
+
+        res = self.client().delete('/movies/2/actors/{}'.format(actor_id),
+                                   headers=header_obj)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_profile_sampled_request(self):
+        settings = Settings.from_env()
+        settings.profile_sample_rate = 1.0
+        settings.profile_dir = tempfile.mkdtemp()
+        settings.profile_keep = 2
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        for _ in range(3):
+            res = app.test_client().get('/movies', headers=header_obj)
+
+        self.assertEqual(res.status_code, 200)
+        profile = app.extensions['profiles'].load(res.headers['X-Profile-Id'])
+        self.assertEqual(profile['endpoint'], 'retrieve_movies')
+        self.assertEqual(profile['status'], 200)
+        self.assertTrue(profile['sql']['statements'] > 0)
+        self.assertEqual(len(app.extensions['profiles'].list()), 2)
+
+        res = app.test_client().get('/profiles', headers=header_obj)
+
+        self.assertEqual(res.status_code, 403)
+
+    def test_profile_header_without_jwks(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"],
+            "X-Profile": "1"
+        }
+        expected = self.client().get('/ready')
+        with mock.patch('auth.auth.verify_decode_jwt',
+                        side_effect=URLError('Auth0 is down')):
+            res = self.client().get('/ready', headers=header_obj)
+
+        self.assertEqual(res.status_code, expected.status_code)
+        self.assertNotIn('X-Profile-Id', res.headers)
+
+    def test_slow_query_log(self):
+        settings = Settings.from_env()
+        settings.slow_query_threshold = 1e-9
+        settings.slow_query_log = os.path.join(tempfile.mkdtemp(),
+                                               'slow.jsonl')
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        app.test_client().get('/movies/2', headers=header_obj)
+
+        queries = []
+        for _ in range(50):
+            if os.path.exists(settings.slow_query_log):
+                queries = [query for query in slow_query_report(
+                    settings.slow_query_log) if query['plan']]
+            if queries:
+                break
+            time.sleep(0.1)
+
+        self.assertTrue(queries)
+        self.assertIn('GET /movies/<int:movie_id>', queries[0]['routes'])
+        self.assertNotIn("2", queries[0]['statement'].split())
+
+    def test_query_budget_exceeded(self):
+        @query_budget(1)
+        def list_twice():
+            Movie.query.all()
+            Movie.query.all()
+
+        with self.app.test_request_context('/movies'):
+            with self.assertRaises(QueryBudgetExceeded):
+                list_twice()
+
+    def test_ready_after_warmup(self):
+        settings = Settings.from_env()
+        settings.warmup_budget = 5
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+
+        for _ in range(60):
+            res = app.test_client().get('/ready')
+            if res.status_code == 200:
+                break
+            self.assertEqual(res.status_code, 503)
+            time.sleep(0.1)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['ready'])
+        self.assertTrue(data['steps']['database_pool'].startswith('done'))
+        # the warm-up filled the pool of this app
+        dispose_engines(app)
+
+    def test_cors_preflight(self):
+        res = self.client().options('/movies/1', headers={
+            "Origin": "http://localhost:8100",
+            "Access-Control-Request-Method": "PATCH",
+            "Access-Control-Request-Headers": "authorization,if-match"
+        })
+
+        self.assertEqual(res.status_code, 204)
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'], '*')
+        self.assertIn('PATCH', res.headers['Access-Control-Allow-Methods'])
+        self.assertIn('If-Match', res.headers['Access-Control-Allow-Headers'])
+        self.assertEqual(res.headers['Access-Control-Max-Age'], '7200')
+
+        res = self.client().get('/movies', headers={
+            "Authorization": self.auth_headers["Casting Assistant"]
+        })
+
+        self.assertEqual(res.headers['Access-Control-Allow-Origin'], '*')
+        self.assertIn('X-Total-Count',
+                      res.headers['Access-Control-Expose-Headers'])
+
+    def test_get_stats(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/stats', headers=header_obj)
+        data = json.loads(res.data)
+        movies = data['stats']['movies']
+
+        self.client().post('/movies', json={
+            'title': 'Stats Movie',
+            'release_date': '2020-02-19'
+        }, headers={
+            "Authorization": self.auth_headers["Executive Producer"]
+        })
+        res = self.client().get('/stats', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['stats']['movies'], movies + 1)
+        self.assertEqual(data['stats']['actors'],
+                         sum(data['stats']['actors_by_gender'].values()))
+
+    def test_stats_follow_only_changed_columns(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().post('/actors', json=dict(self.actor, age=41),
+                                 headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+        with self.app.app_context():
+            before = db.session.execute(
+                'SELECT count(*) FROM catalogue_stats').scalar()
+        self.client().patch(f'/actors/{a_id}', json={'name': 'Ata Demirer'},
+                            headers=header_obj)
+        with self.app.app_context():
+            after = db.session.execute(
+                'SELECT count(*) FROM catalogue_stats').scalar()
+        res = self.client().get('/stats', headers=header_obj)
+        stats = json.loads(res.data)['stats']
+        self.client().patch(f'/actors/{a_id}', json={'age': 85},
+                            headers=header_obj)
+        res = self.client().get('/stats', headers=header_obj)
+        moved = json.loads(res.data)['stats']
+
+        self.assertEqual(after, before)
+        self.assertEqual(moved['actors'], stats['actors'])
+        self.assertEqual(moved['actors_by_age']['40-49'],
+                         stats['actors_by_age']['40-49'] - 1)
+        self.assertEqual(moved['actors_by_age']['80-89'],
+                         stats['actors_by_age'].get('80-89', 0) + 1)
+        self.assertEqual(sum(moved['actors_by_age'].values()),
+                         moved['actors'])
+
     def test_get_actor_fail_401(self):
         res = self.client().get('/actors')
         data = json.loads(res.data)
@@ -103,6 +492,14 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
+        self.assertEqual(data['movie']['title'], self.movie['title'])
+        self.assertEqual(data['movie']['actors'], [])
+
+        res = self.client().get(res.headers['Location'], headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['title'], self.movie['title'])
 
     def test_create_movies_fail_400(self):
         header_obj = {
@@ -139,6 +536,225 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 200)
         self.assertTrue(data['success'])
+        self.assertEqual(data['actor']['name'], self.actor['name'])
+        self.assertTrue(
+            res.headers['Location'].endswith(f"/actors/{data['actor']['id']}"))
+
+    def test_create_actors_idempotent(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "Idempotency-Key": "test-create-actors-idempotent"
+        }
+        res = self.client().post(f'/actors',
+                                 json=self.actor, headers=header_obj)
+        replay = self.client().post(f'/actors',
+                                    json=self.actor, headers=header_obj)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.data, res.data)
+
+    def test_create_actors_idempotent_fail_409(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "Idempotency-Key": "test-create-actors-idempotent-409"
+        }
+        self.client().post(f'/actors',
+                           json=self.actor, headers=header_obj)
+        other_actor = dict(self.actor, name="Şener Şen")
+        res = self.client().post(f'/actors',
+                                 json=other_actor, headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertFalse(data['success'])
+
+    def test_create_actors_idempotent_across_workers(self):
+        # a second app stands for another gunicorn worker
+        other_app = create_app(Settings.from_env())
+        setup_db(other_app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "Idempotency-Key": "test-create-actors-idempotent-workers"
+        }
+        res = self.client().post(f'/actors',
+                                 json=self.actor, headers=header_obj)
+        replay = other_app.test_client().post(f'/actors',
+                                              json=self.actor,
+                                              headers=header_obj)
+        dispose_engines(other_app)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(replay.data, res.data)
+
+    def test_purge_expired_idempotency_keys(self):
+        now = time.time()
+        rows = [{'key': f'test-purge {i}', 'fingerprint': '',
+                 'expires_at': now - 1} for i in range(5)]
+        rows.append({'key': 'test-purge live', 'fingerprint': '',
+                     'expires_at': now + 60})
+        with self.app.app_context():
+            db.session.execute(idempotency_keys.delete().where(
+                idempotency_keys.c.expires_at <= now))
+            db.session.execute(idempotency_keys.insert(), rows)
+            db.session.commit()
+            purged = self.app.extensions['idempotency'].purge(batch_size=2)
+            db.session.execute(idempotency_keys.insert(), [rows[0]])
+            db.session.commit()
+        Worker(self.app).purge_idempotency_keys()
+        with self.app.app_context():
+            keys = [row.key for row in db.session.execute(
+                idempotency_keys.select().where(
+                    idempotency_keys.c.key.like('test-purge %')))]
+            db.session.execute(idempotency_keys.delete().where(
+                idempotency_keys.c.key.like('test-purge %')))
+            db.session.commit()
+
+        self.assertEqual(purged, 5)
+        self.assertEqual(keys, ['test-purge live'])
+
+    def test_import_actors(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "Content-Type": "application/x-ndjson"
+        }
+        body = '\n'.join([
+            json.dumps(self.actor),
+            json.dumps(dict(self.actor, movie_id=-100)),
+            '{"name": ',
+            json.dumps(dict(self.actor, name='Ata Demirer')),
+            ''
+        ])
+        res = self.client().post('/import/actors', data=body,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['row'] for error in data['errors']], [2, 3])
+
+    def test_import_actors_reports_failing_rows(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "Content-Type": "application/x-ndjson"
+        }
+        body = b'\n'.join([
+            json.dumps(self.actor).encode(),
+            b'{"name": "\xff"}',
+            json.dumps(self.actor).encode()
+        ])
+        res = self.client().post('/import/actors', data=body,
+                                 headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['errors'], [{'row': 2,
+                                           'error': 'Invalid UTF-8'}])
+
+        # a movie deleted after the ids were loaded: the database rejects
+        # that row only, the rest of its batch is imported
+        with self.app.app_context():
+            movie_id = Movie.create(title='Gone', release_date=None)['id']
+            importer = create_importer('actors', self.app.config)
+            Movie.delete_by_id(movie_id)
+            rows = [(1, self.actor), (2, dict(self.actor, movie_id=movie_id)),
+                    (3, self.actor)]
+            report = importer.run(iter(rows)).report()
+
+        self.assertEqual(report['imported'], 2)
+        self.assertEqual([error['row'] for error in report['errors']], [2])
+
+    def test_import_movies_csv(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"],
+            "Content-Type": "text/csv"
+        }
+        body = 'title,release_date\n"Pek Yakında, 2",2020-11-02\n' \
+               'Undated,\n'
+        res = self.client().post('/import/movies', data=body.encode(),
+                                 headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['errors'][0]['row'], 2)
+
+    def run_jobs(self):
+        worker = Worker(self.app)
+        with self.app.app_context():
+            while worker.work_once():
+                pass
+
+    def test_export_movies_job(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().post('/export/movies', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(data['job']['status'], 'queued')
+
+        self.run_jobs()
+        res = self.client().get(res.headers['Location'], headers=header_obj)
+        job = json.loads(res.data)['job']
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result']['rows'], job['total'])
+
+        res = self.client().get('/jobs/{}/result'.format(job['id']),
+                                headers=header_obj)
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(lines), job['total'])
+        self.assertIn('release_date', json.loads(lines[0]))
+
+        res = self.client().get('/jobs/{}/result'.format(job['id']),
+                                headers=header_obj)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_import_actors_job(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "Content-Type": "application/x-ndjson",
+            "Prefer": "respond-async"
+        }
+        res = self.client().post('/import/actors',
+                                 data=json.dumps(self.actor) + '\n',
+                                 headers=header_obj)
+        job_id = json.loads(res.data)['job']['id']
+
+        self.assertEqual(res.status_code, 202)
+
+        self.run_jobs()
+        res = self.client().get('/jobs/{}'.format(job_id),
+                                headers=header_obj)
+        job = json.loads(res.data)['job']
+
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['result']['imported'], 1)
+        with self.app.app_context():
+            row = db.session.execute(
+                jobs.select().where(jobs.c.id == job_id)).fetchone()
+
+        # the upload is removed once the import has finished
+        self.assertFalse(os.path.exists(json.loads(row['params'])['path']))
+
+    def test_get_job_fail_404(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Assistant"]
+        }
+        res = self.client().get('/jobs/-100', headers=header_obj)
+
+        self.assertEqual(res.status_code, 404)
 
     def test_create_actors_fail_400(self):
         header_obj = {
@@ -153,6 +769,70 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertEqual(data['message'], "Missing field for Actor")
 
+    def test_create_actors_fail_400_invalid(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        res = self.client().post('/actors', json=dict(self.actor, age='old'),
+                                 headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['message'], "Invalid age")
+
+        res = self.client().patch('/actors/2', json={'age': 2 ** 31},
+                                  headers=header_obj)
+
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().post('/actors', json=dict(self.actor,
+                                                      movie_id=1000),
+                                 headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_create_actors_coerces_fields(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        res = self.client().post('/actors', json=dict(self.actor, age='45'),
+                                 headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['age'], 45)
+
+    def test_create_actors_unknown_movie_without_query(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        settings = Settings.from_env()
+        settings.notify_backend = 'none'
+        local_app = create_app(settings)
+        setup_db(local_app, self.database_path)
+        for app in (self.app, local_app):
+            with app.app_context():
+                app.extensions['movie_ids'].current()
+        # a movie whose write event never reaches the workers
+        with self.app.app_context():
+            movie_id = db.session.execute(
+                "INSERT INTO movies (title) VALUES ('Unseen') RETURNING id"
+            ).scalar()
+            db.session.commit()
+
+        res = self.client().post('/actors',
+                                 json=dict(self.actor, movie_id=movie_id),
+                                 headers=header_obj)
+        local_res = local_app.test_client().post(
+            '/actors', json=dict(self.actor, movie_id=movie_id),
+            headers=header_obj)
+        dispose_engines(local_app)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(local_res.status_code, 200)
+
     def test_create_actors_fail_403(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Assistant"]
@@ -165,6 +845,24 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertFalse(data['success'])
 
+    def test_create_movies_fail_429(self):
+        settings = Settings.from_env()
+        settings.rate_limits = {'post:movies': '1/60'}
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        app.test_client().post(f'/movies',
+                               json=self.movie, headers=header_obj)
+        res = app.test_client().post(f'/movies',
+                                     json=self.movie, headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertFalse(data['success'])
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
     def test_delete_movie(self):
         header_obj = {
             "Authorization": self.auth_headers["Executive Producer"]
@@ -191,6 +889,184 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assertFalse(found_deleted)
 
+    def test_delete_movie_keeps_actors(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().post('/movies', json=self.movie,
+                                 headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        actor = dict(self.actor, movie_id=m_id)
+        res = self.client().post('/actors', json=actor, headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+
+        res = self.client().delete(f'/movies/{m_id}', headers=header_obj)
+
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(f'/actors/{a_id}', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['actor']['movie_id'])
+
+        res = self.client().get(f'/actors/{a_id}/movies', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'], [])
+
+    def test_read_model_snapshot(self):
+        settings = Settings.from_env()
+        settings.read_model = True
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().get('/actors?page=1&per_page=1',
+                                headers=header_obj)
+        a_id = json.loads(res.data)['actors'][0]['id']
+        for path in ('/movies?page=1&per_page=3', '/actors?min_age=40',
+                     '/movies/2', '/movies/2/actors', f'/actors/{a_id}',
+                     f'/actors/{a_id}/movies'):
+            expected = self.client().get(path, headers=header_obj)
+            res = app.test_client().get(path, headers=header_obj)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(sorted_casts(json.loads(res.data)),
+                             sorted_casts(json.loads(expected.data)))
+            self.assertEqual(res.headers.get('X-Total-Count'),
+                             expected.headers.get('X-Total-Count'))
+
+        res = app.test_client().post('/movies', json=self.movie,
+                                     headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        actor = dict(self.actor, movie_id=m_id)
+        app.test_client().post('/actors', json=actor, headers=header_obj)
+        app.test_client().delete(f'/movies/{m_id}', headers=header_obj)
+        res = app.test_client().get('/actors?name=Cem', headers=header_obj)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(None, [actor['movie_id'] for actor in data['actors']])
+        self.assertTrue(
+            app.extensions['metrics'].snapshot()['read_model.bytes'] > 0)
+
+    def set_movie_delete_rule(self, rule):
+        # the movie_delete rule of the migrations, SET NULL by default
+        with self.app.app_context():
+            db.session.execute(
+                "ALTER TABLE actors DROP CONSTRAINT actors_movie_id_fkey, "
+                "ADD CONSTRAINT actors_movie_id_fkey FOREIGN KEY (movie_id) "
+                "REFERENCES movies (id) ON DELETE " + rule)
+            db.session.commit()
+
+    def test_read_model_follows_cascading_movie_delete(self):
+        settings = Settings.from_env()
+        settings.read_model = True
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = app.test_client().post('/movies', json=self.movie,
+                                     headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        actor = dict(self.actor, movie_id=m_id)
+        res = app.test_client().post('/actors', json=actor,
+                                     headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+        app.test_client().get(f'/actors/{a_id}', headers=header_obj)
+
+        self.set_movie_delete_rule('CASCADE')
+        try:
+            app.test_client().delete(f'/movies/{m_id}', headers=header_obj)
+        finally:
+            self.set_movie_delete_rule('SET NULL')
+        res = app.test_client().get(f'/actors/{a_id}', headers=header_obj)
+        dispose_engines(app)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_read_model_follows_actor_import(self):
+        settings = Settings.from_env()
+        settings.read_model = True
+        app = create_app(settings)
+        setup_db(app, self.database_path)
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = app.test_client().post('/movies', json=self.movie,
+                                     headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        app.test_client().get(f'/movies/{m_id}', headers=header_obj)
+        body = json.dumps(dict(self.actor, movie_id=m_id)) + '\n'
+        app.test_client().post('/import/actors', data=body,
+                               headers=dict(header_obj, **{
+                                   'Content-Type': 'application/x-ndjson'}))
+        res = app.test_client().get(f'/movies/{m_id}', headers=header_obj)
+        expected = self.client().get(f'/movies/{m_id}', headers=header_obj)
+        dispose_engines(app)
+        actors = json.loads(res.data)['movie']['actors']
+
+        self.assertEqual([actor['name'] for actor in actors],
+                         [self.actor['name']])
+        self.assertEqual(json.loads(res.data), json.loads(expected.data))
+
+    def test_movie_documents_follow_writes(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().post('/movies', json=self.movie,
+                                 headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        actor = dict(self.actor, movie_id=m_id)
+        res = self.client().post('/actors', json=actor, headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+        self.client().patch(f'/actors/{a_id}', json={'age': 46},
+                            headers=header_obj)
+
+        res = self.client().get('/movies?page=1&per_page=1000',
+                                headers=header_obj)
+        movie = [movie for movie in json.loads(res.data)['movies']
+                 if movie['id'] == m_id][0]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor['age'] for actor in movie['actors']], [46])
+        with self.app.app_context():
+            self.assertEqual(check_documents()['outdated'], [])
+
+    def test_movie_documents_follow_cascading_movie_delete(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().post('/movies', json=self.movie,
+                                 headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        actor = dict(self.actor, movie_id=m_id)
+        res = self.client().post('/actors', json=actor, headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+        res = self.client().post('/movies', json=self.movie,
+                                 headers=header_obj)
+        other_id = json.loads(res.data)['movie']['id']
+        self.client().post(f'/movies/{other_id}/actors',
+                           json={'actor_id': a_id}, headers=header_obj)
+
+        self.set_movie_delete_rule('CASCADE')
+        try:
+            res = self.client().delete(f'/movies/{m_id}',
+                                       headers=header_obj)
+        finally:
+            self.set_movie_delete_rule('SET NULL')
+
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(f'/movies/{other_id}', headers=header_obj)
+        movie = json.loads(res.data)['movie']
+        self.assertEqual(movie['actors'], [])
+        with self.app.app_context():
+            self.assertEqual(check_documents()['outdated'], [])
+
     def test_delete_movie_fail_404(self):
         header_obj = {
             "Authorization": self.auth_headers["Executive Producer"]
@@ -297,6 +1173,214 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['updated']['id'], update_id_movie)
         self.assertEqual(data['updated']['title'], new_title)
 
+    def test_update_movie_if_match(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().get('/movies/3', headers=header_obj)
+        etag = res.headers['ETag']
+
+        res = self.client().patch('/movies/3', json={'title': 'Avengers'},
+                                  headers=dict(header_obj, **{
+                                      'If-Match': etag}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.headers['ETag'],
+                         '"{}"'.format(data['updated']['version']))
+
+        res = self.client().patch('/movies/3', json={'title': 'Lost'},
+                                  headers=dict(header_obj, **{
+                                      'If-Match': etag}))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertFalse(data['success'])
+
+    def test_movie_etag_follows_cast(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().post('/movies', json=self.movie,
+                                 headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        res = self.client().post('/actors', json=self.actor,
+                                 headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+
+        etags = [self.client().get(f'/movies/{m_id}',
+                                   headers=header_obj).headers['ETag']]
+        self.client().post(f'/movies/{m_id}/actors',
+                           json={'actor_id': a_id}, headers=header_obj)
+        etags.append(self.client().get(f'/movies/{m_id}',
+                                       headers=header_obj).headers['ETag'])
+        self.client().patch(f'/actors/{a_id}', json={'age': 46},
+                            headers=header_obj)
+        res = self.client().get(f'/movies/{m_id}', headers=header_obj)
+        etags.append(res.headers['ETag'])
+        data = json.loads(res.data)
+        self.client().delete(f'/movies/{m_id}/actors/{a_id}',
+                             headers=header_obj)
+        etags.append(self.client().get(f'/movies/{m_id}',
+                                       headers=header_obj).headers['ETag'])
+        res = self.client().patch(f'/movies/{m_id}', json={'title': 'Lost'},
+                                  headers=dict(header_obj, **{
+                                      'If-Match': etags[2]}))
+
+        self.assertEqual(len(set(etags)), 4)
+        self.assertEqual(data['movie']['actors'][0]['age'], 46)
+        self.assertEqual(etags[2], '"{}"'.format(data['movie']['version']))
+        self.assertEqual(res.status_code, 412)
+
+    def test_update_actor_if_match_fail_404(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"],
+            "If-Match": '"1"'
+        }
+        res = self.client().patch('/actors/-100', json={'age': 40},
+                                  headers=header_obj)
+
+        self.assertEqual(res.status_code, 404)
+
+    def test_get_changes(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        self.client().patch('/actors/2', json={'age': 44},
+                            headers=header_obj)
+        feed = self.app.extensions['changes']
+        stream_header_obj = dict(header_obj)
+        stream_header_obj['Last-Event-ID'] = feed.event_id(0)
+        res = self.client().get('/changes', headers=stream_header_obj,
+                                buffered=False)
+        frames = iter(res.response)
+        next(frames)
+        frame = next(frames).decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertIn('id: ' + feed.event_id(1), frame)
+        self.assertIn('event: actors.update', frame)
+        res.close()
+
+        # an id of another worker
+        stream_header_obj['Last-Event-ID'] = 'f00:1'
+        res = self.client().get('/changes', headers=stream_header_obj,
+                                buffered=False)
+        frames = iter(res.response)
+        next(frames)
+
+        self.assertIn('event: reset', next(frames).decode())
+        res.close()
+
+        # without Last-Event-ID, a change made before the stream is read
+        res = self.client().get('/changes', headers=header_obj,
+                                buffered=False)
+        self.client().patch('/actors/2', json={'age': 45},
+                            headers=header_obj)
+        frames = iter(res.response)
+        next(frames)
+
+        self.assertIn('"age": 45', next(frames).decode())
+        res.close()
+
+    def test_audit_log_records_writes(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        token = self.auth["roles"]["Casting Director"]["jwt_token"]
+        sub = jwt.get_unverified_claims(token)['sub']
+        self.client().patch('/actors/2', json={'age': 43},
+                            headers=header_obj)
+        self.client().patch('/actors/2', json={'age': 44},
+                            headers=header_obj)
+        self.app.extensions['audit'].flush()
+
+        args = {'table': 'actors', 'record_id': '2', 'limit': '1'}
+        with self.app.app_context():
+            first, next_before = audit_page(MultiDict(args))
+            args['before'] = str(next_before)
+            second, _ = audit_page(MultiDict(args))
+
+        self.assertEqual(first[0]['actor'], sub)
+        self.assertEqual(first[0]['action'], 'update')
+        self.assertEqual(first[0]['record']['age'], 44)
+        self.assertEqual(second[0]['record']['age'], 43)
+        self.assertTrue(second[0]['id'] < first[0]['id'])
+
+        res = self.client().get('/audit', headers=header_obj)
+
+        self.assertEqual(res.status_code, 403)
+
+    def test_update_actor_publishes_invalidation(self):
+        events = []
+        self.app.extensions['notifications'].subscribe(
+            events.append, tables={'actors'})
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        self.client().patch('/actors/2', json={'age': 44},
+                            headers=header_obj)
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].action, 'update')
+        self.assertEqual(events[0].id, 2)
+
+    def test_update_actor_invalidates_other_workers_by_polling(self):
+        # two apps stand for two workers sharing the invalidations table
+        apps = []
+        for _ in range(2):
+            settings = Settings.from_env()
+            settings.notify_backend = 'poll'
+            settings.notify_poll_interval = 0.05
+            app = create_app(settings)
+            setup_db(app, self.database_path)
+            apps.append(app)
+        writer, reader = apps
+        events = []
+        reader.extensions['notifications'].subscribe(
+            events.append, tables={'actors'})
+        reader.extensions['notifications'].ensure_started()
+        time.sleep(0.5)
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        writer.test_client().patch('/actors/-100', json={'age': 43},
+                                   headers=header_obj)
+        writer.test_client().patch('/actors/2', json={'age': 44},
+                                   headers=header_obj)
+        deadline = time.monotonic() + 5
+        while not events and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for app in apps:
+            dispose_engines(app)
+
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].action, 'update')
+        self.assertEqual(events[0].id, 2)
+        self.assertEqual(events[0].record['age'], 44)
+
+    def test_delete_actor_publishes_its_movies(self):
+        events = []
+        self.app.extensions['notifications'].subscribe(
+            events.append, tables={'actors'})
+        header_obj = {
+            "Authorization": self.auth_headers["Executive Producer"]
+        }
+        res = self.client().post('/movies', json=self.movie,
+                                 headers=header_obj)
+        m_id = json.loads(res.data)['movie']['id']
+        actor = dict(self.actor, movie_id=m_id)
+        res = self.client().post('/actors', json=actor, headers=header_obj)
+        a_id = json.loads(res.data)['actor']['id']
+        self.client().delete(f'/actors/{a_id}', headers=header_obj)
+        res = self.client().delete(f'/actors/{a_id}', headers=header_obj)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(events[-1].action, 'delete')
+        self.assertEqual(events[-1].record, {'id': a_id, 'movie_ids': [m_id]})
+
     def test_update_movie_fail_404(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Director"]
@@ -331,6 +1415,25 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['updated']['name'], new_name)
         self.assertEqual(data['updated']['age'], new_age)
 
+    def test_update_actor_moves_casting(self):
+        header_obj = {
+            "Authorization": self.auth_headers["Casting Director"]
+        }
+        res = self.client().post('/actors', json=self.actor,
+                                 headers=header_obj)
+        actor_id = json.loads(res.data)['actor']['id']
+
+        res = self.client().patch(f'/actors/{actor_id}',
+                                  json={'movie_id': 4}, headers=header_obj)
+        old_cast = json.loads(self.client().get(
+            '/movies/2/actors', headers=header_obj).data)['actors']
+        new_cast = json.loads(self.client().get(
+            '/movies/4/actors', headers=header_obj).data)['actors']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(actor_id, [actor['id'] for actor in old_cast])
+        self.assertIn(actor_id, [actor['id'] for actor in new_cast])
+
     def test_update_actor_fail_404(self):
         header_obj = {
             "Authorization": self.auth_headers["Casting Director"]
@@ -358,6 +1461,29 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
 
 
+def sorted_casts(data):
+    # the database returns the cast of a movie in no particular order
+    for movie in data.get('movies', []) + [data.get('movie', {})]:
+        movie.get('actors', []).sort(key=lambda actor: actor['id'])
+    return data
+
+
+def assistant_headers():
+    with open('auth_config.json', 'r') as f:
+        auth = json.loads(f.read())
+    assistant_jwt = auth["roles"]["Casting Assistant"]["jwt_token"]
+    return {"Authorization": f'Bearer {assistant_jwt}'}
+
+
+def test_movie_list_queries_are_constant(assert_constant_queries):
+    assert_constant_queries('/movies', assistant_headers())
+    assert_constant_queries('/movies?page=1&per_page=5', assistant_headers())
+
+
+def test_actor_list_queries_are_constant(assert_constant_queries):
+    assert_constant_queries('/actors', assistant_headers())
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()